@@ -30,7 +30,7 @@ unregistered automatically:
 The most important part of the Handle class is the submit() method, described in
 detail below.
 
-Handle.submit(where, service, request[, sync_option[, unmarshall]])
+Handle.submit(where, service, request[, sync_option[, unmarshall[, interner]]])
 
     submit() submits a request to STAF.
 
@@ -100,6 +100,169 @@ Handle.submit(where, service, request[, sync_option[, unmarshall]])
         STAF.UNMARSHALL_NONE
             No unmarshalling is done. The result is returned as a string.
 
+        STAF.UNMARSHALL_RAW
+            No unmarshalling or decoding is done. The result is returned as a
+            UTF-8 encoded str, copied once from the buffer STAF returned. This
+            avoids building a unicode copy of large results (like the output
+            of FS GET FILE) for callers that want bytes. Error results are
+            still decoded for the STAFResultError.
+
+        STAF.UNMARSHALL_LAZY
+            The result is unmarshalled on demand. Lists, Maps, and Map Classes
+            are returned as read-only STAF.LazyList, STAF.LazyMap, and
+            STAF.LazyMapClass objects that hold on to the marshalled string and
+            unmarshall each item only when it is first accessed. Marshalled
+            strings in the result are unmarshalled recursively (and lazily)
+            when they are accessed. This is much cheaper than full
+            unmarshalling when only a few items of a large result are used.
+            Note that only the parts of the result that are accessed are
+            checked, so STAFUnmarshallError may be raised when accessing an
+            item of invalid data.
+
+    An empty result is returned as the str '' in every mode.
+
+    'interner' makes equal strings in the result share a single object, which
+    can greatly reduce the memory used by large results with many repeated
+    keys and values. It may be True to use a new STAF.Interner for this result,
+    or an Interner object to share strings between results. By default no
+    interning is done. It isn't used with STAF.UNMARSHALL_LAZY.
+
+Handle.submit_many(requests[, max_workers[, unmarshall[, interner]]])
+
+    Submits many synchronous requests at once. 'requests' is an iterable of
+    (where, service, request) tuples, which are submitted by up to
+    'max_workers' threads (8 by default) sharing the handle. Returns a list of
+    the results in the same order as 'requests'. A request that fails doesn't
+    affect the others. Its STAFResultError is put in the list in place of a
+    result, so errors can be checked with isinstance(). Other exceptions stop
+    the batch and are raised.
+
+        requests = [(machine, 'ping', 'ping') for machine in machines]
+        results = h.submit_many(requests, max_workers=50)
+
+Handle.iter_submit_many(requests[, max_workers[, unmarshall[, interner]]])
+
+    Same as submit_many(), but yields (index, result) tuples as the requests
+    complete, where 'index' is the position of the request in 'requests'.
+
+Threads that each need their own handle can share a pool of registered
+handles instead of registering a new one for each task:
+
+class HandlePool(object)
+
+    HandlePool(name[, size[, preregister]])
+
+    Creates a pool of up to 'size' handles (8 by default) registered with
+    'name'. 'preregister' handles are registered right away, and the rest as
+    they're needed.
+
+    acquire() checks out a handle, waiting if all of them are in use, and
+    release(handle) gives it back. The handle() method is a context manager
+    that does both:
+
+        with pool.handle() as h:
+            h.submit('local', 'ping', 'ping')
+
+    pool.submit() takes the same arguments as Handle.submit() and uses a handle
+    from the pool. If it fails with HandleDoesNotExist, because STAFProc was
+    restarted for example, the request is tried again with a newly registered
+    handle. Handles that fail with HandleDoesNotExist in a handle() block, or
+    that were unregistered, are dropped from the pool.
+
+    close() unregisters the idle handles, and handles that are checked out are
+    unregistered when they're released. HandlePool is also a context manager.
+
+Many requests can be in progress at once using an AsyncHandle:
+
+class AsyncHandle(object)
+
+    AsyncHandle(name[, max_workers[, executor]])
+
+    Creates a Handle (available as the 'handle' attribute) with a submit()
+    method that takes the same arguments as Handle.submit() but returns a
+    concurrent.futures.Future for the result instead of waiting for it. The
+    requests, and the unmarshalling of their results, run in a pool of up to
+    'max_workers' threads (8 by default). STAF releases the GIL while waiting
+    for a result. 'executor' can be an existing executor to use instead. The
+    default executor requires concurrent.futures, which is in the 'futures'
+    package on Python 2.
+
+    close() waits for submitted requests, shuts down the executor it created,
+    and unregisters the handle. AsyncHandle is also a context manager.
+
+    The futures work with asyncio through asyncio.wrap_future(), so submitting
+    doesn't block an event loop:
+
+        result = await asyncio.wrap_future(ah.submit('local', 'ping', 'ping'))
+
+A RequestManager runs any number of requests at once without a thread for
+each one, using STAF.REQ_QUEUE:
+
+class RequestManager(object)
+
+    RequestManager(name[, batch_size[, poll_interval]])
+
+    Creates a Handle registered with 'name' (available as the 'handle'
+    attribute). RequestManager.submit(where, service, request[, unmarshall[,
+    interner]]) submits a request with STAF.REQ_QUEUE and returns a
+    concurrent.futures.Future. A single background thread gets the
+    STAF/RequestComplete messages from the handle's queue, up to 'batch_size'
+    (1000 by default) at a time, waiting up to 'poll_interval' seconds (1 by
+    default) for them. It completes each request's future with the
+    unmarshalled result, or with a STAFResultError if the request failed.
+    Requests that complete before submit() returns are handled as well.
+
+    The manager owns the RequestComplete messages on its handle's queue, so
+    the handle shouldn't be used for other queued requests. outstanding()
+    returns the number of requests that haven't completed. close() waits for
+    them, stops the reader, and unregisters the handle. With wait=False, the
+    outstanding futures are cancelled instead (the requests themselves keep
+    running). RequestManager is also a context manager. This requires
+    concurrent.futures, which is in the 'futures' package on Python 2.
+
+Messages sent to a handle's queue, like the notifications from PROCESS START
+with NOTIFY ONEND, can be handled in the background with a QueueListener:
+
+class QueueListener(object)
+
+    QueueListener(handle[, batch_size[, poll_interval[, max_pending[,
+                  workers[, unmarshall[, error_callback]]]]]])
+
+    Starts a thread that reads the queue of the Handle 'handle' with QUEUE
+    GET, up to 'batch_size' messages (1000 by default) at a time, waiting up
+    to 'poll_interval' seconds (1 by default) for them. Each batch is
+    unmarshalled with 'unmarshall' in a single call. The queue entries are
+    passed to callbacks by 'workers' dispatch threads (1 by default).
+
+    add_callback(callback, message_type=None, key=None) registers a callback,
+    which is called with each queue entry of 'message_type'. If 'key' is
+    given, the callback only gets messages of that type with that 'key' value,
+    as set with the KEY option of PROCESS START. A key without a message_type
+    raises ValueError. A callback registered with a
+    message_type of None gets all messages without another callback. Only
+    the types with callbacks are read from the queue, unless there's a
+    callback for all messages. remove_callback(message_type=None, key=None)
+    removes a callback.
+
+        def process_ended(entry):
+            print entry['message']['handle'], entry['message']['rc']
+
+        listener = STAF.QueueListener(h)
+        listener.add_callback(process_ended, 'STAF/Process/End')
+
+    At most 'max_pending' messages (10000 by default, or no limit if it's 0)
+    are held waiting for callbacks. When the callbacks fall behind, the
+    reader gets fewer messages and then stops reading until there's room, so
+    the rest wait in the STAF queue. pending() returns the number of messages
+    waiting. Exceptions raised by callbacks are passed to
+    error_callback(entry, exc_info), or printed to stderr by default. If
+    reading the queue fails, the reader stops and the exception is stored in
+    the 'error' attribute.
+
+    close() stops the reader and waits for the callbacks for messages already
+    read. With wait=False those messages are dropped. The handle isn't
+    unregistered. QueueListener is also a context manager.
+
 Errors and Exceptions
 ---------------------
 class STAFError(Exception)
@@ -150,8 +313,8 @@ Unmarshalling
 -------------
 Two functions are available for doing unmarshalling:
 
-    def unmarshall(data[, mode])
-    def unmarshall_force(data[, mode])
+    def unmarshall(data[, mode[, interner]])
+    def unmarshall_force(data[, mode[, interner]])
 
 Note: Unmarshalling usually happens automatically in the Handle.submit() call,
 so the unmarshall() and unmarshall_force() functions aren't needed most of the
@@ -165,10 +328,187 @@ just a plain string, and it is returned as-is. unmarshall_force() assumes that
 the string is marshalled data and raises STAFUnmarshallError if it cannot be
 unmarshalled.
 
-The optional 'mode' argument has the same meaning as the 'unmarshall' argument
-for Handle.submit(). Using STAF.UNMARSHALL_NONE makes both of these functions
+When it isn't known whether a string holds marshalled data, these can be used
+instead of catching exceptions:
+
+    def try_unmarshall(data[, mode[, interner]])
+    def looks_marshalled(data)
+
+try_unmarshall() is like unmarshall(), but returns STAF.NOT_MARSHALLED instead
+of returning 'data' unchanged, so the two cases can be told apart.
+looks_marshalled() only checks that 'data' starts with a marshalled data header
+that gives the length of the whole string. It's very cheap. A False result means
+that 'data' is definitely not marshalled, but a True result doesn't guarantee
+that unmarshalling will succeed. unmarshall() and recursive unmarshalling use
+this check first, so ordinary strings never cause exceptions to be raised.
+
+The optional 'mode' and 'interner' arguments have the same meaning as the
+'unmarshall' and 'interner' arguments for Handle.submit(). Using
+STAF.UNMARSHALL_NONE or STAF.UNMARSHALL_RAW makes both of these functions
 no-ops, but is still supported for consistency with Handle.submit().
 
+Large results can also be unmarshalled a piece at a time, as the data arrives,
+using the Unmarshaller class:
+
+class Unmarshaller(object)
+
+    Unmarshaller([mode[, interner]])
+
+        Create an incremental unmarshaller. 'mode' and 'interner' have the
+        same meaning as for unmarshall().
+
+    unmarshaller.feed(data)
+
+        Add the next piece of marshalled data. If the marshalled object is a
+        list (possibly in a Marshalling Context), returns a list of the list
+        items that were completed by 'data'. Otherwise returns an empty list.
+
+    unmarshaller.close()
+
+        Returns the unmarshalled object once all of the data has been fed.
+
+    Data is treated as it would be by unmarshall_force(), so feed() and close()
+    raise STAFUnmarshallError for invalid or incomplete data. Pieces must be
+    strings rather than encoded bytes, because marshalled lengths are given in
+    characters. For example, to process the items of a large result stored in
+    a UTF-8 file:
+
+        reader = codecs.getreader('utf-8')(f)
+        u = STAF.Unmarshaller()
+        for chunk in iter(lambda: reader.read(65536), u''):
+            for item in u.feed(chunk):
+                process(item)
+        u.close()
+
+When a result is a list whose items are processed one at a time, the items
+can be unmarshalled one at a time too, so only one is held in memory at once:
+
+    def iter_unmarshall(data[, mode[, interner]])
+
+iter_unmarshall() is a generator yielding the items of the list (which may be
+in a Marshalling Context). Like unmarshall_force(), it raises
+STAFUnmarshallError for invalid data, and it raises ValueError if the data
+isn't a list. For example:
+
+    result = h.submit('local', 'fs', ['list directory', path, 'long'],
+                      unmarshall=STAF.UNMARSHALL_NONE)
+    for entry in STAF.iter_unmarshall(result):
+        writer.writerow([entry['name'], entry['size']])
+
+When only a few items of a large result are needed, unmarshall_select() can be
+used to unmarshall just those items:
+
+    def unmarshall_select(data, paths[, mode])
+
+'paths' is a path string or a sequence of them. Paths are made up of '.key',
+'[n]', and '[*]' steps. For example:
+
+    (names, rcs) = STAF.unmarshall_select(data, ['[*].name', '[*].rc'])
+
+gives a list of the 'name' items and a list of the 'rc' items from a list of
+maps. Everything else in the data is skipped over without being unmarshalled.
+See the docstring for the full details.
+
+Results that are lists of Map Classes, like tables of files or processes, can
+be unmarshalled into columns instead of rows:
+
+    def unmarshall_columns(data[, mode[, numbers[, arrays]]])
+
+The result is a STAF.MapClass (so the columns are in the order given by the
+Map Class Definition) where each value is the list of values for that key.
+With numbers=True, columns of integers are converted to ints. With
+arrays=True, columns are NumPy arrays, which requires NumPy to be installed.
+An empty list gives empty columns if the result has exactly one Map Class
+Definition, and raises ValueError otherwise. For example:
+
+    result = h.submit('local', 'fs', ['list directory', path, 'long'],
+                      unmarshall=STAF.UNMARSHALL_NONE)
+    columns = STAF.unmarshall_columns(result, numbers=True, arrays=True)
+    total = columns['size'].sum()
+
+Very large results that are lists can be unmarshalled using several processes:
+
+    def unmarshall_parallel(data[, mode[, processes[, threshold[, pool]]]])
+
+The list items are split into chunks, which are unmarshalled in a
+multiprocessing pool of 'processes' processes (one per CPU by default) and put
+back together in order. Results smaller than 'threshold' characters (16 MiB by
+default) and results that aren't lists are unmarshalled by unmarshall() in the
+current process, since starting processes and copying data between them
+outweighs the gain for small results. 'pool' can be an existing
+multiprocessing.Pool to use instead of starting new processes. UNMARSHALL_LAZY
+isn't done in parallel. The cyclic garbage collector is disabled for the whole
+process (not just the calling thread) while the chunks are loaded.
+
+The Map Class Definitions from each Marshalling Context are cached, so results
+from services that send the same definitions every time don't have to be
+parsed again. The cache holds definitions for up to 100 different contexts by
+default, discarding the least recently used. It can be controlled with these
+functions:
+
+    def definition_cache_info()
+    def set_definition_cache_size(size)
+    def clear_definition_cache()
+
+definition_cache_info() returns an object with 'hits', 'misses', 'maxsize',
+and 'currsize' attributes, and a hit_rate() method. Setting the size to 0
+disables the cache.
+
+Programs that repeat the same request often, and often get back exactly the
+same result, can also cache whole unmarshalled results:
+
+    def result_cache_info()
+    def set_result_cache_size(size)
+    def clear_result_cache()
+
+This cache is disabled (its size is 0) by default. While it's enabled,
+unmarshalling a string that is the same as a cached one, in the same mode,
+returns the cached result instead of unmarshalling it again. This covers
+unmarshall(), unmarshall_force(), and Handle.submit(), except when an
+'interner' is given. Cached results are shared, so while the cache is enabled
+results are read-only: lists, dicts, and MapClasses are returned as
+STAF.ReadOnlyList, STAF.ReadOnlyDict, and STAF.ReadOnlyMapClass, whose
+modifying methods raise NotImplementedError. list(obj) and obj.copy() give
+modifiable copies.
+
+Unmarshalled results can be saved in a compact binary format and loaded again
+much faster than unmarshalling or unpickling them:
+
+    def dump_snapshot(obj, fileobj)
+    def load_snapshot(fileobj[, lazy])
+
+Snapshots store each Map Class Definition once, no matter how many instances
+use it. 'fileobj' must be opened in binary mode. Snapshots are written and read
+starting at the current position of the file, so several can be written to
+the same file one after another and loaded back in order. Real files are
+memory mapped for loading, and with lazy=True the result is made up of
+LazyLists, LazyMaps, and LazyMapClasses (as with UNMARSHALL_LAZY) that only
+read the parts of the file that are used. Each string and container in a
+snapshot must be smaller than 4 GiB. load_snapshot() raises ValueError for
+invalid data, and lazy results raise ValueError when the invalid part is
+accessed. dump_snapshot() and load_snapshot() without lazy=True disable the
+cyclic garbage collector for the whole process while they run.
+
+class Interner(object)
+
+    Interner([maxsize[, max_length]])
+
+        Create an Interner for use with unmarshalling. An Interner remembers
+        the strings it has seen, and passing it an equal string returns the
+        one it already has. Strings longer than 'max_length' (64 by default)
+        are not interned. If 'maxsize' is given, no more than that many strings
+        are kept. An Interner shared between results with no 'maxsize' keeps
+        every distinct short string it sees, so a limit is a good idea for
+        long-running programs.
+
+    len(interner)
+
+        Returns the number of strings kept.
+
+    interner.clear()
+
+        Forget all of the strings.
+
 STAF has six data types that can appear in marshalled strings. These data types
 and the corresponding Python type used to represent the unmarshalled forms are
 as follows:
@@ -183,7 +523,11 @@ as follows:
      Marshalling Context | (not used)
 
 The first four are straight-forward. String results have the same type as the
-original marshalled data string.
+original marshalled data string. With UNMARSHALL_LAZY, Lists, Maps, and Map
+Classes are instead represented by LazyList, LazyMap, and LazyMapClass. These
+support the read-only parts of the list and dict interfaces, and compare equal
+to lists and dicts with the same contents. LazyMapClass has the same extra
+attributes and methods as MapClass.
 
 A Map Class is basically a Map with an associated Map Class Definition. The Map
 Class Definition includes extra information that is typically only relevant for
@@ -212,7 +556,10 @@ class MapClass(dict)
 
     The main restriction is that you may not add keys to or remove keys from a
     MapClass, because the structure of a MapClass is imposed by the Map Class
-    Definition.
+    Definition. MapClasses created from the same definition share a single
+    copy of the structure, so large numbers of them don't take up much more
+    memory than plain dicts. For the same reason, other attributes can't be
+    added to a MapClass.
 
     MapClasses impose an ordering on the items they contain. This ordering is
     determined by the MapClassDefinition used to create the MapClass. What this
@@ -272,6 +619,18 @@ class MapClassDefinition(object)
         Add a new key along with its display name and optionally a short display
         name. This adds the key to the end of the 'keys' list.
 
+    mapclassdef.map_class([...])
+
+        Returns a new MapClass using this definition. The arguments are used
+        to set values, the same way dict.update() uses them.
+
+    mapclassdef.map_class_rows(rows)
+
+        Returns a list of new MapClass instances using this definition, one for
+        each item of 'rows'. Each row is a sequence of values in the order
+        given by the 'keys' attribute. This is the fastest way to create many
+        MapClass instances.
+
     mapclassdef.display_name(key)
     mapclassdef.display_short_name(key)
 
@@ -279,6 +638,54 @@ class MapClassDefinition(object)
         display_short_name() will return None if no short display name was
         defined for the key.
 
+When the structure of a Map Class is known ahead of time, instances can be
+unmarshalled into other types, like namedtuples or classes with __slots__,
+which are smaller and faster to use than MapClasses:
+
+    def register_map_class(name, factory)
+
+After this, instances of the Map Class named 'name' are unmarshalled by calling
+'factory' with a keyword argument for each key. For example:
+
+    ProcessInfo = collections.namedtuple('ProcessInfo', 'handle pid rc')
+    STAF.register_map_class('STAF/Service/Process/Info', ProcessInfo)
+
+Any exception raised by the factory, like a TypeError for a key it doesn't
+expect, is passed on to the caller. Registering None as the factory goes back
+to using MapClass. Registrations apply to all unmarshalling except
+UNMARSHALL_LAZY, unmarshall_columns(), and load_snapshot(). The objects created
+aren't known to marshall(), and unmarshall_parallel() needs the same
+registrations in its pool processes. Whole results aren't cached (see above)
+while any factories are registered, since the objects they create might not be
+safe to share.
+
+Marshalling
+-----------
+Python objects can be marshalled for use by STAF services or for testing with:
+
+    def marshall(obj)
+
+'obj' can be made up of the types in the table above. Tuples are marshalled as
+Lists, and other objects are marshalled as Strings using str(). If 'obj'
+contains MapClass instances, the result is a Marshalling Context holding a Map
+Class Definition for each Map Class name used. Map Classes with the same name
+must have the same definition.
+
+The result can be unmarshalled again with unmarshall(). Note that marshalled
+strings inside 'obj' are left as they are, so unmarshalling the result with
+UNMARSHALL_RECURSIVE will unmarshall them as well.
+
+Large objects can be marshalled a piece at a time, without building the whole
+marshalled string in memory:
+
+    def iter_marshall(obj[, chunk_size])
+    def marshall_to(obj, fileobj[, chunk_size])
+
+iter_marshall() is a generator that yields the marshalled data in chunks of
+about 'chunk_size' characters. marshall_to() writes the chunks to the
+file-like object 'fileobj'. The output is the same as marshall() gives. 'obj'
+must not be modified while it is being marshalled.
+
 Misc. Functions
 ---------------
 See the docstrings for the full documentation for these functions.
@@ -299,8 +706,17 @@ __all__ = [
     'remove_privacy_delimiters', 'mask_private_data',
     'escape_privacy_delimiters', 'errors', 'strerror', 'STAFError',
     'STAFResultError', 'unmarshall', 'unmarshall_force', 'STAFUnmarshallError',
-    'MapClassDefinition', 'MapClass', 'UNMARSHALL_RECURSIVE',
-    'UNMARSHALL_NON_RECURSIVE', 'UNMARSHALL_NONE',
+    'Unmarshaller', 'MapClassDefinition', 'MapClass', 'UNMARSHALL_RECURSIVE',
+    'UNMARSHALL_NON_RECURSIVE', 'UNMARSHALL_NONE', 'UNMARSHALL_LAZY',
+    'LazyList', 'LazyMap', 'LazyMapClass', 'unmarshall_select', 'marshall',
+    'iter_marshall', 'marshall_to', 'definition_cache_info',
+    'set_definition_cache_size', 'clear_definition_cache', 'Interner',
+    'unmarshall_columns', 'try_unmarshall', 'looks_marshalled',
+    'NOT_MARSHALLED', 'unmarshall_parallel', 'result_cache_info',
+    'set_result_cache_size', 'clear_result_cache', 'ReadOnlyList',
+    'ReadOnlyDict', 'ReadOnlyMapClass', 'dump_snapshot', 'load_snapshot',
+    'register_map_class', 'iter_unmarshall', 'UNMARSHALL_RAW', 'AsyncHandle',
+    'HandlePool', 'RequestManager', 'QueueListener',
 ]
 
 from ._staf import (
@@ -317,6 +733,22 @@ from ._staf import (
     escape_privacy_delimiters,
 )
 
+from ._async import (
+    AsyncHandle,
+)
+
+from ._pool import (
+    HandlePool,
+)
+
+from ._requests import (
+    RequestManager,
+)
+
+from ._listener import (
+    QueueListener,
+)
+
 from ._errors import (
     errors,
     strerror,
@@ -327,10 +759,45 @@ from ._errors import (
 from ._marshall import (
     unmarshall,
     unmarshall_force,
+    try_unmarshall,
+    looks_marshalled,
+    NOT_MARSHALLED,
+    iter_unmarshall,
+    marshall,
+    iter_marshall,
+    marshall_to,
+    definition_cache_info,
+    set_definition_cache_size,
+    clear_definition_cache,
+    result_cache_info,
+    set_result_cache_size,
+    clear_result_cache,
+    register_map_class,
     STAFUnmarshallError,
+    Unmarshaller,
     UNMARSHALL_RECURSIVE,
     UNMARSHALL_NON_RECURSIVE,
     UNMARSHALL_NONE,
+    UNMARSHALL_LAZY,
+    UNMARSHALL_RAW,
+)
+
+from ._select import (
+    unmarshall_select,
+)
+
+from ._columns import (
+    unmarshall_columns,
+)
+
+from ._parallel import (
+    unmarshall_parallel,
+)
+
+from ._lazy import (
+    LazyList,
+    LazyMap,
+    LazyMapClass,
 )
 
 from ._mapclass import (
@@ -338,6 +805,21 @@ from ._mapclass import (
     MapClass,
 )
 
+from ._snapshot import (
+    dump_snapshot,
+    load_snapshot,
+)
+
+from ._readonly import (
+    ReadOnlyList,
+    ReadOnlyDict,
+    ReadOnlyMapClass,
+)
+
+from ._cache import (
+    Interner,
+)
+
 # Clean up names. This gives 'STAF.Handle' istead of 'STAF._staf.Handle'
 for name in __all__:
     obj = globals()[name]
@@ -166,8 +166,7 @@ class String(object):
         buf = ctypes.POINTER(ctypes.c_char)()
         length = ctypes.c_uint()
         StringGetBuffer(self, ctypes.byref(buf), ctypes.byref(length), None)
-        result = buf[:length.value]
-        return result.decode('utf-8')
+        return ctypes.string_at(buf, length.value).decode('utf-8')
 
     def __enter__(self):
         return self
@@ -0,0 +1,104 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Submitting STAF requests without blocking the caller.
+'''
+
+from __future__ import with_statement
+
+import threading
+
+from ._staf import Handle, REQ_SYNC
+from ._marshall import UNMARSHALL_RECURSIVE
+
+class AsyncHandle(object):
+    '''
+    A STAF handle whose submit() method returns a future instead of waiting
+    for the result. Requests are submitted, and their results unmarshalled, in
+    a bounded pool of threads. The STAF call releases the GIL while it waits,
+    so the requests really do run at the same time. Use as a context manager
+    to automatically close the handle.
+    '''
+
+    def __init__(self, name, max_workers=8, executor=None):
+        '''
+        Create an AsyncHandle. 'name' has the same meaning as for Handle.
+
+        'max_workers' limits the number of requests submitted at once.
+        Alternatively, 'executor' can be an existing executor (anything with a
+        submit() method returning concurrent.futures.Future objects, like a
+        concurrent.futures.ThreadPoolExecutor) to use instead. The default
+        executor requires concurrent.futures, which is in the 'futures'
+        package for Python 2.
+        '''
+        self._own_executor = executor is None
+        if self._own_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers)
+
+        self.handle = Handle(name)
+        self._executor = executor
+
+        self._cond = threading.Condition()
+        # Futures for requests that haven't finished.
+        self._futures = set()
+        self._closed = False
+
+    def submit(self, where, service, request, sync_option=REQ_SYNC,
+               unmarshall=UNMARSHALL_RECURSIVE, interner=None):
+        '''
+        Same as Handle.submit(), but returns a future for the result. Errors,
+        like STAFResultError, are raised by the future's result() method.
+        Raises ValueError if the handle is closed.
+        '''
+        with self._cond:
+            if self._closed:
+                raise ValueError('handle is closed')
+
+            future = self._executor.submit(self.handle.submit, where, service,
+                                           request, sync_option, unmarshall,
+                                           interner)
+            self._futures.add(future)
+
+        # Called right away if the request has already finished.
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._cond:
+            self._futures.discard(future)
+            self._cond.notifyAll()
+
+    def close(self):
+        '''
+        Wait for the submitted requests to finish, then shut down the executor
+        (unless it was given to the constructor) and unregister the handle.
+        '''
+        with self._cond:
+            self._closed = True
+            while self._futures:
+                self._cond.wait()
+
+        if self._own_executor:
+            self._executor.shutdown(True)
+        self.handle.unregister()
+
+    def handle_num(self):
+        '''
+        Returns the handle number.
+        '''
+        return self.handle.handle_num()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+        # Don't suppress an exception
+        return False
+
+    def __repr__(self):
+        return '<STAF AsyncHandle %d>' % self.handle_num()
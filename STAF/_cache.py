@@ -0,0 +1,201 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Bounded caches used to avoid repeating work across calls.
+'''
+
+import threading
+
+class CacheInfo(object):
+    '''
+    Statistics for a cache. Has 'hits', 'misses', 'maxsize', and 'currsize'
+    attributes.
+    '''
+    def __init__(self, hits, misses, maxsize, currsize):
+        self.hits = hits
+        self.misses = misses
+        self.maxsize = maxsize
+        self.currsize = currsize
+
+    def hit_rate(self):
+        '''
+        Returns the fraction of lookups that were hits, or 0.0 if there were
+        none.
+        '''
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __repr__(self):
+        cls = self.__class__
+        return '%s.%s(hits=%r, misses=%r, maxsize=%r, currsize=%r)' % (
+                cls.__module__, cls.__name__, self.hits, self.misses,
+                self.maxsize, self.currsize)
+
+class LRUCache(object):
+    '''
+    A mapping holding at most 'maxsize' items. When it's full, adding an item
+    discards the least recently used one. A maxsize of 0 disables the cache.
+    Safe to use from multiple threads.
+    '''
+
+    def __init__(self, maxsize):
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._clear()
+
+    def _clear(self):
+        # {key : [prev link, next link, key, value]}. The links form a circular
+        # list, most recently used first, with _root as the list head.
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def get(self, key, default=None):
+        '''
+        Returns the value for 'key', or 'default' if it isn't cached. Counts
+        as a hit or a miss.
+        '''
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._unlink(link)
+            self._push(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = [None, None, key, value]
+                self._links[key] = link
+
+            self._push(link)
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._links)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def _unlink(self, link):
+        (prev_link, next_link) = link[:2]
+        prev_link[1] = next_link
+        next_link[0] = prev_link
+
+    def _push(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        root[1] = first[0] = link
+
+    def _trim(self):
+        root = self._root
+        while len(self._links) > self._maxsize:
+            last = root[0]
+            self._unlink(last)
+            del self._links[last[2]]
+
+    def clear(self):
+        '''
+        Discard all items and reset the hit and miss counts.
+        '''
+        self._lock.acquire()
+        try:
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def set_maxsize(self, maxsize):
+        '''
+        Change the maximum number of items. Items are discarded if there are
+        more than 'maxsize'.
+        '''
+        if maxsize < 0:
+            raise ValueError('cache size must not be negative')
+
+        self._lock.acquire()
+        try:
+            self._maxsize = maxsize
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def info(self):
+        '''
+        Returns a CacheInfo for this cache.
+        '''
+        self._lock.acquire()
+        try:
+            return CacheInfo(self.hits, self.misses, self._maxsize,
+                             len(self._links))
+        finally:
+            self._lock.release()
+
+class Interner(object):
+    '''
+    Makes equal strings share a single object. Calling an Interner with a
+    string returns the first equal string it was called with, so unmarshalled
+    data with many repeated keys and values takes up less memory.
+
+    Strings longer than 'max_length' are returned as they are, since long
+    strings are rarely repeated. At most 'maxsize' strings are kept, or any
+    number if 'maxsize' is None. Once it's full, strings that haven't been
+    seen before are returned as they are.
+    '''
+
+    def __init__(self, maxsize=None, max_length=64):
+        self.maxsize = maxsize
+        self.max_length = max_length
+        self._strings = {}
+
+    def __call__(self, string):
+        if len(string) > self.max_length:
+            return string
+
+        strings = self._strings
+        result = strings.get(string)
+        if result is None:
+            if self.maxsize is None or len(strings) < self.maxsize:
+                # setdefault is atomic, so this is safe to use from multiple
+                # threads.
+                return strings.setdefault(string, string)
+            return string
+
+        # str and unicode strings can be equal, but shouldn't be swapped.
+        if type(result) is not type(string):
+            return string
+
+        return result
+
+    def __len__(self):
+        return len(self._strings)
+
+    def clear(self):
+        '''
+        Forget all of the strings.
+        '''
+        self._strings.clear()
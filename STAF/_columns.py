@@ -0,0 +1,149 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Unmarshalling lists of map classes into columns.
+'''
+
+import re
+
+from ._marshall import (
+    unmarshall_internal,
+    read_list_start,
+    read_type,
+    read_clc,
+    STAFUnmarshallError,
+    UNMARSHALL_RECURSIVE,
+    UNMARSHALL_NONE,
+    UNMARSHALL_RAW,
+    UNMARSHALL_LAZY,
+    MapClassUnmarshaller,
+    get_plan,
+)
+from ._mapclass import new_map_class
+
+def unmarshall_columns(data, mode=UNMARSHALL_RECURSIVE, numbers=False,
+                       arrays=False):
+    '''
+    Unmarshall a list of map class instances, all of the same map class, into
+    columns. Returns a MapClass of that class where the value for each key is
+    the list of values for that key, one per row. No MapClass is created for
+    the rows themselves.
+
+    'mode' is used for unmarshalling the values, and is UNMARSHALL_RECURSIVE by
+    default.
+
+    If 'numbers' is True, columns where every value is an integer (or None)
+    are converted to ints, so numbers like sizes can be used directly.
+
+    If 'arrays' is True, columns are NumPy arrays instead of lists. Integer
+    columns without any None values become int64 arrays and other columns
+    become object arrays. This requires NumPy.
+
+    If the list is empty, the columns are empty. The data must then have
+    exactly one map class definition, since there's no other way to tell
+    which map class is in the list.
+
+    Raises STAFUnmarshallError for invalid data, and ValueError if the data
+    isn't a list of map class instances of a single map class, or is an empty
+    list whose map class can't be determined.
+    '''
+    if mode in (UNMARSHALL_NONE, UNMARSHALL_RAW, UNMARSHALL_LAZY):
+        raise ValueError('mode is not supported for columns')
+
+    if arrays:
+        import numpy
+
+    start = read_list_start(data)
+    if start is None:
+        raise ValueError('marshalled data is not a list')
+
+    (context, count, pos, stop) = start
+
+    plan = None
+    columns = None
+    # The values of the current row. They're only held until the row is
+    # finished, then added to the end of their columns.
+    values = []
+    for i in xrange(count):
+        (unmarshaller, pos) = read_type(data, pos, stop)
+        if unmarshaller is not MapClassUnmarshaller:
+            raise ValueError('list items must be map class instances')
+
+        (pos, item_stop) = read_clc(data, pos, stop)
+        (name_start, pos) = read_clc(data, pos, item_stop)
+        class_name = data[name_start:pos]
+
+        if plan is None:
+            plan = get_plan(context, class_name)
+            columns = [[] for key in plan.layout.keys]
+        elif class_name != plan.layout.name:
+            raise ValueError('list items must all be of the same map class')
+
+        del values[:]
+        while True:
+            pos = plan.read_scalars(data, pos, item_stop, values)
+            if len(values) == plan.count:
+                break
+            (value, pos) = unmarshall_internal(data, pos, item_stop, mode,
+                                               context)
+            values.append(value)
+
+        if pos != item_stop:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        for (column, value) in zip(columns, values):
+            column.append(value)
+
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    if plan is None:
+        if len(context) != 1:
+            raise ValueError("can't tell the map class of an empty list")
+        plan = get_plan(context, context.keys()[0])
+        columns = [[] for key in plan.layout.keys]
+
+    for (i, column) in enumerate(columns):
+        is_int = numbers and int_column(column)
+        if is_int:
+            column = [None if value is None else int(value)
+                      for value in column]
+        if arrays:
+            column = make_array(numpy, column, is_int)
+        columns[i] = column
+
+    return new_map_class(plan.layout, columns)
+
+int_matcher = re.compile(r'-?\d+\Z')
+
+def int_column(column):
+    '''
+    Returns True if every value in 'column' is a string representing an
+    integer or None, and at least one isn't None.
+    '''
+    found = False
+    for value in column:
+        if value is None:
+            continue
+        if not isinstance(value, basestring) or not int_matcher.match(value):
+            return False
+        found = True
+
+    return found
+
+def make_array(numpy, column, is_int):
+    if is_int and None not in column:
+        try:
+            return numpy.array(column, dtype=numpy.int64)
+        except OverflowError:
+            pass
+
+    # Building the array an item at a time keeps NumPy from treating nested
+    # lists as extra dimensions.
+    array = numpy.empty(len(column), dtype=object)
+    for (i, value) in enumerate(column):
+        array[i] = value
+
+    return array
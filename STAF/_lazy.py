@@ -0,0 +1,395 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Lazy unmarshalling, used for UNMARSHALL_LAZY. Lists, maps, and map classes are
+represented by read-only objects that keep a reference to the marshalled data
+and only unmarshall an item when it is accessed.
+'''
+
+from ._marshall import (
+    unmarshall,
+    unmarshall_internal,
+    read_type,
+    read_clc,
+    read_scalar,
+    skip_object,
+    read_context_map,
+    looks_marshalled,
+    STAFUnmarshallError,
+    UNMARSHALL_LAZY,
+    UNMARSHALL_NON_RECURSIVE,
+    ListUnmarshaller,
+    MapUnmarshaller,
+    MapClassUnmarshaller,
+    ContextUnmarshaller,
+)
+from ._mapclass import MapClassDefinition
+
+def unmarshall_lazy(data, pos, end, context):
+    '''
+    Lazily unmarshall the object starting at index 'pos' in 'data', without
+    reading past index 'end'. Only the object's header is checked, except
+    for marshalled strings, which are checked in full (but not the strings
+    inside them) so that invalid ones are kept as plain strings, as with
+    UNMARSHALL_RECURSIVE. Returns a tuple of the object and the index just past
+    the end of it.
+    '''
+    (unmarshaller, pos) = read_type(data, pos, end)
+
+    if unmarshaller is None:
+        (obj, pos) = read_scalar(data, pos, end)
+        if obj is not None and looks_marshalled(obj):
+            try:
+                unmarshall_internal(obj, 0, len(obj), UNMARSHALL_NON_RECURSIVE)
+            except STAFUnmarshallError:
+                return (obj, pos)
+            obj = unmarshall(obj, UNMARSHALL_LAZY)
+        return (obj, pos)
+
+    elif unmarshaller is ListUnmarshaller:
+        m = ListUnmarshaller.count_matcher.match(data, pos, end)
+        if m is None:
+            raise STAFUnmarshallError('bad format for list object')
+
+        count = int(m.group())
+        (start, stop) = read_clc(data, m.end(), end)
+        if count > stop - start:
+            raise STAFUnmarshallError('list count exceeds available data')
+
+        return (LazyList(data, start, stop, count, context), stop)
+
+    elif unmarshaller is MapUnmarshaller:
+        (start, stop) = read_clc(data, pos, end)
+        return (LazyMap(data, start, stop, context), stop)
+
+    elif unmarshaller is MapClassUnmarshaller:
+        (pos, stop) = read_clc(data, pos, end)
+        (name_start, start) = read_clc(data, pos, stop)
+        class_name = data[name_start:start]
+
+        class_def = context.get(class_name)
+        if class_def is None:
+            raise STAFUnmarshallError('missing map class definition for %r' %
+                                      class_name)
+
+        return (LazyMapClass(data, start, stop, class_def, context), stop)
+
+    else: # unmarshaller is ContextUnmarshaller
+        (pos, stop) = read_clc(data, pos, end)
+
+        # The context map is small and needed right away, so there's no point
+        # in unmarshalling it lazily.
+        (new_context, pos) = read_context_map(data, pos, stop, context)
+
+        (root_obj, pos) = unmarshall_lazy(data, pos, stop, new_context)
+        if pos != stop:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        return (root_obj, stop)
+
+# Marks items that haven't been unmarshalled yet.
+_unread = object()
+
+class LazyList(object):
+    '''
+    Read-only list-like object used for lists unmarshalled with
+    UNMARSHALL_LAZY. Items are unmarshalled when they are first accessed.
+    '''
+
+    def __init__(self, data, pos, stop, count, context):
+        '''
+        This should not be used directly. Use unmarshall() with
+        UNMARSHALL_LAZY.
+        '''
+        self._data = data
+        self._pos = pos
+        self._stop = stop
+        self._context = context
+        self._count = count
+        # Start index of each item, found on first access. The end of the list
+        # is included to give the end of the last item.
+        self._offsets = None
+        self._items = None
+
+    def _index(self):
+        stop = self._stop
+
+        offsets = [self._pos]
+        for i in xrange(self._count):
+            offsets.append(self._skip(offsets[-1], stop))
+
+        if offsets[-1] != stop:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        self._offsets = offsets
+        self._items = [_unread] * self._count
+
+    def _item(self, index):
+        if self._items is None:
+            self._index()
+
+        item = self._items[index]
+        if item is _unread:
+            item = self._read(self._offsets[index], self._offsets[index + 1])
+            self._items[index] = item
+
+        return item
+
+    # Subclasses can override these to read data in other formats.
+
+    def _read(self, start, end):
+        (item, pos) = unmarshall_lazy(self._data, start, end, self._context)
+        return item
+
+    def _skip(self, pos, end):
+        return skip_object(self._data, pos, end)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(i) for i in xrange(*index.indices(self._count))]
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('list index out of range')
+
+        return self._item(index)
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self._item(i)
+
+    def __reversed__(self):
+        for i in xrange(self._count - 1, -1, -1):
+            yield self._item(i)
+
+    def __contains__(self, value):
+        for item in self:
+            if item == value:
+                return True
+        return False
+
+    def index(self, value):
+        for (i, item) in enumerate(self):
+            if item == value:
+                return i
+        raise ValueError('%r is not in list' % (value,))
+
+    def count(self, value):
+        return sum(1 for item in self if item == value)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyList)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+class LazyMap(object):
+    '''
+    Read-only dict-like object used for maps unmarshalled with UNMARSHALL_LAZY.
+    Values are unmarshalled when they are first accessed.
+    '''
+
+    def __init__(self, data, pos, stop, context):
+        '''
+        This should not be used directly. Use unmarshall() with
+        UNMARSHALL_LAZY.
+        '''
+        self._data = data
+        self._pos = pos
+        self._stop = stop
+        self._context = context
+        # Ordered keys and {key : (start index, end index)} for values, found
+        # on first access.
+        self._keys = None
+        self._offsets = None
+        self._values = {}
+
+    def _index(self):
+        data = self._data
+        stop = self._stop
+
+        keys = []
+        offsets = {}
+        pos = self._pos
+        while pos < stop:
+            (key_start, key_end) = read_clc(data, pos, stop)
+            key = data[key_start:key_end]
+            pos = skip_object(data, key_end, stop)
+
+            if key not in offsets:
+                keys.append(key)
+            offsets[key] = (key_end, pos)
+
+        self._keys = keys
+        self._offsets = offsets
+
+    def _ordered_keys(self):
+        if self._keys is None:
+            self._index()
+        return self._keys
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        if self._offsets is None:
+            self._index()
+
+        (start, end) = self._offsets[key]
+        value = self._read(start, end)
+        self._values[key] = value
+        return value
+
+    def _read(self, start, end):
+        (value, pos) = unmarshall_lazy(self._data, start, end, self._context)
+        return value
+
+    def _skip(self, pos, end):
+        return skip_object(self._data, pos, end)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        if self._offsets is None:
+            self._index()
+        return key in self._offsets
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._ordered_keys())
+
+    def __iter__(self):
+        return iter(self._ordered_keys())
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self._ordered_keys())
+
+    def itervalues(self):
+        for key in self._ordered_keys():
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for key in self._ordered_keys():
+            yield (key, self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        '''
+        Returns a dict with the same items. Items are not copied.
+        '''
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, LazyMap)):
+            return NotImplemented
+        return self.copy() == dict(other.iteritems())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        items = []
+        for (k, v) in self.iteritems():
+            items.append('%r: %r' % (k, v))
+
+        return '{%s}' % ', '.join(items)
+
+class LazyMapClass(LazyMap):
+    '''
+    LazyMap used for map classes unmarshalled with UNMARSHALL_LAZY. Like
+    MapClass, it has a 'class_name' attribute, 'display_name',
+    'display_short_name', and 'definition' methods, and keeps its keys in the
+    order given by the map class definition.
+    '''
+
+    def __init__(self, data, pos, stop, class_def, context):
+        '''
+        This should not be used directly. Use unmarshall() with
+        UNMARSHALL_LAZY.
+        '''
+        super(LazyMapClass, self).__init__(data, pos, stop, context)
+        self.class_name = class_def.name
+        self._class_def = class_def
+
+    def _index(self):
+        stop = self._stop
+
+        keys = self._class_def.keys
+        offsets = {}
+        pos = self._pos
+        for key in keys:
+            end = self._skip(pos, stop)
+            offsets[key] = (pos, end)
+            pos = end
+
+        if pos != stop:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        self._keys = list(keys)
+        self._offsets = offsets
+
+    def _ordered_keys(self):
+        return self._class_def.keys
+
+    def __contains__(self, key):
+        return key in self._class_def._names
+
+    has_key = __contains__
+
+    def display_name(self, key):
+        '''
+        Returns the display name for 'key'.
+        '''
+        return self._class_def.display_name(key)
+
+    def display_short_name(self, key):
+        '''
+        Returns the short form of the display name for 'key', or None if no
+        short name is defined.
+        '''
+        return self._class_def.display_short_name(key)
+
+    def definition(self):
+        '''
+        Return a new MapClassDefinition using the structure of this map class.
+        '''
+        definition = MapClassDefinition(self.class_name)
+        for key in self._class_def.keys:
+            definition.add_item(key, self.display_name(key),
+                                self.display_short_name(key))
+
+        return definition
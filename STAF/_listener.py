@@ -0,0 +1,237 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Reading messages from a handle's queue in the background and passing them to
+callbacks.
+'''
+
+from __future__ import with_statement
+
+import sys
+import threading
+import traceback
+import Queue
+
+from ._staf import REQ_SYNC, wrap_data
+from ._errors import errors, STAFResultError
+from ._marshall import UNMARSHALL_RECURSIVE, UNMARSHALL_LAZY
+from ._lazy import LazyMap
+
+class QueueListener(object):
+    '''
+    Reads the messages on a handle's queue in batches with a single thread and
+    passes each one to the callback registered for its type (and optionally
+    its key). Callbacks run in separate dispatch threads. When they fall
+    behind, the reader stops getting messages, leaving them in the STAF
+    queue. Use as a context manager to automatically close the listener.
+    '''
+
+    def __init__(self, handle, batch_size=1000, poll_interval=1.0,
+                 max_pending=10000, workers=1, unmarshall=UNMARSHALL_RECURSIVE,
+                 error_callback=None):
+        '''
+        Create a QueueListener that reads the queue of the Handle 'handle'.
+        The handle isn't unregistered when the listener is closed.
+
+        The reader gets up to 'batch_size' messages at a time, waiting up to
+        'poll_interval' seconds for them, and unmarshalls each batch with
+        'unmarshall', which must be UNMARSHALL_RECURSIVE or UNMARSHALL_LAZY so
+        that the entries and their messages are maps. At most 'max_pending'
+        messages are held waiting for callbacks, which are run by 'workers'
+        threads. A 'max_pending' of 0 or less means there's no limit.
+
+        'error_callback' is called with the queue entry and the result of
+        sys.exc_info() when a callback raises an exception. By default the
+        traceback is printed to stderr.
+        '''
+        if unmarshall not in (UNMARSHALL_RECURSIVE, UNMARSHALL_LAZY):
+            raise ValueError('unsupported unmarshall mode: %r' % unmarshall)
+
+        self.handle = handle
+        self.batch_size = batch_size
+        self._wait = int(poll_interval * 1000)
+        self._poll_interval = poll_interval
+        self._unmarshall = unmarshall
+        self._error_callback = error_callback
+
+        self._lock = threading.Lock()
+        # {(lowercase message type, key) : callback}
+        self._callbacks = {}
+        self._entries = Queue.Queue(max_pending)
+        self._stopping = threading.Event()
+        # The exception that stopped the reader.
+        self.error = None
+
+        self._reader = threading.Thread(target=self._read_queue)
+        self._workers = [threading.Thread(target=self._dispatch)
+                         for i in xrange(workers)]
+        for thread in [self._reader] + self._workers:
+            thread.setDaemon(True)
+            thread.start()
+
+    def add_callback(self, callback, message_type=None, key=None):
+        '''
+        Call 'callback' with each queue entry of 'message_type' (compared
+        without regard to case). The entry is a map with keys like 'type',
+        'handle', 'machine', and 'message'. If 'key' is given, the callback
+        only gets messages of that type whose message is a map with that
+        value for 'key', like the messages sent by PROCESS START with NOTIFY
+        ONEND KEY. A message_type of None registers a callback for all
+        messages without another callback, and can't be used with 'key'.
+        Replaces any callback already registered for the same type and key.
+
+        Only messages of the registered types are read from the queue, unless
+        there is a callback for all messages. Messages that are read but have
+        no callback (because their key doesn't match) are dropped.
+        '''
+        if message_type is None:
+            if key is not None:
+                raise ValueError('a key needs a message type')
+        else:
+            message_type = message_type.lower()
+
+        with self._lock:
+            self._callbacks[(message_type, key)] = callback
+
+    def remove_callback(self, message_type=None, key=None):
+        '''
+        Remove the callback registered for 'message_type' and 'key'.
+        '''
+        if message_type is not None:
+            message_type = message_type.lower()
+
+        with self._lock:
+            del self._callbacks[(message_type, key)]
+
+    def pending(self):
+        '''
+        Returns the number of messages waiting for callbacks.
+        '''
+        return self._entries.qsize()
+
+    def _queue_request(self):
+        '''
+        Returns the QUEUE request for the next batch, or None if there are no
+        callbacks.
+        '''
+        with self._lock:
+            types = set(message_type for (message_type, key)
+                        in self._callbacks)
+
+        if not types:
+            return None
+
+        # Only as many messages as there is room for are taken from the STAF
+        # queue.
+        count = self.batch_size
+        if self._entries.maxsize > 0:
+            free = self._entries.maxsize - self._entries.qsize()
+            count = max(1, min(count, free))
+
+        request = ['get']
+        if None not in types:
+            for message_type in sorted(types):
+                request.append('type ' + wrap_data(message_type))
+
+        request.append('first %d wait %d' % (count, self._wait))
+        return ' '.join(request)
+
+    def _read_queue(self):
+        while not self._stopping.isSet():
+            request = self._queue_request()
+            if request is None:
+                self._stopping.wait(self._poll_interval)
+                continue
+
+            try:
+                entries = self.handle.submit('local', 'queue', request,
+                                             REQ_SYNC, self._unmarshall)
+            except STAFResultError, exc:
+                if exc.rc in (errors.Timeout, errors.NoQueueElement):
+                    continue
+                self.error = exc
+                return
+            except Exception, exc:
+                self.error = exc
+                return
+
+            # Blocks while the queue is full, which holds up the reader until
+            # the callbacks catch up.
+            for entry in entries:
+                self._entries.put(entry)
+
+    def _dispatch(self):
+        while True:
+            entry = self._entries.get()
+            if entry is None:
+                return
+
+            try:
+                callback = self._find_callback(entry)
+                if callback is not None:
+                    callback(entry)
+            except Exception:
+                if self._error_callback is None:
+                    traceback.print_exc()
+                else:
+                    # The dispatch thread has to keep running, or the reader
+                    # and close() could wait forever for room in the queue.
+                    try:
+                        self._error_callback(entry, sys.exc_info())
+                    except Exception:
+                        traceback.print_exc()
+
+    def _find_callback(self, entry):
+        message_type = entry.get('type')
+        if message_type is not None:
+            message_type = message_type.lower()
+
+        message = entry.get('message')
+        key = None
+        if isinstance(message, (dict, LazyMap)):
+            key = message.get('key')
+
+        with self._lock:
+            for lookup in [(message_type, key), (message_type, None),
+                           (None, None)]:
+                callback = self._callbacks.get(lookup)
+                if callback is not None:
+                    return callback
+
+        return None
+
+    def close(self, wait=True):
+        '''
+        Stop reading the queue. If 'wait' is True, waits for the callbacks
+        for the messages already read. Otherwise those messages are dropped.
+        '''
+        self._stopping.set()
+        while self._reader.isAlive():
+            if not wait:
+                # The reader might be waiting for room in the queue.
+                try:
+                    while True:
+                        self._entries.get_nowait()
+                except Queue.Empty:
+                    pass
+            self._reader.join(0.1)
+
+        for thread in self._workers:
+            self._entries.put(None)
+        for thread in self._workers:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+        # Don't suppress an exception
+        return False
+
+    def __repr__(self):
+        return '<STAF QueueListener for handle %d, %d pending>' % (
+                self.handle.handle_num(), self.pending())
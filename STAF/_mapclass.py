@@ -44,7 +44,7 @@ class KeyView(SetLikeView):
         return val in self._mc
 
     def __iter__(self):
-        return iter(self._mc._keys)
+        return iter(self._mc._layout.keys)
 
 class ItemView(SetLikeView):
     '''
@@ -55,7 +55,7 @@ class ItemView(SetLikeView):
         return key in self._mc and self._mc[key] == value
 
     def __iter__(self):
-        for key in self._mc._keys:
+        for key in self._mc._layout.keys:
             yield (key, self._mc[key])
 
 class ValueView(View):
@@ -66,7 +66,7 @@ class ValueView(View):
         return val in list(self)
 
     def __iter__(self):
-        for key in self._mc._keys:
+        for key in self._mc._layout.keys:
             yield self._mc[key]
 
 class MapClassDefinition(object):
@@ -79,6 +79,9 @@ class MapClassDefinition(object):
         self.name = name
         self.keys = []
         self._names = {} # {'key' : ('display name', 'short display name')}
+        # These are made when needed, and reset when the definition changes.
+        self._layout = None
+        self._plan = None
 
     def __repr__(self):
         cls = self.__class__
@@ -95,6 +98,8 @@ class MapClassDefinition(object):
 
         self.keys.append(key)
         self._names[key] = (display_name, display_short_name)
+        self._layout = None
+        self._plan = None
 
     def display_name(self, key):
         '''
@@ -113,10 +118,66 @@ class MapClassDefinition(object):
         '''
         Return a MapClass instance based on this definition.
         '''
-        cls = MapClass(self.name, self.keys, self._names)
+        layout = self._get_layout()
+        cls = new_map_class(layout, (None,) * len(layout.keys))
         cls.update(*args, **kwargs)
         return cls
 
+    def map_class_rows(self, rows):
+        '''
+        Return a list of MapClass instances based on this definition, one for
+        each item of 'rows'. Each row is a sequence of values in the order
+        given by 'keys'. This is much faster than creating the instances one
+        at a time with map_class().
+        '''
+        layout = self._get_layout()
+        count = len(layout.keys)
+
+        result = []
+        for row in rows:
+            if len(row) != count:
+                raise ValueError('expected %d values, got %d' %
+                                 (count, len(row)))
+            result.append(new_map_class(layout, row))
+
+        return result
+
+    def _get_layout(self):
+        '''
+        Returns the MapClassLayout for the current state of this definition.
+        '''
+        if self._layout is None:
+            self._layout = MapClassLayout(self.name, self.keys, self._names)
+        return self._layout
+
+class MapClassLayout(object):
+    '''
+    The structure of a map class, shared by all of the MapClass instances
+    created from the same definition. Unlike MapClassDefinition, it never
+    changes, so instances don't need their own copies of the keys and display
+    names.
+    '''
+    __slots__ = ('name', 'keys', 'names')
+
+    def __init__(self, name, keys, names):
+        self.name = name
+        self.keys = tuple(keys)
+        self.names = dict(names)
+
+    def __reduce__(self):
+        return (MapClassLayout, (self.name, self.keys, self.names))
+
+def new_map_class(layout, values, cls=None):
+    '''
+    Create a MapClass using 'layout', with the given values in key order. No
+    checking is done. 'cls' can give a subclass of MapClass to create.
+    '''
+    result = dict.__new__(cls or MapClass)
+    dict.__init__(result, zip(layout.keys, values))
+    result.class_name = layout.name
+    result._layout = layout
+    return result
+
 def add_docstring(method):
     '''
     Add a docstring to method by pulling it from the corresponding method in
@@ -133,6 +194,9 @@ class MapClass(dict):
     Adding and removing keys are not supported.
     '''
 
+    # Instances only hold their values and a reference to a shared layout.
+    __slots__ = ('class_name', '_layout')
+
     def __init__(self, class_name, keys, disp_names):
         '''
         Create a new MapClass. 'class_name' gives the Map Class name, 'keys'
@@ -147,36 +211,45 @@ class MapClass(dict):
         super(MapClass, self).__init__()
 
         self.class_name = class_name
-        self._keys = list(keys)
-        self._names = dict(disp_names)
+        self._layout = MapClassLayout(class_name, keys, disp_names)
 
-        for key in self._keys:
-            self[key] = None
+        super(MapClass, self).update(dict.fromkeys(self._layout.keys))
 
     def display_name(self, key):
         '''
         Returns the display name for 'key'.
         '''
-        return self._names[key][0]
+        return self._layout.names[key][0]
 
     def display_short_name(self, key):
         '''
         Returns the short form of the display name for 'key', or None if no
         short name is defined.
         '''
-        return self._names[key][1]
+        return self._layout.names[key][1]
 
     def definition(self):
         '''
         Return a new MapClassDefinition using the structure of this MapClass.
         '''
         definition = MapClassDefinition(self.class_name)
-        for key in self._keys:
-            (disp_name, disp_short) = self._names[key]
+        for key in self._layout.keys:
+            (disp_name, disp_short) = self._layout.names[key]
             definition.add_item(key, disp_name, disp_short)
 
         return definition
 
+    def __reduce__(self):
+        # The layout is pickled once no matter how many instances share it.
+        return (new_map_class, (self._layout, self.values()))
+
+    def __setstate__(self, state):
+        # Only used for MapClasses pickled by older versions, which had a
+        # __dict__ holding the class name, keys, and display names.
+        self.class_name = state['class_name']
+        self._layout = MapClassLayout(state['class_name'], state['_keys'],
+                                      state['_names'])
+
     # Overrides to prevent adding/removing keys.
 
     def __setitem__(self, key, value):
@@ -184,7 +257,13 @@ class MapClass(dict):
         Implements self[key] = value, but raises KeyError if key is not in the
         Map Class Definition.
         '''
-        if key in self._names:
+        try:
+            names = self._layout.names
+        except AttributeError:
+            # Pickles from older versions set the items before the layout.
+            names = None
+
+        if names is None or key in names:
             super(MapClass, self).__setitem__(key, value)
         else:
             raise KeyError(key)
@@ -230,23 +309,23 @@ class MapClass(dict):
     # Overrides to preserve ordering on item access.
 
     def __iter__(self):
-        return iter(self._keys)
+        return iter(self._layout.keys)
 
     def iterkeys(self):
-        return iter(self._keys)
+        return iter(self._layout.keys)
 
     def keys(self):
         return list(self.iterkeys())
 
     def itervalues(self):
-        for key in self._keys:
+        for key in self._layout.keys:
             yield self[key]
 
     def values(self):
         return list(self.itervalues())
 
     def iteritems(self):
-        for key in self._keys:
+        for key in self._layout.keys:
             yield (key, self[key])
 
     def items(self):
@@ -262,9 +341,7 @@ class MapClass(dict):
         return '{%s}' % ', '.join(items)
 
     def copy(self):
-        result = MapClass(self.class_name, self._keys, self._names)
-        result.update(self)
-        return result
+        return new_map_class(self._layout, self.values())
 
     if hasattr(dict, 'viewitems'):
         def viewitems(self):
@@ -7,9 +7,13 @@ STAF data type marshalling.
 '''
 
 import re
+import gc
+import hashlib
 
 from ._errors import STAFError
-from ._mapclass import MapClassDefinition
+from ._mapclass import MapClassDefinition, MapClass, new_map_class
+from ._cache import LRUCache, Interner
+from ._readonly import read_only
 
 class STAFUnmarshallError(STAFError):
     pass
@@ -24,13 +28,30 @@ class NamedConstant(object):
     def __repr__(self):
         return '.'.join([self.__module__, self.name])
 
+    def __reduce__(self):
+        # Pickle by name so the constant is still the same object when it's
+        # unpickled, e.g. in another process.
+        return self.name
+
 UNMARSHALL_RECURSIVE = NamedConstant('UNMARSHALL_RECURSIVE')
 UNMARSHALL_NON_RECURSIVE = NamedConstant('UNMARSHALL_NON_RECURSIVE')
 UNMARSHALL_NONE = NamedConstant('UNMARSHALL_NONE')
+UNMARSHALL_LAZY = NamedConstant('UNMARSHALL_LAZY')
+UNMARSHALL_RAW = NamedConstant('UNMARSHALL_RAW')
+
+# Modes that leave the data as it is.
+no_unmarshall_modes = (UNMARSHALL_NONE, UNMARSHALL_RAW)
+
+# Returned by try_unmarshall() for data that isn't marshalled.
+NOT_MARSHALLED = NamedConstant('NOT_MARSHALLED')
 
 marker = '@SDT/'
 
-def unmarshall(data, mode=UNMARSHALL_RECURSIVE):
+# A complete header: marker, type indicator, list item count, and the
+# colon-length-colon.
+header_matcher = re.compile(r'@SDT/(\$[0S]|[{%*]|\[(\d+)):(\d+):')
+
+def unmarshall(data, mode=UNMARSHALL_RECURSIVE, interner=None):
     '''
     Try to unmarshall the string in 'data'. 'mode' determines how unmarshalling
     is done.
@@ -45,53 +66,342 @@ def unmarshall(data, mode=UNMARSHALL_RECURSIVE):
 
         UNMARSHALL_NONE - doesn't do any unmarshalling.
 
+        UNMARSHALL_RAW - same as UNMARSHALL_NONE here. Handle.submit() also
+        skips decoding the result, returning the UTF-8 encoded str.
+
+        UNMARSHALL_LAZY - Returns read-only list-like and dict-like objects
+        that unmarshall each item when it is first accessed. Strings are
+        recursively unmarshalled (also lazily) when they are accessed.
+
+    'interner' can be used to make equal strings in the result share a single
+    object. It can be True to use a new Interner for this call, or an Interner
+    to share between calls. It isn't used with UNMARSHALL_LAZY.
+
     Returns 'data' if it doesn't appear to be a marshalled object, or if 'mode'
-    is UNMARSHALL_NONE.
+    is UNMARSHALL_NONE or UNMARSHALL_RAW.
+    '''
+    result = try_unmarshall(data, mode, interner)
+    if result is NOT_MARSHALLED:
+        return data
+    return result
+
+def try_unmarshall(data, mode=UNMARSHALL_RECURSIVE, interner=None):
     '''
+    Same as unmarshall, but returns NOT_MARSHALLED instead of 'data' if 'data'
+    isn't a marshalled object. Data that isn't marshalled is usually rejected
+    by looks_marshalled() without any exceptions being raised.
+    '''
+    if mode in no_unmarshall_modes:
+        return data
+
+    if not looks_marshalled(data):
+        return NOT_MARSHALLED
+
     try:
-        return unmarshall_force(data, mode)
+        return unmarshall_force(data, mode, interner)
     except STAFUnmarshallError:
-        return data
+        return NOT_MARSHALLED
 
-def unmarshall_force(data, mode=UNMARSHALL_RECURSIVE):
+def looks_marshalled(data):
+    '''
+    Returns True if 'data' starts with a marshalled data header giving the
+    length of the whole string. This only looks at the header, so it's cheap,
+    but it doesn't mean that the rest of the data is valid. If it returns
+    False, 'data' definitely isn't a marshalled object.
+    '''
+    m = header_matcher.match(data)
+    return m is not None and m.end() + int(m.group(3)) == len(data)
+
+def unmarshall_force(data, mode=UNMARSHALL_RECURSIVE, interner=None):
     '''
     Same as unmarshall, but raises STAFUnmarshallError if unmarshalling isn't
     possible.
     '''
-    if mode == UNMARSHALL_NONE:
+    if mode in no_unmarshall_modes:
         return data
 
-    (obj, remainder) = unmarshall_internal(data, mode)
+    # Objects made by registered factories may be modifiable, so they can't
+    # be shared between callers.
+    use_cache = (interner is None and result_cache.maxsize > 0 and
+                 not map_class_factories)
+    if use_cache:
+        key = result_key(data, mode)
+        obj = result_cache.get(key, not_cached)
+        if obj is not not_cached:
+            return obj
 
-    if remainder != '':
+    end = len(data)
+    if mode == UNMARSHALL_LAZY:
+        from ._lazy import unmarshall_lazy
+        (obj, pos) = unmarshall_lazy(data, 0, end, {})
+    else:
+        (obj, pos) = unmarshall_internal(data, 0, end, mode, None,
+                                         get_interner(interner))
+
+    if pos != end:
         raise STAFUnmarshallError('unexpected trailing data')
 
+    if use_cache:
+        obj = read_only(obj)
+        result_cache[key] = obj
+
     return obj
 
-def unmarshall_internal(data, mode, context=None):
+def iter_unmarshall(data, mode=UNMARSHALL_RECURSIVE, interner=None):
+    '''
+    Generator that unmarshalls the items of a marshalled list (possibly in a
+    marshalling context) one at a time, yielding each item as soon as it's
+    unmarshalled. The list itself is never built.
+
+    'mode' and 'interner' have the same meaning as for unmarshall(), but
+    UNMARSHALL_NONE and UNMARSHALL_RAW aren't supported. Like
+    unmarshall_force(), raises STAFUnmarshallError for invalid data, and
+    ValueError if the data isn't a list. Since this is a generator, these are
+    raised while iterating. Problems after an item are only found once that
+    item has been yielded.
+    '''
+    if mode in no_unmarshall_modes:
+        raise ValueError('%r is not supported for iteration' % mode)
+
+    interner = get_interner(interner)
+
+    start = read_list_start(data)
+    if start is None:
+        raise ValueError('marshalled data is not a list')
+
+    (context, count, pos, stop) = start
+    for i in xrange(count):
+        if mode == UNMARSHALL_LAZY:
+            from ._lazy import unmarshall_lazy
+            (item, pos) = unmarshall_lazy(data, pos, stop, context)
+        else:
+            (item, pos) = unmarshall_internal(data, pos, stop, mode, context,
+                                              interner)
+        yield item
+
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+def read_list_start(data):
+    '''
+    Read the start of marshalled data that is a list, possibly in a
+    marshalling context. Returns a tuple of the map of names to
+    MapClassDefinitions for the context, the number of items, the index of the
+    first item, and the index of the end of the list. Returns None if the data
+    isn't a list.
+    '''
+    end = len(data)
+    context = {}
+
+    (unmarshaller, pos) = read_type(data, 0, end)
+    if unmarshaller is ContextUnmarshaller:
+        (pos, stop) = read_clc(data, pos, end)
+        if stop != end:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        (context, pos) = read_context_map(data, pos, end, context)
+        (unmarshaller, pos) = read_type(data, pos, end)
+
+    if unmarshaller is not ListUnmarshaller:
+        return None
+
+    m = ListUnmarshaller.count_matcher.match(data, pos, end)
+    if m is None:
+        raise STAFUnmarshallError('bad format for list object')
+
+    count = int(m.group())
+    (pos, stop) = read_clc(data, m.end(), end)
+    if stop != end:
+        raise STAFUnmarshallError('unexpected trailing data')
+    if count > stop - pos:
+        raise STAFUnmarshallError('list count exceeds available data')
+
+    return (context, count, pos, stop)
+
+# Unmarshalled results, keyed on the type of the data, the mode, and the length
+# and SHA-1 digest of the data. Keying on a digest keeps the cache from holding
+# on to every payload. Results are shared between callers, so they are made
+# read-only. The cache is disabled by default.
+result_cache = LRUCache(0)
+not_cached = object()
+
+def result_key(data, mode):
+    if isinstance(data, unicode):
+        digest = hashlib.sha1(data.encode('utf-8')).digest()
+    else:
+        digest = hashlib.sha1(data).digest()
+
+    return (type(data), mode, len(data), digest)
+
+def result_cache_info():
+    '''
+    Returns a CacheInfo object with the 'hits', 'misses', 'maxsize', and
+    'currsize' of the cache of unmarshalled results.
+    '''
+    return result_cache.info()
+
+def set_result_cache_size(size):
+    '''
+    Set the maximum number of unmarshalled results that are cached. 0 disables
+    the cache. Only a digest of each payload is kept, but the results can
+    still be large, so the size should be small if the results are big lists.
+    '''
+    result_cache.set_maxsize(size)
+
+def clear_result_cache():
+    '''
+    Empty the cache of unmarshalled results and reset its statistics.
+    '''
+    result_cache.clear()
+
+# The unmarshallers below never slice the marshalled data except to extract
+# strings for the final result. Instead they walk a single string using integer
+# indices. 'pos' is the index where an object starts, and 'end' is the index
+# that the object must not extend past (the end of the enclosing object). This
+# keeps unmarshalling linear in the size of the data.
+#
+# Nesting is handled with an explicit stack of ContainerUnmarshaller instances
+# rather than with recursion, so arbitrarily deep data can be unmarshalled
+# without hitting the recursion limit.
+
+def unmarshall_internal(data, pos, end, mode, context=None, interner=None):
+    '''
+    Unmarshall the object starting at index 'pos' in 'data', without reading
+    past index 'end'. Strings are passed through 'interner', if given. Returns
+    a tuple of the object and the index just past the end of it.
+    '''
     if context is None:
         context = {}
 
-    if not data.startswith(marker):
+    # Unmarshallers for the containers that are still collecting items. The
+    # next object read is an item of the one on top.
+    stack = []
+    # True when (obj, pos) is a finished object that hasn't been added to its
+    # container yet.
+    pending = False
+
+    while True:
+        try:
+            if not pending:
+                (unmarshaller, pos) = read_type(data, pos, end)
+
+                if unmarshaller is None:
+                    (obj, pos) = read_scalar(data, pos, end)
+                    if (mode == UNMARSHALL_RECURSIVE and obj is not None and
+                            looks_marshalled(obj)):
+                        stack.append(EmbeddedUnmarshaller(obj, pos))
+                    else:
+                        if interner is not None and obj is not None:
+                            obj = interner(obj)
+                        pending = True
+                else:
+                    stack.append(unmarshaller(data, pos, end, context,
+                                              interner))
+
+            if pending:
+                pending = False
+                if not stack:
+                    return (obj, pos)
+                stack[-1].add_item(obj, pos)
+
+            # Hand finished containers to the containers holding them until one
+            # is found that needs another item.
+            top = stack[-1]
+            while not top.next_item():
+                stack.pop()
+                if not stack:
+                    return (top.result, top.end)
+                stack[-1].add_item(top.result, top.end)
+                top = stack[-1]
+
+            data = top.data
+            pos = top.pos
+            end = top.stop
+            context = top.context
+
+        except STAFUnmarshallError:
+            # A marshalled string inside the data that turns out not to be
+            # valid is kept as a plain string, like unmarshall() does.
+            while stack and not isinstance(stack[-1], EmbeddedUnmarshaller):
+                stack.pop()
+            if not stack:
+                raise
+
+            top = stack.pop()
+            (obj, pos) = (top.data, top.end)
+            pending = True
+
+def read_type(data, pos, end):
+    '''
+    Read the marker and data type indicator at index 'pos'. Returns a tuple of
+    the ContainerUnmarshaller class for the type and the index following the
+    indicator. The class is None for scalars, which are read with
+    read_scalar().
+    '''
+    if not data.startswith(marker, pos, end):
         raise STAFUnmarshallError('missing marshalled data marker')
 
-    sym_index = len(marker)
-    try:
-        symbol = data[sym_index]
-        rest = data[sym_index+1:]
-    except IndexError:
+    sym_index = pos + len(marker)
+    if sym_index >= end:
         raise STAFUnmarshallError('incomplete marshalled data')
 
+    symbol = data[sym_index]
+    if symbol == '$':
+        return (None, sym_index + 1)
+
     unmarshaller = get_unmarshaller(symbol)
     if unmarshaller is None:
         raise STAFUnmarshallError('unrecognized data type indicator')
 
-    return unmarshaller.unmarshall(rest, mode, context)
+    return (unmarshaller, sym_index + 1)
+
+def skip_object(data, pos, end):
+    '''
+    Returns the index just past the object starting at index 'pos' in 'data'
+    without unmarshalling it. Only the object's header is checked.
+    '''
+    (unmarshaller, pos) = read_type(data, pos, end)
+
+    if unmarshaller is None:
+        if pos >= end or data[pos] not in ('0', 'S'):
+            raise STAFUnmarshallError('bad format for scalar object')
+        pos += 1
+    elif unmarshaller is ListUnmarshaller:
+        m = ListUnmarshaller.count_matcher.match(data, pos, end)
+        if m is None:
+            raise STAFUnmarshallError('bad format for list object')
+        pos = m.end()
+
+    return read_clc(data, pos, end)[1]
+
+def get_interner(interner):
+    '''
+    Returns the Interner to use for an 'interner' argument, or None.
+    '''
+    if interner is True:
+        return Interner()
+    elif interner is False:
+        return None
+    return interner
+
+def without_gc(function, *args):
+    '''
+    Call 'function' with the cyclic garbage collector disabled. Unmarshalling
+    and similar work create lots of objects but no reference cycles, so the
+    collections that would be triggered along the way are wasted time. The
+    collector is disabled for the whole process, so this should only be used
+    for work that ends soon.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if enabled:
+            gc.enable()
 
 def get_unmarshaller(symbol):
-    if symbol == '$':
-        return ScalarUnmarshaller
-    elif symbol == '{':
+    if symbol == '{':
         return MapUnmarshaller
     elif symbol == '[':
         return ListUnmarshaller
@@ -102,139 +412,377 @@ def get_unmarshaller(symbol):
     else:
         return None
 
-class Unmarshaller(object):
+# Map class definitions built from context maps, keyed on the type and text of
+# the marshalled context map. Services tend to send the same definitions with
+# every result, so this usually saves unmarshalling the context map at all.
+definition_cache = LRUCache(100)
+
+def read_context_map(data, pos, end, context):
     '''
-    Base class for all unmarshallers.
+    Read the context map of a marshalling context at index 'pos' in 'data'.
+    Returns a tuple of the map of names to MapClassDefinitions for the context
+    and the index just past the context map.
     '''
-    clc_matcher = re.compile(
-        r'''^
-        :(?P<len>\d+):  # Colon-length-colon
-        (?P<rest>.*)    # Data
-        $''', re.VERBOSE | re.DOTALL)
+    stop = skip_object(data, pos, end)
+    key = (type(data), data[pos:stop])
 
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        raise NotImplementedError()
+    new_context = definition_cache.get(key)
+    if new_context is None:
+        (context_map, pos) = unmarshall_internal(data, pos, stop,
+                                                 UNMARSHALL_NON_RECURSIVE,
+                                                 context)
+        new_context = ContextUnmarshaller.build_context(context_map)
+        definition_cache[key] = new_context
 
-    @classmethod
-    def read_clc_obj(cls, data):
-        '''
-        Read a colon-length-colon denoted object from data. That is, a colon,
-        integer length, colon, and finally a sequence of characters of the given
-        length. Returns a tuple of the object and everything that's left in
-        data. Raises STAFUnmarshallError if the format is not as expected.
-        '''
-        m = cls.clc_matcher.match(data)
-        if m is None:
-            raise STAFUnmarshallError('bad format for colon-length-colon '
-                                      'object')
+    return (new_context, stop)
 
-        (length, rest) = m.group('len', 'rest')
-        length = int(length)
+def definition_cache_info():
+    '''
+    Returns a CacheInfo object with the 'hits', 'misses', 'maxsize', and
+    'currsize' of the cache of map class definitions.
+    '''
+    return definition_cache.info()
 
-        if length > len(rest):
-            raise STAFUnmarshallError('specified length exceeds available data')
+def set_definition_cache_size(size):
+    '''
+    Set the maximum number of marshalling contexts whose map class definitions
+    are cached. 0 disables the cache.
+    '''
+    definition_cache.set_maxsize(size)
 
-        obj = rest[:length]
-        rest = rest[length:]
+def clear_definition_cache():
+    '''
+    Empty the cache of map class definitions and reset its statistics.
+    '''
+    definition_cache.clear()
 
-        return (obj, rest)
+# Only used with match(data, pos, end), so it never looks beyond the
+# colon-length-colon itself.
+clc_matcher = re.compile(r':(\d+):')
 
-class ScalarUnmarshaller(Unmarshaller):
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        if not data.startswith('0') and not data.startswith('S'):
-            raise STAFUnmarshallError('bad format for scalar object')
+def read_clc(data, pos, end):
+    '''
+    Read a colon-length-colon denoted object from data starting at index 'pos'.
+    That is, a colon, integer length, colon, and finally a sequence of
+    characters of the given length. Returns a tuple of the start and end indices
+    of the characters. Raises STAFUnmarshallError if the format is not as
+    expected or if the object extends past index 'end'.
+    '''
+    m = clc_matcher.match(data, pos, end)
+    if m is None:
+        raise STAFUnmarshallError('bad format for colon-length-colon object')
+
+    start = m.end()
+    stop = start + int(m.group(1))
+
+    if stop > end:
+        raise STAFUnmarshallError('specified length exceeds available data')
+
+    return (start, stop)
 
-        typ = data[0]
-        (obj, rest) = cls.read_clc_obj(data[1:])
+def read_scalar(data, pos, end):
+    '''
+    Read the body of a scalar object (following the '$' type indicator) at index
+    'pos'. Returns a tuple of the string or None, and the index just past the
+    end of the object.
+    '''
+    if pos >= end or data[pos] not in ('0', 'S'):
+        raise STAFUnmarshallError('bad format for scalar object')
+
+    typ = data[pos]
+    (start, stop) = read_clc(data, pos + 1, end)
+
+    if typ == '0':
+        if start != stop:
+            raise STAFUnmarshallError('bad format for none object')
+        return (None, stop)
+
+    else: # typ == 'S'
+        return (data[start:stop], stop)
+
+class ContainerUnmarshaller(object):
+    '''
+    Base class for container unmarshallers. An instance collects the items of
+    one container object. The constructor reads the container's header from
+    'data' at index 'pos' (just past the type indicator).
+
+    unmarshall_internal() reads each item starting at 'pos' using 'context',
+    without reading past 'stop', and passes it to add_item(). next_item() is
+    called to prepare for each item, and returns False once the container is
+    finished, at which point 'result' is the unmarshalled container and 'end' is
+    the index just past it.
+    '''
+    def __init__(self, data, context, interner=None):
+        self.data = data
+        self.context = context
+        # Used for map keys and strings read by the unmarshaller itself.
+        self.interner = interner
 
-        if typ == '0':
-            if obj != '':
-                raise STAFUnmarshallError('bad format for none object')
-            return (None, rest)
+    def add_item(self, obj, pos):
+        raise NotImplementedError()
+
+    def next_item(self):
+        raise NotImplementedError()
 
-        else: # typ == 'S'
-            # Possibly do recursive unmarshalling.
-            if mode == UNMARSHALL_RECURSIVE:
-                obj = unmarshall(obj, mode)
+class EmbeddedUnmarshaller(ContainerUnmarshaller):
+    '''
+    Unmarshaller for a string that may hold marshalled data, used with
+    UNMARSHALL_RECURSIVE. 'data' is the string and 'end' is the index following
+    the string in the data that contains it. The result is the string itself if
+    it doesn't hold exactly one marshalled object.
+    '''
+    def __init__(self, data, end):
+        super(EmbeddedUnmarshaller, self).__init__(data, {})
+        self.pos = 0
+        self.stop = len(data)
+        self.end = end
+        self.result = data
+        self.done = False
 
-            return (obj, rest)
+    def add_item(self, obj, pos):
+        if pos == self.stop:
+            self.result = obj
+        self.done = True
 
+    def next_item(self):
+        return not self.done
 
-class MapUnmarshaller(Unmarshaller):
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        (items, remainder) = cls.read_clc_obj(data)
+class MapUnmarshaller(ContainerUnmarshaller):
+    def __init__(self, data, pos, end, context, interner=None):
+        super(MapUnmarshaller, self).__init__(data, context, interner)
+        (self.pos, self.stop) = read_clc(data, pos, end)
+        self.end = self.stop
+        self.result = {}
+        self.key = None
 
-        result = {}
+    def add_item(self, obj, pos):
+        self.result[self.key] = obj
+        self.pos = pos
 
-        while items:
-            (key, items) = cls.read_clc_obj(items)
-            (val, items) = unmarshall_internal(items, mode, context)
+    def next_item(self):
+        if self.pos == self.stop:
+            return False
 
-            result[key] = val
+        (key_start, self.pos) = read_clc(self.data, self.pos, self.stop)
+        self.key = self.data[key_start:self.pos]
+        if self.interner is not None:
+            self.key = self.interner(self.key)
+        return True
 
-        return (result, remainder)
+class ListUnmarshaller(ContainerUnmarshaller):
+    count_matcher = re.compile(r'\d+')
 
-class ListUnmarshaller(Unmarshaller):
-    count_matcher = re.compile(r'''^
-        (?P<count>\d+)  # Number of elements
-        (?P<rest>.*)    # List items
-        $''', re.VERBOSE | re.DOTALL)
+    def __init__(self, data, pos, end, context, interner=None):
+        super(ListUnmarshaller, self).__init__(data, context, interner)
 
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        m = cls.count_matcher.match(data)
+        m = self.count_matcher.match(data, pos, end)
         if m is None:
             raise STAFUnmarshallError('bad format for list object')
 
-        (count, rest) = m.group('count', 'rest')
-        count = int(count)
+        self.count = int(m.group())
 
-        (items, remainder) = cls.read_clc_obj(rest)
+        (self.pos, self.stop) = read_clc(data, m.end(), end)
+        self.end = self.stop
 
-        result = []
-        for i in range(count):
-            (obj, items) = unmarshall_internal(items, mode, context)
-            result.append(obj)
+        # Every item takes up at least one character, so this can't succeed.
+        # Checking it up front avoids looping over a bogus count.
+        if self.count > self.stop - self.pos:
+            raise STAFUnmarshallError('list count exceeds available data')
 
-        if items != '':
+        self.result = []
+
+    def add_item(self, obj, pos):
+        self.result.append(obj)
+        self.pos = pos
+
+    def next_item(self):
+        if len(self.result) < self.count:
+            return True
+
+        if self.pos != self.stop:
             raise STAFUnmarshallError('unexpected trailing data')
 
-        return (result, remainder)
+        return False
 
-class MapClassUnmarshaller(Unmarshaller):
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        (content, remainder) = cls.read_clc_obj(data)
-        (class_name, values) = cls.read_clc_obj(content)
+class MapClassUnmarshaller(ContainerUnmarshaller):
+    def __init__(self, data, pos, end, context, interner=None):
+        super(MapClassUnmarshaller, self).__init__(data, context, interner)
+        (pos, self.stop) = read_clc(data, pos, end)
+        (name_start, self.pos) = read_clc(data, pos, self.stop)
+        self.end = self.stop
+        class_name = data[name_start:self.pos]
 
-        class_def = context.get(class_name)
-        if class_def is None:
-            raise STAFUnmarshallError('missing map class definition for %r' %
-                                      class_name)
+        self.plan = get_plan(context, class_name)
+        self.values = []
+        self.result = None
 
-        result = class_def.map_class()
-        # The ordering and names of the keys are given by class_def.keys.
-        for key in class_def.keys:
-            (value, values) = unmarshall_internal(values, mode, context)
-            result[key] = value
+    def add_item(self, obj, pos):
+        self.values.append(obj)
+        self.pos = pos
 
-        if values != '':
+    def next_item(self):
+        # Most values are plain strings, which the plan reads right away. Any
+        # others are read as items.
+        count = self.plan.count
+        if len(self.values) < count:
+            self.pos = self.plan.read_scalars(self.data, self.pos, self.stop,
+                                              self.values, self.interner)
+            if len(self.values) < count:
+                return True
+
+        if self.pos != self.stop:
             raise STAFUnmarshallError('unexpected trailing data')
 
-        return (result, remainder)
+        self.result = self.plan.map_class(self.values)
+        return False
+
+# {map class name : factory} for map classes registered with
+# register_map_class().
+map_class_factories = {}
+
+def register_map_class(name, factory):
+    '''
+    Unmarshall instances of the map class named 'name' by calling 'factory'
+    with a keyword argument for each key, instead of creating MapClass
+    objects. A 'factory' of None removes the registration. The cache of
+    unmarshalled results is cleared, since its results may have been made
+    with the old factory, and it isn't used while any factories are
+    registered.
+    '''
+    if factory is None:
+        map_class_factories.pop(name, None)
+    else:
+        map_class_factories[name] = factory
+
+    result_cache.clear()
+
+def get_plan(context, class_name):
+    '''
+    Returns the MapClassPlan for the map class named 'class_name' in 'context'.
+    '''
+    class_def = context.get(class_name)
+    if class_def is None:
+        raise STAFUnmarshallError('missing map class definition for %r' %
+                                  class_name)
+
+    if class_def._plan is None:
+        class_def._plan = MapClassPlan(class_def)
+    return class_def._plan
+
+class MapClassPlan(object):
+    '''
+    Reads instances of one map class. Every instance has its values in the
+    order given by the definition, so a plan only has to be made once for each
+    definition. It's kept in the definition's '_plan' attribute.
+    '''
+    scalar_marker = marker + '$'
 
-class ContextUnmarshaller(Unmarshaller):
-    @classmethod
-    def unmarshall(cls, data, mode, context):
-        (content, remainder) = cls.read_clc_obj(data)
-        (context_map, root_data) = unmarshall_internal(content, mode, context)
+    def __init__(self, class_def):
+        self.layout = class_def._get_layout()
+        self.count = len(self.layout.keys)
 
+        # Keyword argument names for registered factories. Unicode keyword
+        # names need Python 2.6.5 or later, so ASCII keys are made into str.
+        arg_names = []
+        for key in self.layout.keys:
+            try:
+                key = str(key)
+            except UnicodeError:
+                pass
+            arg_names.append(key)
+        self.arg_names = tuple(arg_names)
+
+    def read_scalars(self, data, pos, stop, values, interner=None):
+        '''
+        Read values starting at index 'pos' in 'data' and append them to
+        'values' until all the values have been read, or until one is found
+        that isn't a plain string or None. Strings are passed through
+        'interner', if given. Returns the index following the last value read.
+
+        Anything unusual, including marshalled strings and invalid data, is
+        left for the general unmarshalling code to deal with.
+        '''
+        count = self.count
+        scalar_marker = self.scalar_marker
+        type_index = len(scalar_marker)
+        match = clc_matcher.match
+
+        while (len(values) < count and
+               data.startswith(scalar_marker, pos, stop)):
+            typ = data[pos + type_index:pos + type_index + 1]
+            m = match(data, pos + type_index + 1, stop)
+            if m is None:
+                break
+
+            start = m.end()
+            end = start + int(m.group(1))
+            if end > stop:
+                break
+
+            if typ == 'S':
+                value = data[start:end]
+                if looks_marshalled(value):
+                    break
+                if interner is not None:
+                    value = interner(value)
+            elif typ == '0' and start == end:
+                value = None
+            else:
+                break
+
+            values.append(value)
+            pos = end
+
+        return pos
+
+    def map_class(self, values):
+        '''
+        Returns a MapClass with 'values' for its values, in key order, or the
+        result of the factory registered for the map class.
+        '''
+        factory = map_class_factories.get(self.layout.name)
+        if factory is not None:
+            return factory(**dict(zip(self.arg_names, values)))
+
+        return new_map_class(self.layout, values)
+
+class ContextUnmarshaller(ContainerUnmarshaller):
+    '''
+    A context has two items: the context map, which holds the map class
+    definitions, and the root object, which is the result. The context map is
+    read by the constructor, so the root object is the only item.
+    '''
+    def __init__(self, data, pos, end, context, interner=None):
+        super(ContextUnmarshaller, self).__init__(data, context, interner)
+        (pos, self.stop) = read_clc(data, pos, end)
+        (self.context, self.pos) = read_context_map(data, pos, self.stop,
+                                                    context)
+        self.end = self.stop
+        self.result = None
+        self.done = False
+
+    def add_item(self, obj, pos):
+        self.result = obj
+        self.pos = pos
+        self.done = True
+
+    def next_item(self):
+        if not self.done:
+            return True
+
+        if self.pos != self.stop:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        return False
+
+    @staticmethod
+    def build_context(context_map):
+        '''
+        Build a map of names to MapClassDefinitions from the unmarshalled
+        context map.
+        '''
         class_map = context_map.get('map-class-map', {})
 
-        # Build a map of names to MapClassDefinitions.
         new_context = {}
         for (name, info) in class_map.iteritems():
             class_def = MapClassDefinition(name)
@@ -248,9 +796,515 @@ class ContextUnmarshaller(Unmarshaller):
         # favor of new_context. Nested contexts probably shouldn't happen, but
         # if they do this means the objects in the inner context won't be able
         # to reference objects in the outer context. This is probably fine.
-        (root_obj, trailing) = unmarshall_internal(root_data, mode, new_context)
+        return new_context
+
+class Unmarshaller(object):
+    '''
+    Unmarshalls data that arrives in pieces, such as a large result read from a
+    file, pipe, or socket. Pass each piece to feed() as it arrives, then call
+    close() to get the unmarshalled object:
+
+        u = Unmarshaller()
+        for chunk in chunks:
+            for item in u.feed(chunk):
+                process(item)
+        result = u.close()
+
+    If the data is a list (possibly inside a marshalling context), feed()
+    returns the list items completed by the data passed to it, so they can be
+    processed before the rest of the data arrives. close() returns the complete
+    object in any case.
+
+    Data is treated the way unmarshall_force() treats it: STAFUnmarshallError
+    is raised as soon as the data is found to be invalid, and close() raises
+    it if the data is incomplete. Lengths in marshalled data are given in
+    characters, so the pieces must be decoded strings, not byte strings in a
+    multi-byte encoding.
+    '''
+
+    # Anything that a complete header could start with.
+    partial_header_matcher = re.compile(r'''
+        @(?:S(?:D(?:T(?:/(?:
+            \$(?:[0S](?::\d*)?)? |
+            [{%*](?::\d*)? |
+            \[(?:\d+(?::\d*)?)?
+        )?)?)?)?)?\Z''', re.VERBOSE)
+
+    def __init__(self, mode=UNMARSHALL_RECURSIVE, interner=None):
+        '''
+        Create an Unmarshaller. 'mode' and 'interner' have the same meaning as
+        for unmarshall().
+        '''
+        self.mode = mode
+        self.interner = get_interner(interner)
+
+        # Data is collected in _pending and only joined onto the unread part of
+        # _buffer once there is enough of it to make progress.
+        self._buffer = ''
+        self._pos = 0
+        self._pending = []
+        self._pending_size = 0
+        self._need = 1
+        # Index in the full data of _buffer[0].
+        self._offset = 0
+
+        self._context = {}
+        self._context_stop = None
+        self._stop = None
+        self._count = None
+        self._items = None
+
+        self._state = self._read_top
+        self._result = None
+        self._done = False
+        self._closed = False
+
+    def feed(self, data):
+        '''
+        Add the next piece of marshalled data. Returns a list of the top-level
+        list items that were completed by 'data'.
+        '''
+        if self._closed:
+            raise ValueError('feed() called after close()')
+
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+        completed = []
+        if self.mode in no_unmarshall_modes:
+            return completed
+
+        while self._available() >= self._need:
+            self._fill()
+            if not self._state(completed):
+                break
+            # Some steps (like finishing an empty list) need no more data.
+            self._need = 0
+
+        return completed
+
+    def close(self):
+        '''
+        Finish unmarshalling and return the unmarshalled object.
+        '''
+        self._closed = True
+
+        if self.mode in no_unmarshall_modes:
+            self._fill()
+            return self._buffer
+
+        if not self._done:
+            raise STAFUnmarshallError('incomplete marshalled data')
+
+        return self._result
+
+    def _available(self):
+        return len(self._buffer) - self._pos + self._pending_size
+
+    def _fill(self):
+        if self._pending:
+            self._offset += self._pos
+            self._pending.insert(0, self._buffer[self._pos:])
+            self._buffer = ''.join(self._pending)
+            self._pos = 0
+            self._pending = []
+            self._pending_size = 0
+
+    def _wait_for(self, stop):
+        '''
+        Returns True if the data up to index 'stop' (in the full data) is
+        available. Otherwise arranges to wait for it and returns False.
+        '''
+        self._need = stop - self._offset - self._pos
+        return self._available() >= self._need
+
+    def _read_header(self, limit):
+        '''
+        Read the header of the next object, which must not extend past index
+        'limit' in the full data (if 'limit' isn't None). Returns a tuple of
+        the type indicator (including the list count, if any), the list count
+        or None, the index in the full data just past the object, and the index
+        in _buffer just past the header. Returns None if more data is needed.
+        '''
+        buf = self._buffer
+        m = header_matcher.match(buf, self._pos)
+        if m is None:
+            if (self._pos < len(buf) and
+                    self.partial_header_matcher.match(buf, self._pos) is None):
+                raise STAFUnmarshallError('bad format for marshalled data')
+
+            self._need = self._available() + 1
+            return None
+
+        (typ, count, length) = m.groups()
+        stop = self._offset + m.end() + int(length)
+        if limit is not None and stop > limit:
+            raise STAFUnmarshallError('specified length exceeds available data')
+
+        if count is not None:
+            count = int(count)
+
+        return (typ, count, stop, m.end())
+
+    def _read_object(self, stop, mode=None):
+        '''
+        Unmarshall the whole object starting at the current position and ending
+        at index 'stop' in the full data. 'mode' overrides self.mode.
+        '''
+        if mode is None:
+            mode = self.mode
+
+        end = stop - self._offset
+        if mode == UNMARSHALL_LAZY:
+            from ._lazy import unmarshall_lazy
+            (obj, pos) = unmarshall_lazy(self._buffer, self._pos, end,
+                                         self._context)
+        else:
+            (obj, pos) = unmarshall_internal(self._buffer, self._pos, end,
+                                             mode, self._context,
+                                             self.interner)
+        self._pos = pos
+        return obj
+
+    def _start_root(self, limit):
+        header = self._read_header(limit)
+        if header is None:
+            return False
+
+        (typ, count, stop, header_end) = header
+        if count is not None:
+            # A list. Its items are read one at a time.
+            self._pos = header_end
+            self._count = count
+            self._stop = stop
+            self._items = []
+            self._state = self._read_item
+        else:
+            self._stop = stop
+            self._state = self._read_root
+
+        return True
+
+    def _read_top(self, completed):
+        header = self._read_header(None)
+        if header is None:
+            return False
+
+        (typ, count, stop, header_end) = header
+        if typ == '*':
+            # The context map comes first, then the root object.
+            self._pos = header_end
+            self._context_stop = stop
+            self._state = self._read_context_map
+            return True
+
+        return self._start_root(None)
+
+    def _read_context_map(self, completed):
+        header = self._read_header(self._context_stop)
+        if header is None or not self._wait_for(header[2]):
+            return False
 
-        if trailing != '':
+        (self._context, self._pos) = read_context_map(
+                self._buffer, self._pos, header[2] - self._offset,
+                self._context)
+        self._state = self._start_context_root
+        return True
+
+    def _start_context_root(self, completed):
+        return self._start_root(self._context_stop)
+
+    def _read_root(self, completed):
+        if not self._wait_for(self._stop):
+            return False
+
+        self._result = self._read_object(self._stop)
+        self._finish()
+        return True
+
+    def _read_item(self, completed):
+        if len(self._items) == self._count:
+            if self._offset + self._pos != self._stop:
+                raise STAFUnmarshallError('unexpected trailing data')
+
+            self._result = self._items
+            self._finish()
+            return True
+
+        header = self._read_header(self._stop)
+        if header is None or not self._wait_for(header[2]):
+            return False
+
+        item = self._read_object(header[2])
+        self._items.append(item)
+        completed.append(item)
+        return True
+
+    def _finish(self):
+        if (self._context_stop is not None and
+                self._offset + self._pos != self._context_stop):
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        self._done = True
+        self._state = self._read_trailing
+
+    def _read_trailing(self, completed):
+        if self._available() > 0:
             raise STAFUnmarshallError('unexpected trailing data')
 
-        return (root_obj, remainder)
+        return False
+
+def marshall(obj):
+    '''
+    Marshall 'obj' into a STAF marshalled data string. 'obj' can be None, a
+    string, a list or tuple, a dict, a MapClass, or any combination of these.
+    Other objects are marshalled as strings using str(). Lazily unmarshalled
+    objects are marshalled like the types they stand in for.
+
+    If 'obj' contains MapClass instances, the result is a marshalling context
+    with a definition for each map class. Raises ValueError if map classes
+    with the same name have different definitions.
+    '''
+    class_defs = {}
+    (parts, size) = marshall_parts(obj, class_defs)
+    if not class_defs:
+        return ''.join(parts)
+
+    (context_parts, context_size) = marshall_parts(context_map(class_defs), {})
+    header = '%s*:%d:' % (marker, context_size + size)
+    return ''.join([header] + context_parts + parts)
+
+def iter_marshall(obj, chunk_size=65536):
+    '''
+    Generator that marshalls 'obj' like marshall() does, yielding the
+    marshalled data in chunks of about 'chunk_size' characters (or more, if
+    'obj' contains longer strings). The whole marshalled string is never held
+    in memory.
+
+    'obj' is gone through twice, once to find the lengths of the containers
+    and once to produce the data, so it must not be modified until the
+    generator is finished.
+    '''
+    class_defs = {}
+    (sizes, size) = marshall_parts(obj, class_defs, sizes_only=True)
+
+    chunk = []
+    chunk_len = 0
+    if class_defs:
+        context = marshall(context_map(class_defs))
+        chunk = ['%s*:%d:' % (marker, len(context) + size), context]
+        chunk_len = len(chunk[0]) + len(context)
+
+    sizes = iter(sizes)
+    # (item iterator, whether the items are key-value pairs) for each
+    # container being marshalled.
+    stack = []
+
+    while True:
+        (header, first, items, has_keys) = marshall_object(obj, class_defs)
+        if items is not None:
+            header = '%s:%d:' % (header, sizes.next())
+            stack.append((items, has_keys))
+
+        chunk.extend((header, first))
+        chunk_len += len(header) + len(first)
+
+        # Move on to the next item of the innermost unfinished container.
+        while stack:
+            (items, has_keys) = stack[-1]
+            try:
+                item = items.next()
+            except StopIteration:
+                stack.pop()
+                continue
+
+            if has_keys:
+                (key, obj) = item
+                key = key_clc(key)
+                chunk.append(key)
+                chunk_len += len(key)
+            else:
+                obj = item
+
+            break
+
+        else:
+            break
+
+        if chunk_len >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_len = 0
+
+    yield ''.join(chunk)
+
+def marshall_to(obj, fileobj, chunk_size=65536):
+    '''
+    Marshall 'obj' like marshall() does, writing the marshalled data to the
+    file-like object 'fileobj' a piece at a time. See iter_marshall().
+    '''
+    for chunk in iter_marshall(obj, chunk_size):
+        fileobj.write(chunk)
+
+# Marshalled data is built up as a list of strings that is joined once at the
+# end. The header of a container can't be written until the length of its
+# contents is known, so a placeholder is put in the list and filled in once the
+# container is finished. The total size so far is tracked as the parts are
+# added, so the length of a container is the growth in the size since its
+# placeholder was added.
+#
+# Like unmarshalling, this uses an explicit stack rather than recursion.
+
+none_data = marker + '$0:0:'
+
+def marshall_parts(obj, class_defs, sizes_only=False):
+    '''
+    Marshall 'obj' into a list of strings. Definitions for the map classes in
+    'obj' are added to 'class_defs', a map of names to MapClassDefinitions.
+    Returns a tuple of the list and its total length.
+
+    If 'sizes_only' is True, the list instead holds just the length of the
+    contents of each container, in the order that the containers start.
+    '''
+    parts = []
+    size = 0
+    # One entry for each container being marshalled: an iterator over the
+    # remaining items, the index of the header placeholder in 'parts', the size
+    # before the container's contents, the start of the header, and whether the
+    # items are key-value pairs.
+    stack = []
+
+    while True:
+        (header, first, items, has_keys) = marshall_object(obj, class_defs)
+        if items is None:
+            if not sizes_only:
+                parts.extend((header, first))
+            size += len(header) + len(first)
+        else:
+            stack.append((items, len(parts), size, header, has_keys))
+            if sizes_only:
+                parts.append(None)
+            else:
+                parts.extend((None, first))
+            size += len(first)
+
+        # Finish containers until one is found with another item.
+        while stack:
+            (items, index, start, header_start, has_keys) = stack[-1]
+            try:
+                item = items.next()
+            except StopIteration:
+                stack.pop()
+                header = '%s:%d:' % (header_start, size - start)
+                if sizes_only:
+                    parts[index] = size - start
+                else:
+                    parts[index] = header
+                size += len(header)
+                continue
+
+            if has_keys:
+                (key, obj) = item
+                key = key_clc(key)
+                if not sizes_only:
+                    parts.append(key)
+                size += len(key)
+            else:
+                obj = item
+
+            break
+
+        else:
+            return (parts, size)
+
+def marshall_object(obj, class_defs):
+    '''
+    Get the pieces needed to marshall 'obj'. Returns a tuple of the header, the
+    first part of the contents, an iterator over the items, and whether the
+    items are key-value pairs. For a container, the header is missing the
+    colon-length-colon and is followed by the items. For other objects the
+    header is complete, the contents are the string, and the iterator is None.
+    '''
+    if obj is None:
+        return (none_data, '', None, False)
+
+    elif isinstance(obj, (MapClass, LazyMapClass)):
+        add_definition(obj, class_defs)
+        name = obj.class_name
+        return (marker + '%', ':%d:%s' % (len(name), name), obj.itervalues(),
+                False)
+
+    elif isinstance(obj, (dict, LazyMap)):
+        return (marker + '{', '', obj.iteritems(), True)
+
+    elif isinstance(obj, (list, tuple, LazyList)):
+        return ('%s[%d' % (marker, len(obj)), '', iter(obj), False)
+
+    else:
+        if not isinstance(obj, basestring):
+            obj = str(obj)
+
+        return ('%s$S:%d:' % (marker, len(obj)), obj, None, False)
+
+def key_clc(key):
+    '''
+    Returns the colon-length-colon form of a map key.
+    '''
+    if not isinstance(key, basestring):
+        key = str(key)
+
+    return ':%d:%s' % (len(key), key)
+
+def add_definition(obj, class_defs):
+    '''
+    Add the definition for map class 'obj' to 'class_defs', or check that it
+    matches the one already there.
+    '''
+    name = obj.class_name
+    layout = getattr(obj, '_layout', None)
+    class_def = class_defs.get(name)
+    if class_def is None:
+        class_def = class_defs[name] = obj.definition()
+        # Instances sharing this layout can be recognized without checking.
+        class_def._layout = layout
+        return
+
+    if layout is not None and layout is class_def._layout:
+        return
+
+    keys = class_def.keys
+    if obj.keys() != keys:
+        raise ValueError('conflicting definitions for map class %r' % name)
+
+    for key in keys:
+        if (obj.display_name(key) != class_def.display_name(key) or
+                obj.display_short_name(key) !=
+                class_def.display_short_name(key)):
+            raise ValueError('conflicting definitions for map class %r' % name)
+
+def context_map(class_defs):
+    '''
+    Build the context map for a marshalling context holding the map class
+    definitions in 'class_defs'. This is the reverse of
+    ContextUnmarshaller.build_context().
+    '''
+    class_map = {}
+    for (name, class_def) in class_defs.iteritems():
+        keys = []
+        for key in class_def.keys:
+            item = {
+                'key': key,
+                'display-name': class_def.display_name(key),
+            }
+            short_name = class_def.display_short_name(key)
+            if short_name is not None:
+                item['display-short-name'] = short_name
+
+            keys.append(item)
+
+        class_map[name] = {'name': name, 'keys': keys}
+
+    return {'map-class-map': class_map}
+
+# Imported last because _lazy imports from this module.
+from ._lazy import LazyList, LazyMap, LazyMapClass
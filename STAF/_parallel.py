@@ -0,0 +1,180 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Unmarshalling large lists using a pool of processes.
+'''
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from ._marshall import (
+    unmarshall,
+    unmarshall_internal,
+    looks_marshalled,
+    read_type,
+    read_clc,
+    skip_object,
+    read_context_map,
+    without_gc,
+    STAFUnmarshallError,
+    UNMARSHALL_RECURSIVE,
+    UNMARSHALL_NONE,
+    UNMARSHALL_RAW,
+    UNMARSHALL_LAZY,
+    ListUnmarshaller,
+    ContextUnmarshaller,
+)
+
+# The number of chunks given to each process. More chunks keep the processes
+# busy when some items take longer than others.
+chunks_per_process = 4
+
+def unmarshall_parallel(data, mode=UNMARSHALL_RECURSIVE, processes=None,
+                        threshold=16*1024*1024, pool=None):
+    '''
+    Same as unmarshall, but when 'data' is a list (possibly in a marshalling
+    context) of at least 'threshold' characters, the items are unmarshalled
+    in a pool of processes. The data is split into chunks of whole items
+    using only the lengths in the data, each chunk is unmarshalled by a
+    process along with the context's map class definitions, and the items are
+    put back together in order.
+
+    'processes' gives the number of processes to start, and defaults to the
+    number of CPUs. Alternatively, 'pool' can be an existing
+    multiprocessing.Pool (or anything else with a compatible map() method,
+    like a concurrent.futures.ProcessPoolExecutor) to use instead of starting
+    new processes for each call.
+
+    Smaller data, data that isn't a list, and UNMARSHALL_LAZY are handled by
+    unmarshall() in the current process. Results are copied between
+    processes, so this only pays off for large results.
+
+    The cyclic garbage collector is disabled while the chunks are loaded. This
+    affects the whole process, so other threads don't get cyclic collections
+    until it's done.
+    '''
+    if (mode in (UNMARSHALL_NONE, UNMARSHALL_RAW, UNMARSHALL_LAZY) or
+            len(data) < threshold or not looks_marshalled(data)):
+        return unmarshall(data, mode)
+
+    import multiprocessing
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    try:
+        split = split_list(data, processes * chunks_per_process)
+    except STAFUnmarshallError:
+        return data
+
+    if split is None:
+        return unmarshall(data, mode)
+
+    (context_data, chunks) = split
+    tasks = [(context_data, chunk, count, mode) for (chunk, count) in chunks]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+
+    # Chunks are loaded as they arrive, while the rest are still being
+    # unmarshalled.
+    pool_map = getattr(pool, 'imap', None) or pool.map
+    items = []
+    try:
+        try:
+            for result in pool_map(unmarshall_chunk, tasks):
+                items.extend(without_gc(pickle.loads, result))
+        except STAFUnmarshallError:
+            return data
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    return items
+
+def split_list(data, pieces):
+    '''
+    Split the items of the list in 'data' into about 'pieces' chunks of
+    similar size. Returns a tuple of the context map data (or None if there's
+    no context) and a list of (chunk data, item count) tuples, or None if
+    'data' isn't a list.
+    '''
+    end = len(data)
+    context_data = None
+
+    (unmarshaller, pos) = read_type(data, 0, end)
+    if unmarshaller is ContextUnmarshaller:
+        (pos, stop) = read_clc(data, pos, end)
+        if stop != end:
+            raise STAFUnmarshallError('unexpected trailing data')
+
+        context_start = pos
+        pos = skip_object(data, pos, end)
+        context_data = data[context_start:pos]
+        (unmarshaller, pos) = read_type(data, pos, end)
+
+    if unmarshaller is not ListUnmarshaller:
+        return None
+
+    m = ListUnmarshaller.count_matcher.match(data, pos, end)
+    if m is None:
+        raise STAFUnmarshallError('bad format for list object')
+
+    count = int(m.group())
+    (pos, stop) = read_clc(data, m.end(), end)
+    if stop != end:
+        raise STAFUnmarshallError('unexpected trailing data')
+    if count > stop - pos:
+        raise STAFUnmarshallError('list count exceeds available data')
+
+    chunk_size = max((stop - pos) // pieces, 1)
+    chunks = []
+    chunk_start = pos
+    chunk_count = 0
+    for i in xrange(count):
+        pos = skip_object(data, pos, stop)
+        chunk_count += 1
+        if pos - chunk_start >= chunk_size:
+            chunks.append((data[chunk_start:pos], chunk_count))
+            chunk_start = pos
+            chunk_count = 0
+
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    if chunk_count:
+        chunks.append((data[chunk_start:pos], chunk_count))
+
+    return (context_data, chunks)
+
+def unmarshall_chunk(task):
+    '''
+    Unmarshall a chunk of list items in a pool process. Returns the pickled
+    list of items, which is faster than letting the pool pickle it.
+    '''
+    return without_gc(unmarshall_chunk_items, *task)
+
+def unmarshall_chunk_items(context_data, data, count, mode):
+    context = {}
+    if context_data is not None:
+        # Definitions are cached, so each process only builds them once.
+        (context, pos) = read_context_map(context_data, 0, len(context_data),
+                                          context)
+
+    end = len(data)
+    pos = 0
+    items = []
+    for i in xrange(count):
+        (item, pos) = unmarshall_internal(data, pos, end, mode, context)
+        items.append(item)
+
+    if pos != end:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    return pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
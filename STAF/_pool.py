@@ -0,0 +1,198 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+A pool of registered STAF handles shared between threads.
+'''
+
+from __future__ import with_statement
+
+import threading
+from contextlib import contextmanager
+
+from ._staf import Handle, REQ_SYNC
+from ._errors import errors, STAFResultError
+from ._marshall import UNMARSHALL_RECURSIVE, UNMARSHALL_NONE
+
+class HandlePool(object):
+    '''
+    A thread-safe pool of STAF handles, all registered with the same name.
+    Threads check handles out with acquire() or handle() and give them back
+    when they're done, so handles are registered once rather than for each
+    task. Use as a context manager to automatically close the pool.
+    '''
+
+    def __init__(self, name, size=8, preregister=0):
+        '''
+        Create a HandlePool. Handles are registered with 'name' as they're
+        needed, up to 'size' handles. 'preregister' handles are registered
+        right away.
+        '''
+        self.name = name
+        self.size = size
+
+        self._cond = threading.Condition()
+        self._idle = []
+        # Handles that are idle, in use, or being registered.
+        self._count = 0
+        self._closed = False
+
+        try:
+            for i in xrange(min(preregister, size)):
+                self._idle.append(Handle(name))
+                self._count += 1
+        except:
+            self.close()
+            raise
+
+    def acquire(self, new=False):
+        '''
+        Check out a handle, waiting for one to be released if 'size' handles
+        are already in use. With 'new' set to True, a newly registered handle
+        is returned rather than an idle one. The handle must be given back
+        with release(). Raises ValueError if the pool is closed.
+        '''
+        replaced = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ValueError('handle pool is closed')
+                if self._idle and not new:
+                    return self._idle.pop()
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                if new and self._idle:
+                    # The new handle takes the place of an idle one.
+                    replaced = self._idle.pop()
+                    break
+                self._cond.wait()
+
+        # STAF calls are made outside of the lock so other threads aren't held
+        # up.
+        try:
+            if replaced is not None:
+                replaced.unregister()
+            return Handle(self.name)
+        except:
+            self._discard()
+            raise
+
+    def release(self, handle):
+        '''
+        Give back a handle checked out with acquire(). Handles that have been
+        unregistered are dropped from the pool.
+        '''
+        with self._cond:
+            keep = handle.is_registered() and not self._closed
+            if keep:
+                self._idle.append(handle)
+                self._cond.notify()
+
+        if not keep:
+            self._discard()
+            handle.unregister()
+
+    def _discard(self):
+        '''
+        Forget a handle that was checked out, making room for another.
+        '''
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def _lost(self, handle, exc):
+        '''
+        Returns True if 'exc' shows that 'handle' no longer exists. The error
+        HandleDoesNotExist could be about some other handle named in the
+        request, like for a HANDLE QUERY request, so the handle is checked
+        with a MISC WHOAMI request.
+        '''
+        if exc.rc != errors.HandleDoesNotExist:
+            return False
+
+        try:
+            handle.submit('local', 'misc', 'whoami', REQ_SYNC, UNMARSHALL_NONE)
+        except STAFResultError, check_exc:
+            return check_exc.rc == errors.HandleDoesNotExist
+
+        return False
+
+    @contextmanager
+    def handle(self, new=False):
+        '''
+        Context manager that checks out a handle and gives it back at the end
+        of the block. If the block raises STAFResultError with
+        HandleDoesNotExist and the handle no longer exists, the handle is
+        dropped from the pool.
+        '''
+        handle = self.acquire(new)
+        lost = False
+        try:
+            try:
+                yield handle
+            except STAFResultError, exc:
+                lost = self._lost(handle, exc)
+                raise
+        finally:
+            if lost:
+                self._discard()
+                # Marks the handle as unregistered.
+                handle.unregister()
+            else:
+                self.release(handle)
+
+    def submit(self, where, service, request, sync_option=REQ_SYNC,
+               unmarshall=UNMARSHALL_RECURSIVE, interner=None):
+        '''
+        Same as Handle.submit(), using a handle from the pool. If the handle
+        no longer exists (for example, because STAFProc was restarted), the
+        request is tried again with a newly registered handle.
+        '''
+        handle = None
+        try:
+            with self.handle() as handle:
+                return handle.submit(where, service, request, sync_option,
+                                     unmarshall, interner)
+        except STAFResultError:
+            # handle() only unregisters the handle if it no longer exists.
+            if handle is None or handle.is_registered():
+                raise
+
+        with self.handle(new=True) as handle:
+            return handle.submit(where, service, request, sync_option,
+                                 unmarshall, interner)
+
+    def close(self):
+        '''
+        Unregister the idle handles and close the pool. Handles that are
+        checked out are unregistered when they're released.
+        '''
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._count -= len(idle)
+            self._cond.notifyAll()
+
+        for handle in idle:
+            handle.unregister()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+        # Don't suppress an exception
+        return False
+
+    def __repr__(self):
+        if self._closed:
+            closed = ' (closed)'
+        else:
+            closed = ''
+
+        return '<STAF HandlePool %r, %d of %d handles%s>' % (
+                self.name, self._count, self.size, closed)
@@ -0,0 +1,100 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Read-only versions of unmarshalled objects, used for results that are shared
+through the result cache.
+'''
+
+from ._mapclass import MapClass, new_map_class
+
+def not_supported(name):
+    '''
+    Create a method that raises NotImplementedError.
+    '''
+    def method(self, *args, **kwargs):
+        raise NotImplementedError('%s is not supported in %s' %
+                                  (name, self.__class__.__name__))
+
+    method.__name__ = name
+    method.__doc__ = 'Not supported, raises NotImplementedError.'
+    return method
+
+dict_methods = ['__setitem__', '__delitem__', 'clear', 'pop', 'popitem',
+                'setdefault', 'update']
+
+list_methods = ['__setitem__', '__delitem__', '__setslice__', '__delslice__',
+                '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+                'remove', 'reverse', 'sort']
+
+class ReadOnlyList(list):
+    '''
+    A list that can't be modified. Use list(obj) to get a modifiable copy.
+    '''
+
+    def __reduce__(self):
+        return (ReadOnlyList, (list(self),))
+
+class ReadOnlyDict(dict):
+    '''
+    A dict that can't be modified. copy() returns a modifiable dict.
+    '''
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+class ReadOnlyMapClass(MapClass):
+    '''
+    A MapClass that can't be modified. copy() returns a modifiable MapClass.
+    '''
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (new_map_class, (self._layout, self.values(), ReadOnlyMapClass))
+
+for name in list_methods:
+    setattr(ReadOnlyList, name, not_supported(name))
+for name in dict_methods:
+    setattr(ReadOnlyDict, name, not_supported(name))
+    setattr(ReadOnlyMapClass, name, not_supported(name))
+del name
+
+def read_only(obj):
+    '''
+    Returns a read-only copy of the unmarshalled object 'obj'. Lists, dicts,
+    and MapClasses are copied. Other objects, like strings and the objects
+    created by UNMARSHALL_LAZY, are already read-only and are shared.
+    '''
+    # Containers in the order they're found. Each one comes after the one
+    # holding it, so copying them in reverse order copies the items first.
+    # This avoids recursion, which deeply nested data could overflow.
+    containers = []
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            containers.append(item)
+            stack.extend(item.itervalues())
+        elif isinstance(item, list):
+            containers.append(item)
+            stack.extend(item)
+
+    # {id(container) : copy}
+    copies = {}
+    for container in reversed(containers):
+        if isinstance(container, MapClass):
+            values = [copies.get(id(value), value)
+                      for value in container.itervalues()]
+            copy = new_map_class(container._layout, values, ReadOnlyMapClass)
+        elif isinstance(container, dict):
+            copy = ReadOnlyDict((key, copies.get(id(value), value))
+                                for (key, value) in container.iteritems())
+        else:
+            copy = ReadOnlyList(copies.get(id(item), item)
+                                for item in container)
+
+        copies[id(container)] = copy
+
+    return copies.get(id(obj), obj)
@@ -0,0 +1,251 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Asynchronous requests using REQ_QUEUE, with futures for the results.
+'''
+
+from __future__ import with_statement
+
+import threading
+import time
+
+from ._staf import Handle, REQ_SYNC, REQ_QUEUE
+from ._errors import errors, strerror, STAFResultError
+from ._marshall import (
+    unmarshall as f_unmarshall,
+    UNMARSHALL_RECURSIVE,
+    UNMARSHALL_NON_RECURSIVE,
+    UNMARSHALL_NONE,
+    UNMARSHALL_RAW,
+)
+
+class RequestManager(object):
+    '''
+    Submits requests with REQ_QUEUE and returns futures for their results. A
+    single background thread reads the STAF/RequestComplete messages from the
+    handle's queue in batches and completes the futures, so any number of
+    requests can be outstanding without a thread for each one. Use as a
+    context manager to automatically close the manager.
+    '''
+
+    def __init__(self, name, batch_size=1000, poll_interval=1.0):
+        '''
+        Create a RequestManager with a new Handle registered with 'name'
+        (available as the 'handle' attribute). The reader gets up to
+        'batch_size' messages at a time, waiting up to 'poll_interval' seconds
+        for them. This requires concurrent.futures, which is in the 'futures'
+        package for Python 2.
+        '''
+        from concurrent.futures import Future
+
+        self._future_class = Future
+        self._queue_request = ('get type STAF/RequestComplete first %d '
+                               'wait %d' % (batch_size,
+                                            int(poll_interval * 1000)))
+
+        self._cond = threading.Condition()
+        # {request number : (future, unmarshall, interner)}
+        self._pending = {}
+        # {request number : (time read, message)} for requests that complete
+        # before submit() has recorded them. Messages for requests submitted
+        # some other way with the same handle are never claimed, so they're
+        # dropped after '_early_expiry' seconds.
+        self._early = {}
+        self._early_expiry = max(10 * poll_interval, 10.0)
+        # Number of calls to submit() in progress.
+        self._submitting = 0
+        self._closed = False
+        self._stopping = False
+        # The exception that stopped the reader.
+        self._error = None
+
+        self.handle = Handle(name)
+        self._reader = threading.Thread(target=self._read_queue)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def submit(self, where, service, request, unmarshall=UNMARSHALL_RECURSIVE,
+               interner=None):
+        '''
+        Submit a request with REQ_QUEUE and return a
+        concurrent.futures.Future for its result. 'unmarshall' and 'interner'
+        are used for the result when it arrives. With UNMARSHALL_RAW, the
+        result is a UTF-8 encoded str, as from Handle.submit(). A request that
+        fails sets STAFResultError on the future, but errors submitting the
+        request are raised right away. Cancelling the future doesn't stop the
+        request.
+        '''
+        with self._cond:
+            if self._closed:
+                raise ValueError('request manager is closed')
+            if self._error is not None:
+                raise self._error
+            self._submitting += 1
+
+        try:
+            number = self.handle.submit(where, service, request, REQ_QUEUE,
+                                        UNMARSHALL_NONE)
+
+            future = self._future_class()
+            with self._cond:
+                (read_time, message) = self._early.pop(number, (None, None))
+                if message is None:
+                    if self._error is not None:
+                        complete_future(future, self._error)
+                    else:
+                        self._pending[number] = (future, unmarshall,
+                                                 interner)
+        finally:
+            with self._cond:
+                self._submitting -= 1
+                self._cond.notifyAll()
+
+        if message is not None:
+            complete_future(future, message, unmarshall, interner)
+
+        return future
+
+    def _read_queue(self):
+        '''
+        Complete futures from the RequestComplete messages in the queue until
+        the manager is closed.
+        '''
+        while not self._stopping:
+            try:
+                with self._cond:
+                    self._expire_early(time.time())
+
+                try:
+                    entries = self.handle.submit('local', 'queue',
+                                                 self._queue_request, REQ_SYNC,
+                                                 UNMARSHALL_NON_RECURSIVE)
+                except STAFResultError, exc:
+                    if exc.rc in (errors.Timeout, errors.NoQueueElement):
+                        continue
+                    raise
+
+                completed = []
+                now = time.time()
+                with self._cond:
+                    for entry in entries:
+                        message = entry['message']
+                        if isinstance(message, basestring):
+                            message = f_unmarshall(message,
+                                                   UNMARSHALL_NON_RECURSIVE)
+
+                        number = message['requestNumber']
+                        info = self._pending.pop(number, None)
+                        if info is None:
+                            self._early[number] = (now, message)
+                        else:
+                            completed.append((info, message))
+
+                    self._cond.notifyAll()
+
+                for ((future, unmarshall, interner), message) in completed:
+                    complete_future(future, message, unmarshall, interner)
+
+            except Exception, exc:
+                self._fail(exc)
+                return
+
+    def _expire_early(self, now):
+        '''
+        Drop the early messages that have gone unclaimed for too long. Must be
+        called with the lock held.
+        '''
+        cutoff = now - self._early_expiry
+        for (number, (read_time, message)) in self._early.items():
+            if read_time < cutoff:
+                del self._early[number]
+
+    def _fail(self, exc):
+        '''
+        Set 'exc' on all outstanding futures and on ones submitted later.
+        '''
+        with self._cond:
+            self._error = exc
+            pending = self._pending
+            self._pending = {}
+            self._cond.notifyAll()
+
+        for (future, unmarshall, interner) in pending.itervalues():
+            complete_future(future, exc)
+
+    def outstanding(self):
+        '''
+        Returns the number of requests that haven't completed yet.
+        '''
+        with self._cond:
+            return len(self._pending)
+
+    def close(self, wait=True):
+        '''
+        Stop accepting requests, stop the reader, and unregister the handle.
+        If 'wait' is True, waits for the outstanding requests to complete
+        first. Otherwise their futures are cancelled.
+        '''
+        with self._cond:
+            self._closed = True
+            if wait:
+                while self._pending or self._submitting:
+                    self._cond.wait()
+
+            self._stopping = True
+            pending = self._pending
+            self._pending = {}
+
+        for (future, unmarshall, interner) in pending.itervalues():
+            future.cancel()
+
+        self._reader.join()
+        self.handle.unregister()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+        # Don't suppress an exception
+        return False
+
+    def __repr__(self):
+        return '<STAF RequestManager %d, %d outstanding>' % (
+                self.handle.handle_num(), self.outstanding())
+
+def complete_future(future, message, unmarshall=UNMARSHALL_RECURSIVE,
+                    interner=None):
+    '''
+    Set the result or exception for 'future' from a RequestComplete
+    'message', or set 'message' as the exception if it's an exception.
+    Futures that were cancelled are left alone.
+    '''
+    if not future.set_running_or_notify_cancel():
+        return
+
+    if isinstance(message, Exception):
+        future.set_exception(message)
+        return
+
+    rc = int(message['rc'])
+    result = message['result']
+    if rc != 0:
+        future.set_exception(STAFResultError(rc, strerror(rc), result or None))
+        return
+
+    try:
+        if result is not None:
+            if unmarshall == UNMARSHALL_RAW:
+                # The message has already been decoded, so this doesn't save a
+                # copy like Handle.submit() does, but the result is the same
+                # UTF-8 encoded str.
+                result = result.encode('utf-8')
+            else:
+                result = f_unmarshall(result, unmarshall, interner)
+    except Exception, exc:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
@@ -0,0 +1,339 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Selecting parts of marshalled data without unmarshalling the rest.
+'''
+
+import re
+
+from ._marshall import (
+    unmarshall_internal,
+    read_type,
+    read_clc,
+    read_scalar,
+    skip_object,
+    read_context_map,
+    looks_marshalled,
+    STAFUnmarshallError,
+    UNMARSHALL_RECURSIVE,
+    UNMARSHALL_NON_RECURSIVE,
+    UNMARSHALL_LAZY,
+    no_unmarshall_modes,
+    ListUnmarshaller,
+    MapUnmarshaller,
+    MapClassUnmarshaller,
+    ContextUnmarshaller,
+)
+
+def unmarshall_select(data, paths, mode=UNMARSHALL_RECURSIVE):
+    '''
+    Unmarshall only the parts of the marshalled data in 'data' given by
+    'paths'. 'paths' can be a single path, in which case the selected value is
+    returned, or a sequence of paths, in which case a list of the selected
+    values is returned.
+
+    A path is a sequence of steps, applied in order starting from the
+    unmarshalled object:
+
+        .key    Selects the item 'key' from a map or map class. The dot may be
+                left off of the first step.
+        [n]     Selects item n of a list. n may be negative.
+        [*]     Selects every item of a list. The result is a list of the
+                values selected by the rest of the path for each item.
+
+    For example, '[*].name' selects the 'name' item of every map in a list, and
+    'fileList[0].data' selects the 'data' item from the first item of the
+    'fileList' list in a map. An empty path selects the whole object.
+
+    'mode' gives the unmarshalling mode for the selected values, and is
+    UNMARSHALL_RECURSIVE by default. Except with UNMARSHALL_NON_RECURSIVE,
+    paths can also step into marshalled strings.
+
+    Parts of the data that aren't selected are skipped using the lengths in
+    the data, so only their headers are checked. Raises STAFUnmarshallError
+    for invalid data, and KeyError, IndexError, or TypeError if a path doesn't
+    match the structure of the data, just as applying the same steps to the
+    fully unmarshalled object would.
+    '''
+    if isinstance(paths, basestring):
+        return unmarshall_select(data, [paths], mode)[0]
+
+    if mode in no_unmarshall_modes:
+        raise ValueError('%r is not supported for selection' % mode)
+
+    root = SelectNode()
+    for (i, path) in enumerate(paths):
+        root.add_path(i, parse_path(path))
+
+    end = len(data)
+    (values, pos) = select(data, 0, end, {}, root, mode)
+
+    if pos != end:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    return [values[i] for i in xrange(len(paths))]
+
+step_matcher = re.compile(r'''
+    \[(?P<index>\*|-?\d+)\] |  # [*] or [n]
+    \.?(?P<key>[^.[]+)         # .key
+    ''', re.VERBOSE)
+
+# Used as the step for [*].
+ALL = '*'
+
+def parse_path(path):
+    '''
+    Parse a path into a list of steps. Keys are given as strings, indices as
+    integers, and [*] as ALL.
+    '''
+    steps = []
+    pos = 0
+    while pos < len(path):
+        m = step_matcher.match(path, pos)
+        # Only the first step may leave off the dot.
+        if (m is None or
+                (pos > 0 and m.group('key') is not None and path[pos] != '.')):
+            raise ValueError('invalid path: %r' % path)
+
+        (index, key) = m.group('index', 'key')
+        if key is not None:
+            steps.append(('key', key))
+        elif index == ALL:
+            steps.append(('all', None))
+        else:
+            steps.append(('index', int(index)))
+
+        pos = m.end()
+
+    return steps
+
+class SelectNode(object):
+    '''
+    A node in a tree of paths. Paths that share leading steps share nodes, so
+    each part of the data is visited once no matter how many paths use it.
+    '''
+    def __init__(self):
+        # Indices of the paths that end at this node.
+        self.paths = []
+        # Indices of all paths that end at this node or below it.
+        self.all_paths = []
+        # The remaining steps for each path in all_paths.
+        self.remaining = {}
+        # {step : SelectNode}
+        self.children = {}
+
+    def add_path(self, index, steps):
+        self.all_paths.append(index)
+        self.remaining[index] = steps
+
+        if not steps:
+            self.paths.append(index)
+            return
+
+        child = self.children.get(steps[0])
+        if child is None:
+            child = self.children[steps[0]] = SelectNode()
+
+        child.add_path(index, steps[1:])
+
+def apply_steps(obj, steps):
+    '''
+    Apply path steps to an unmarshalled object.
+    '''
+    for (i, (kind, arg)) in enumerate(steps):
+        if kind == 'all':
+            if not isinstance(obj, list):
+                raise TypeError('[*] can only be used with lists')
+            return [apply_steps(item, steps[i+1:]) for item in obj]
+
+        obj = obj[arg]
+
+    return obj
+
+def select(data, pos, end, context, node, mode):
+    '''
+    Select the values for the paths under 'node' from the object starting at
+    index 'pos' in 'data'. Returns a tuple of a dict mapping path indices to
+    values and the index just past the end of the object.
+    '''
+    if node.paths:
+        # This whole object is needed, so there's nothing to skip.
+        return select_whole(data, pos, end, context, node, mode)
+
+    start = pos
+    (unmarshaller, pos) = read_type(data, pos, end)
+    kinds = set(kind for (kind, arg) in node.children)
+
+    if unmarshaller is None:
+        return select_scalar(data, pos, end, node, mode)
+    elif unmarshaller is ContextUnmarshaller:
+        return select_context(data, pos, end, context, node, mode)
+    elif unmarshaller is ListUnmarshaller:
+        if kinds <= set(['index', 'all']):
+            return select_list(data, pos, end, context, node, mode)
+    elif kinds == set(['key']):
+        if unmarshaller is MapUnmarshaller:
+            return select_map(data, pos, end, context, node, mode)
+        else: # unmarshaller is MapClassUnmarshaller
+            return select_map_class(data, pos, end, context, node, mode)
+
+    # The steps don't fit this type of object. This is unusual enough that
+    # the whole object is unmarshalled so the error (or result) is the same as
+    # it would be for the unmarshalled object.
+    return select_whole(data, start, end, context, node, mode)
+
+def select_whole(data, pos, end, context, node, mode):
+    '''
+    Unmarshall the whole object starting at index 'pos' in 'data' and apply the
+    remaining steps of each path under 'node' to it.
+    '''
+    if mode == UNMARSHALL_LAZY:
+        from ._lazy import unmarshall_lazy
+        (obj, pos) = unmarshall_lazy(data, pos, end, context)
+    else:
+        (obj, pos) = unmarshall_internal(data, pos, end, mode, context)
+
+    return (apply_to(obj, node), pos)
+
+def apply_to(obj, node):
+    values = {}
+    for i in node.all_paths:
+        values[i] = apply_steps(obj, node.remaining[i])
+
+    return values
+
+def select_scalar(data, pos, end, node, mode):
+    (obj, pos) = read_scalar(data, pos, end)
+
+    if (mode != UNMARSHALL_NON_RECURSIVE and obj is not None and
+            looks_marshalled(obj)):
+        try:
+            (values, obj_end) = select(obj, 0, len(obj), {}, node, mode)
+            if obj_end == len(obj):
+                return (values, pos)
+        except STAFUnmarshallError:
+            pass
+
+    # Strings can still be indexed.
+    return (apply_to(obj, node), pos)
+
+def select_list(data, pos, end, context, node, mode):
+    m = ListUnmarshaller.count_matcher.match(data, pos, end)
+    if m is None:
+        raise STAFUnmarshallError('bad format for list object')
+
+    count = int(m.group())
+    (pos, stop) = read_clc(data, m.end(), end)
+    if count > stop - pos:
+        raise STAFUnmarshallError('list count exceeds available data')
+
+    # {item index : [child node]}
+    wanted = {}
+    for ((kind, arg), child) in node.children.iteritems():
+        if kind == 'index':
+            index = arg
+            if index < 0:
+                index += count
+            if not 0 <= index < count:
+                raise IndexError('list index out of range')
+            wanted.setdefault(index, []).append(child)
+
+    every = node.children.get(('all', None))
+
+    values = {}
+    if every is not None:
+        for i in every.all_paths:
+            values[i] = []
+
+    for index in xrange(count):
+        children = wanted.get(index, [])
+        if every is None and not children:
+            pos = skip_object(data, pos, stop)
+            continue
+
+        item_start = pos
+        if every is not None:
+            (item_values, pos) = select(data, item_start, stop, context, every,
+                                        mode)
+            for (i, value) in item_values.iteritems():
+                values[i].append(value)
+
+        for child in children:
+            (item_values, pos) = select(data, item_start, stop, context, child,
+                                        mode)
+            values.update(item_values)
+
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    return (values, stop)
+
+def select_map(data, pos, end, context, node, mode):
+    (pos, stop) = read_clc(data, pos, end)
+
+    values = {}
+    found = set()
+    while pos < stop:
+        (key_start, pos) = read_clc(data, pos, stop)
+        key = data[key_start:pos]
+
+        child = node.children.get(('key', key))
+        if child is None:
+            pos = skip_object(data, pos, stop)
+        else:
+            (child_values, pos) = select(data, pos, stop, context, child, mode)
+            values.update(child_values)
+            found.add(key)
+
+    for (kind, key) in node.children:
+        if key not in found:
+            raise KeyError(key)
+
+    return (values, stop)
+
+def select_map_class(data, pos, end, context, node, mode):
+    (pos, stop) = read_clc(data, pos, end)
+    (name_start, pos) = read_clc(data, pos, stop)
+    class_name = data[name_start:pos]
+
+    class_def = context.get(class_name)
+    if class_def is None:
+        raise STAFUnmarshallError('missing map class definition for %r' %
+                                  class_name)
+
+    for (kind, key) in node.children:
+        if key not in class_def.keys:
+            raise KeyError(key)
+
+    # The keys are in the order given by the definition, so values before the
+    # last selected one are skipped and the rest aren't looked at.
+    values = {}
+    remaining = len(node.children)
+    for key in class_def.keys:
+        if not remaining:
+            return (values, stop)
+
+        child = node.children.get(('key', key))
+        if child is None:
+            pos = skip_object(data, pos, stop)
+        else:
+            (child_values, pos) = select(data, pos, stop, context, child, mode)
+            values.update(child_values)
+            remaining -= 1
+
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    return (values, stop)
+
+def select_context(data, pos, end, context, node, mode):
+    (pos, stop) = read_clc(data, pos, end)
+    (new_context, pos) = read_context_map(data, pos, stop, context)
+
+    (values, pos) = select(data, pos, stop, new_context, node, mode)
+    if pos != stop:
+        raise STAFUnmarshallError('unexpected trailing data')
+
+    return (values, stop)
@@ -0,0 +1,474 @@
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+A binary format for saving unmarshalled results and loading them again
+quickly.
+'''
+
+import os
+import mmap
+import struct
+
+from ._marshall import add_definition, without_gc, STAFUnmarshallError
+from ._mapclass import MapClass, MapClassDefinition, new_map_class
+from ._lazy import LazyList, LazyMap, LazyMapClass, _unread
+
+# A snapshot is a header followed by the map class definitions and then the
+# object. The header has a magic string, a format version, and the length of
+# the rest of the snapshot. The definitions are stored as a list of
+# [name, [[key, display name, display short name], ...]] lists.
+#
+# Objects are stored as a one character tag followed by little-endian 32-bit
+# unsigned fields:
+#
+#   'n'                                 None
+#   's' length, bytes                   str
+#   'u' length, UTF-8 bytes             unicode
+#   'l' count, offsets, items           list
+#   'd' count, length, keys and values  dict
+#   'm' definition, length, values      map class, values in key order
+#
+# The offsets for a list give the end of each item, counting from the end of
+# the offsets, so any item can be found without looking at the others. The
+# lengths for dicts and map classes are the length of their contents.
+
+header_format = '<8sIQ'
+header_size = struct.calcsize(header_format)
+magic = 'STAFSNAP'
+version = 1
+
+# Errors raised while reading invalid data.
+data_errors = (struct.error, IndexError, KeyError, TypeError,
+               STAFUnmarshallError)
+
+unpack_field = struct.Struct('<I').unpack_from
+pack_string = struct.Struct('<cI').pack
+
+def dump_snapshot(obj, fileobj):
+    '''
+    Write 'obj' to the binary file-like object 'fileobj' as a snapshot. 'obj'
+    can hold the same types as for marshall(). Each map class definition is
+    stored only once. Raises ValueError if map classes with the same name have
+    different definitions. The cyclic garbage collector is disabled for the
+    whole process while 'obj' is read.
+    '''
+    class_defs = {}
+    indexes = {}
+    (parts, size) = without_gc(snapshot_parts, obj, class_defs, indexes)
+
+    definitions = [None] * len(indexes)
+    for (name, index) in indexes.iteritems():
+        class_def = class_defs[name]
+        keys = [[key, class_def.display_name(key),
+                 class_def.display_short_name(key)] for key in class_def.keys]
+        definitions[index] = [name, keys]
+
+    (def_parts, def_size) = snapshot_parts(definitions, {}, {})
+
+    fileobj.write(struct.pack(header_format, magic, version, def_size + size))
+    fileobj.writelines(def_parts)
+    fileobj.writelines(parts)
+
+def load_snapshot(fileobj, lazy=False):
+    '''
+    Load a snapshot written by dump_snapshot() from the binary file-like
+    object 'fileobj', starting at its current position. The file is left
+    positioned just past the snapshot, so several snapshots can be stored in
+    one file.
+
+    If 'fileobj' is a real file, it's memory mapped rather than read. With
+    'lazy' set to True, lists, dicts, and map classes are returned as LazyList,
+    LazyMap, and LazyMapClass objects that read their items from the mapped
+    file when they're accessed, so a large snapshot can be used without reading
+    all of it. The mapping stays open as long as any of these objects exist.
+    Without 'lazy', the cyclic garbage collector is disabled for the whole
+    process while the snapshot is loaded.
+
+    Raises ValueError if the data isn't a valid snapshot. Lazy objects raise
+    ValueError when they're accessed if the data they read is invalid.
+    '''
+    try:
+        fileno = fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        fileno = None
+
+    if fileno is not None and os.fstat(fileno).st_size > 0:
+        start = fileobj.tell()
+        data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        try:
+            size = read_header(data[start:start + header_size])
+            pos = start + header_size
+            obj = load_contents(data, pos, size, lazy)
+        except:
+            data.close()
+            raise
+
+        fileobj.seek(pos + size)
+        if not lazy:
+            data.close()
+        return obj
+
+    size = read_header(fileobj.read(header_size))
+    return load_contents(fileobj.read(size), 0, size, lazy)
+
+def read_header(header):
+    '''
+    Check a snapshot header and return the length of the rest of the snapshot.
+    '''
+    if len(header) != header_size:
+        raise ValueError('not a snapshot')
+
+    (found_magic, found_version, size) = struct.unpack(header_format, header)
+    if found_magic != magic:
+        raise ValueError('not a snapshot')
+    if found_version != version:
+        raise ValueError('unsupported snapshot version %d' % found_version)
+
+    return size
+
+def load_contents(data, pos, size, lazy):
+    '''
+    Load the definitions and object of the snapshot whose contents are the
+    'size' bytes at index 'pos' in 'data'.
+    '''
+    end = pos + size
+    if len(data) < end:
+        raise ValueError('snapshot is truncated')
+
+    try:
+        (definitions, pos) = load_object(data, pos, [])
+        class_defs = []
+        for (name, keys) in definitions:
+            class_def = MapClassDefinition(name)
+            for (key, display_name, display_short_name) in keys:
+                class_def.add_item(key, display_name, display_short_name)
+            class_defs.append(class_def)
+
+        if lazy:
+            obj = load_lazy(data, pos, class_defs)
+            pos = skip(data, pos)
+        else:
+            layouts = [class_def._get_layout() for class_def in class_defs]
+            (obj, pos) = without_gc(load_object, data, pos, layouts)
+
+    except data_errors:
+        raise ValueError('invalid snapshot data')
+
+    if pos != end:
+        raise ValueError('invalid snapshot data')
+
+    return obj
+
+# Like marshall_parts(), this builds a list of strings with placeholders for
+# container headers, which are filled in once the container is finished.
+
+def snapshot_parts(obj, class_defs, indexes):
+    '''
+    Build the snapshot data for 'obj' as a list of strings. Definitions for
+    map classes are added to 'class_defs', a map of names to
+    MapClassDefinitions, and their positions in the stored definitions are
+    added to 'indexes'. Returns a tuple of the list and its total length.
+    '''
+    parts = []
+    size = 0
+    # One entry for each container being written: the tag, the first header
+    # field, an iterator over the remaining items, the index of the header
+    # placeholder in 'parts', the size at the start of the contents, and the
+    # list of item end offsets for lists.
+    stack = []
+
+    while True:
+        # Strings come first since they're the most common.
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+            parts.extend((pack_string('u', len(obj)), obj))
+            size += 5 + len(obj)
+            finished = True
+
+        elif isinstance(obj, str):
+            parts.extend((pack_string('s', len(obj)), obj))
+            size += 5 + len(obj)
+            finished = True
+
+        elif obj is None:
+            parts.append('n')
+            size += 1
+            finished = True
+
+        elif isinstance(obj, (MapClass, LazyMapClass)):
+            add_definition(obj, class_defs)
+            index = indexes.setdefault(obj.class_name, len(indexes))
+            stack.append(('m', index, obj.itervalues(), len(parts), size + 9,
+                          None))
+            parts.append(None)
+            size += 9
+            finished = False
+
+        elif isinstance(obj, (dict, LazyMap)):
+            stack.append(('d', len(obj), iter_pairs(obj), len(parts),
+                          size + 9, None))
+            parts.append(None)
+            size += 9
+            finished = False
+
+        elif isinstance(obj, (list, tuple, LazyList)):
+            header_len = 5 + 4 * len(obj)
+            stack.append(('l', len(obj), iter(obj), len(parts),
+                          size + header_len, []))
+            parts.append(None)
+            size += header_len
+            finished = False
+
+        else:
+            obj = str(obj)
+            parts.extend((pack_string('s', len(obj)), obj))
+            size += 5 + len(obj)
+            finished = True
+
+        # Finish containers until one is found with another item.
+        while stack:
+            (tag, field, items, index, start, ends) = stack[-1]
+            if finished and ends is not None:
+                ends.append(size - start)
+
+            try:
+                obj = items.next()
+            except StopIteration:
+                stack.pop()
+                if ends is not None:
+                    header = struct.pack('<cI%dI' % len(ends), tag, field,
+                                         *ends)
+                else:
+                    header = struct.pack('<cII', tag, field, size - start)
+                parts[index] = header
+                finished = True
+                continue
+
+            break
+
+        else:
+            return (parts, size)
+
+def iter_pairs(obj):
+    '''
+    Yields the keys and values of a dict in turn.
+    '''
+    for (key, value) in obj.iteritems():
+        yield key
+        yield value
+
+def load_scalar(data, pos, tag):
+    '''
+    Load a string or None with the given tag at index 'pos' in 'data'. Returns
+    a tuple of the object and the index just past the end of it.
+    '''
+    if tag == 'n':
+        return (None, pos + 1)
+
+    (length,) = unpack_field(data, pos + 1)
+    start = pos + 5
+    end = start + length
+    if end > len(data):
+        raise IndexError('string extends past the end of the data')
+
+    obj = data[start:end]
+    if tag == 'u':
+        obj = unicode(obj, 'utf-8')
+    elif tag != 's':
+        raise KeyError(tag)
+
+    return (obj, end)
+
+def load_object(data, pos, layouts):
+    '''
+    Load the object at index 'pos' in 'data', using 'layouts' for map classes.
+    Returns a tuple of the object and the index just past the end of it.
+    '''
+    # One entry for each container being loaded: the tag, the items loaded so
+    # far, the number of items, and the layout for map classes.
+    stack = []
+
+    while True:
+        tag = data[pos]
+        # Strings are read here rather than with load_scalar() since they're
+        # the most common objects by far. A string that runs past the end of
+        # the data ends up with the wrong end position, which is caught later.
+        if tag == 'u' or tag == 's':
+            (length,) = unpack_field(data, pos + 1)
+            start = pos + 5
+            pos = start + length
+            obj = data[start:pos]
+            if tag == 'u':
+                obj = unicode(obj, 'utf-8')
+
+        elif tag in 'ldm':
+            (field,) = unpack_field(data, pos + 1)
+            if tag == 'l':
+                pos += 5 + 4 * field
+                entry = (tag, [], field, None)
+            elif tag == 'd':
+                pos += 9
+                entry = (tag, [], 2 * field, None)
+            else:
+                layout = layouts[field]
+                pos += 9
+                entry = (tag, [], len(layout.keys), layout)
+
+            stack.append(entry)
+            if entry[2]:
+                continue
+
+            stack.pop()
+            obj = finish_object(entry)
+        else:
+            (obj, pos) = load_scalar(data, pos, tag)
+
+        # Add the object to its container, finishing containers that are full.
+        while stack:
+            entry = stack[-1]
+            items = entry[1]
+            items.append(obj)
+            if len(items) < entry[2]:
+                break
+
+            stack.pop()
+            obj = finish_object(entry)
+
+        else:
+            return (obj, pos)
+
+def finish_object(entry):
+    (tag, items, count, layout) = entry
+    if tag == 'l':
+        return items
+    elif tag == 'd':
+        return dict(zip(items[::2], items[1::2]))
+    else:
+        return new_map_class(layout, items)
+
+def skip(data, pos):
+    '''
+    Returns the index just past the end of the object at index 'pos' in 'data'.
+    '''
+    tag = data[pos]
+    if tag == 'n':
+        return pos + 1
+
+    (field,) = unpack_field(data, pos + 1)
+    if tag in 'su':
+        return pos + 5 + field
+    elif tag == 'l':
+        table = pos + 5
+        if not field:
+            return table
+        (last,) = unpack_field(data, table + 4 * (field - 1))
+        return table + 4 * field + last
+    elif tag in 'dm':
+        (length,) = unpack_field(data, pos + 5)
+        return pos + 9 + length
+    else:
+        raise KeyError(tag)
+
+def load_lazy(data, pos, class_defs):
+    '''
+    Lazily load the object at index 'pos' in 'data', using 'class_defs' for
+    map classes.
+    '''
+    tag = data[pos]
+    if tag == 'l':
+        (count,) = unpack_field(data, pos + 1)
+        return SnapshotList(data, pos + 5, count, class_defs)
+    elif tag == 'd':
+        return SnapshotMap(data, pos + 9, skip(data, pos), class_defs)
+    elif tag == 'm':
+        (index,) = unpack_field(data, pos + 1)
+        return SnapshotMapClass(data, pos + 9, skip(data, pos),
+                                class_defs[index], class_defs)
+    else:
+        (obj, pos) = load_scalar(data, pos, tag)
+        return obj
+
+def checked(method):
+    '''
+    Wrap a method of the lazy snapshot objects so that errors from invalid
+    data are raised as ValueError.
+    '''
+    def wrapper(self, *args):
+        try:
+            return method(self, *args)
+        except data_errors:
+            raise ValueError('invalid snapshot data')
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class SnapshotList(LazyList):
+    '''
+    LazyList that reads its items from a snapshot.
+    '''
+
+    def __init__(self, data, table, count, class_defs):
+        super(SnapshotList, self).__init__(data, table, None, count,
+                                           class_defs)
+
+    @checked
+    def _index(self):
+        # The item offsets give all of the positions at once.
+        table = self._pos
+        count = self._count
+        start = table + 4 * count
+        ends = struct.unpack_from('<%dI' % count, self._data, table)
+
+        self._offsets = [start] + [start + end for end in ends]
+        self._items = [_unread] * count
+
+    @checked
+    def _read(self, start, end):
+        return load_lazy(self._data, start, self._context)
+
+class SnapshotMap(LazyMap):
+    '''
+    LazyMap that reads its items from a snapshot.
+    '''
+
+    @checked
+    def _index(self):
+        data = self._data
+        stop = self._stop
+
+        keys = []
+        offsets = {}
+        pos = self._pos
+        while pos < stop:
+            (key, pos) = load_scalar(data, pos, data[pos])
+            end = skip(data, pos)
+
+            if key not in offsets:
+                keys.append(key)
+            offsets[key] = (pos, end)
+            pos = end
+
+        self._keys = keys
+        self._offsets = offsets
+
+    @checked
+    def _read(self, start, end):
+        return load_lazy(self._data, start, self._context)
+
+class SnapshotMapClass(LazyMapClass):
+    '''
+    LazyMapClass that reads its items from a snapshot.
+    '''
+
+    # LazyMapClass._index() raises STAFUnmarshallError for trailing data.
+    _index = checked(LazyMapClass._index.im_func)
+
+    @checked
+    def _read(self, start, end):
+        return load_lazy(self._data, start, self._context)
+
+    def _skip(self, pos, end):
+        return skip(self._data, pos)
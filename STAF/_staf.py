@@ -7,11 +7,14 @@ Python versions of STAF APIs.
 
 from __future__ import with_statement
 
+import sys
 import ctypes
+import threading
+import Queue
 
 from . import _api
 from ._errors import errors, strerror, STAFResultError
-from ._marshall import UNMARSHALL_RECURSIVE
+from ._marshall import UNMARSHALL_RECURSIVE, UNMARSHALL_RAW
 
 # Submit modes (from STAF.h, STAFSyncOption_e)
 REQ_SYNC            = 0
@@ -49,7 +52,7 @@ class Handle(object):
         self._registered = True
 
     def submit(self, where, service, request, sync_option=REQ_SYNC,
-               unmarshall=UNMARSHALL_RECURSIVE):
+               unmarshall=UNMARSHALL_RECURSIVE, interner=None):
         '''
         Send a command to a STAF service. Arguments work mostly like the
         Submit2UTF8 C API. See the STAF package documentation for full details.
@@ -65,21 +68,114 @@ class Handle(object):
                                   ctypes.byref(result_ptr),
                                   ctypes.byref(result_len))
 
+            # string_at() copies the result into a str in one step. Decoding
+            # makes a second, larger copy, which UNMARSHALL_RAW skips. Empty
+            # results are the str '' in every mode.
             if result_len.value > 0:
-                result = result_ptr[:result_len.value].decode('utf-8')
+                result = ctypes.string_at(result_ptr, result_len.value)
+                if unmarshall != UNMARSHALL_RAW or rc != 0:
+                    result = result.decode('utf-8')
             else:
                 result = ''
 
             if rc != 0:
                 raise STAFResultError(rc, strerror(rc), result or None)
 
-            return f_unmarshall(result, unmarshall)
+            if unmarshall == UNMARSHALL_RAW:
+                return result
+
+            return f_unmarshall(result, unmarshall, interner)
 
         finally:
             # Need to free result_ptr even when rc indicates an error.
             if result_ptr:
                 _api.Free(self._handle, result_ptr)
 
+    def submit_many(self, requests, max_workers=8,
+                    unmarshall=UNMARSHALL_RECURSIVE, interner=None):
+        '''
+        Submit each (where, service, request) tuple in 'requests' using up to
+        'max_workers' threads at once. Returns a list of the results in the
+        same order as 'requests'. A request that fails doesn't stop the
+        others; its STAFResultError is put in the list in place of a result.
+        Raises ValueError if 'max_workers' is less than 1.
+        '''
+        results = {}
+        for (index, result) in self.iter_submit_many(requests, max_workers,
+                                                     unmarshall, interner):
+            results[index] = result
+
+        return [results[i] for i in xrange(len(results))]
+
+    def iter_submit_many(self, requests, max_workers=8,
+                         unmarshall=UNMARSHALL_RECURSIVE, interner=None):
+        '''
+        Same as submit_many(), but yields (index, result) tuples as the
+        requests complete, where 'index' is the position of the request in
+        'requests'.
+        '''
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+
+        return self._iter_submit_many(requests, max_workers, unmarshall,
+                                      interner)
+
+    def _iter_submit_many(self, requests, max_workers, unmarshall, interner):
+        tasks = enumerate(requests)
+        lock = threading.Lock()
+        stopping = threading.Event()
+        # Holds (index, result) tuples, (None, exc_info) for unexpected
+        # errors, and None when a worker finishes.
+        results = Queue.Queue()
+
+        def worker():
+            try:
+                while not stopping.isSet():
+                    lock.acquire()
+                    try:
+                        try:
+                            (index, (where, service, request)) = tasks.next()
+                        except StopIteration:
+                            break
+                    finally:
+                        lock.release()
+
+                    try:
+                        result = self.submit(where, service, request,
+                                             REQ_SYNC, unmarshall, interner)
+                    except STAFResultError, exc:
+                        result = exc
+
+                    results.put((index, result))
+
+            except:
+                stopping.set()
+                results.put((None, sys.exc_info()))
+
+            results.put(None)
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(max_workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        # If the caller stops early, the workers finish the requests they're
+        # running and stop.
+        try:
+            running = len(threads)
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                elif item[0] is None:
+                    (exc_type, exc_value, exc_tb) = item[1]
+                    raise exc_type, exc_value, exc_tb
+                else:
+                    yield item
+        finally:
+            stopping.set()
+
     @classmethod
     def _build_request(cls, request):
         if isinstance(request, basestring):
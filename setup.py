@@ -15,4 +15,8 @@ setup(
     url='https://github.com/KevinGoodsell/caduceus',
     packages=['STAF'],
     license='Eclipse Public License v1.0',
+    extras_require={
+        # AsyncHandle and RequestManager use concurrent.futures.
+        'async': ['futures'],
+    },
 )
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Kevin Goodsell
+#
+# This software is licensed under the Eclipse Public License (EPL) V1.0.
+
+'''
+Benchmarks for unmarshalling synthetic payloads.
+
+Each payload kind is generated at each size and unmarshalled in each mode.
+The best and median times are recorded, along with the growth in peak memory
+use while unmarshalling, which is measured in a separate process using the
+resource module (where it's available). Results are written as JSON, and can
+be compared against the results from another revision with --compare.
+
+Example:
+
+    python bench_marshall.py --sizes 1K,1M,50M --output new.json \\
+        --compare old.json
+'''
+
+import sys
+import os
+import re
+import time
+import timeit
+import random
+import platform
+import tempfile
+import subprocess
+import optparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import STAF
+
+# 'lazy-walk' is UNMARSHALL_LAZY followed by accessing every item, since
+# UNMARSHALL_LAZY on its own only reads the first header.
+modes = {
+    'recursive': STAF.UNMARSHALL_RECURSIVE,
+    'non-recursive': STAF.UNMARSHALL_NON_RECURSIVE,
+    'lazy': STAF.UNMARSHALL_LAZY,
+    'lazy-walk': STAF.UNMARSHALL_LAZY,
+    'none': STAF.UNMARSHALL_NONE,
+}
+
+# Number of distinct items generated for each payload. Larger payloads repeat
+# them.
+pool_size = 500
+
+def random_string(rng, min_len=0, max_len=40):
+    chars = 'abcdefghijklmnopqrstuvwxyz0123456789 -_./'
+    length = rng.randint(min_len, max_len)
+    return ''.join([rng.choice(chars) for i in xrange(length)])
+
+def random_value(rng):
+    choice = rng.random()
+    if choice < 0.1:
+        return None
+    elif choice < 0.4:
+        return str(rng.randint(0, 1 << 32))
+    else:
+        return random_string(rng)
+
+def map_class_definition(num_keys):
+    definition = STAF.MapClassDefinition('Bench/Row%d' % num_keys)
+    for i in xrange(num_keys):
+        definition.add_item('key%d' % i, 'Key %d' % i, 'K%d' % i)
+    return definition
+
+def scalar_items(rng):
+    return [random_value(rng) for i in xrange(pool_size)]
+
+def map_class_items(num_keys):
+    def items(rng):
+        definition = map_class_definition(num_keys)
+        rows = [[random_value(rng) for i in xrange(num_keys)]
+                for j in xrange(pool_size)]
+        return definition.map_class_rows(rows)
+    return items
+
+def nested_container_items(rng, depth=6):
+    definition = map_class_definition(5)
+
+    def tree(level):
+        node = {
+            'level': str(level),
+            'name': random_string(rng),
+            'info': definition.map_class_rows(
+                    [[random_value(rng) for i in xrange(5)]])[0],
+        }
+        if level < depth:
+            node['children'] = [tree(level + 1), tree(level + 1)]
+        return node
+
+    return [tree(1) for i in xrange(pool_size // 50)]
+
+def embedded_items(levels):
+    def items(rng):
+        definition = map_class_definition(5)
+
+        def embedded(level):
+            rows = [[random_value(rng) for i in xrange(5)] for j in xrange(4)]
+            obj = {'rows': definition.map_class_rows(rows)}
+            if level < levels:
+                obj['result'] = embedded(level + 1)
+            return STAF.marshall(obj)
+
+        return [{'rc': '0', 'result': embedded(1)}
+                for i in xrange(pool_size // (levels * 4))]
+    return items
+
+# 'nested-containers' nests maps and lists in a single marshalling context.
+# 'embedded' and 'nested-contexts' have marshalled strings inside strings,
+# each with its own marshalling context, 3 and 20 levels deep.
+kinds = {
+    'scalars': scalar_items,
+    'mapclass-5': map_class_items(5),
+    'mapclass-15': map_class_items(15),
+    'mapclass-30': map_class_items(30),
+    'nested-containers': nested_container_items,
+    'embedded': embedded_items(3),
+    'nested-contexts': embedded_items(20),
+}
+
+def make_payload(kind, size, fileobj, seed=0):
+    '''
+    Write marshalled data of about 'size' characters to 'fileobj': a list of
+    items of the given kind, in a marshalling context if needed. A pool of
+    items is generated and repeated to reach the size, and the data is
+    written a piece at a time, so even large payloads are quick to build.
+    '''
+    rng = random.Random(seed)
+    pool = kinds[kind](rng)
+
+    average = float(len(STAF.marshall(pool))) / len(pool)
+    num_items = max(1, int(size / average))
+    items = [pool[i % len(pool)] for i in xrange(num_items)]
+    STAF.marshall_to(items, fileobj)
+
+def walk(obj):
+    '''
+    Access every item in a lazily unmarshalled object.
+    '''
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, STAF.LazyMap):
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, STAF.LazyList):
+            stack.extend(obj)
+
+def unmarshall(data, mode_name):
+    result = STAF.unmarshall(data, modes[mode_name])
+    if mode_name == 'lazy-walk':
+        walk(result)
+    return result
+
+def time_unmarshall(data, mode_name, repeat):
+    '''
+    Returns a list of the times taken to unmarshall 'data' in 'repeat' runs.
+    '''
+    timer = timeit.default_timer
+    times = []
+    for i in xrange(repeat):
+        start = timer()
+        unmarshall(data, mode_name)
+        times.append(timer() - start)
+
+    return times
+
+def max_rss():
+    '''
+    Returns the peak resident set size of this process in bytes.
+    '''
+    # On Linux, ru_maxrss keeps the peak of the parent process across fork()
+    # and exec(), so the per-process high water mark is used instead.
+    try:
+        f = open('/proc/self/status')
+    except IOError:
+        pass
+    else:
+        try:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            f.close()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, Mac OS X gives bytes.
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+def measure_memory(path, mode_name):
+    '''
+    Unmarshall the data in the file 'path' and return the growth in peak
+    memory use. This runs in a fresh process so earlier runs don't affect
+    the peak.
+    '''
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    before = max_rss()
+    result = unmarshall(data, mode_name)
+    return max_rss() - before
+
+def peak_memory(path, mode_name):
+    '''
+    Returns the growth in peak memory use while unmarshalling the data in
+    the file 'path', measured in a new process, or None if it can't be
+    measured.
+    '''
+    if resource is None:
+        return None
+
+    # The child process finds STAF the same way this one did.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--measure-memory', path, mode_name],
+                            env=env, stdout=subprocess.PIPE)
+    (out, err) = proc.communicate()
+    if proc.returncode != 0:
+        return None
+
+    return int(out)
+
+def parse_size(text):
+    m = re.match(r'(\d+)([KMG]?)$', text.strip().upper())
+    if m is None:
+        raise ValueError('invalid size: %r' % text)
+
+    (number, unit) = m.groups()
+    return int(number) * {'': 1, 'K': 1 << 10, 'M': 1 << 20,
+                          'G': 1 << 30}[unit]
+
+def repeat_for(size):
+    # Small payloads are run more times to get stable timings.
+    if size <= 1 << 16:
+        return 50
+    elif size <= 1 << 22:
+        return 10
+    elif size <= 1 << 26:
+        return 3
+    return 1
+
+def revision():
+    '''
+    Returns the git revision of the source tree, or None.
+    '''
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+    except OSError:
+        return None
+
+    if proc.returncode != 0:
+        return None
+    return out.strip()
+
+def run(kind_names, sizes, mode_names, repeat=None):
+    results = []
+    for kind in kind_names:
+        for size in sizes:
+            (fd, path) = tempfile.mkstemp(suffix='.sdt')
+            f = os.fdopen(fd, 'w+b')
+            try:
+                make_payload(kind, size, f)
+                f.seek(0)
+                data = f.read()
+            finally:
+                f.close()
+
+            try:
+                results.extend(run_payload(kind, size, data, path,
+                                           mode_names, repeat))
+            finally:
+                os.remove(path)
+            del data
+
+    return results
+
+def run_payload(kind, size, data, path, mode_names, repeat=None):
+    '''
+    Run the benchmarks for one payload, given as both the data and the path
+    of a file holding it.
+    '''
+    results = []
+    for mode_name in mode_names:
+        times = sorted(time_unmarshall(data, mode_name,
+                                       repeat or repeat_for(size)))
+        if times[0] > 0:
+            rate = len(data) / times[0] / (1 << 20)
+        else:
+            rate = None
+
+        result = {
+            'kind': kind,
+            'size': size,
+            'bytes': len(data),
+            'mode': mode_name,
+            'runs': len(times),
+            'best': times[0],
+            'median': times[len(times) // 2],
+            'mb_per_sec': rate,
+            'peak_memory': peak_memory(path, mode_name),
+        }
+        results.append(result)
+        report(result)
+
+    return results
+
+def report(result):
+    memory = result['peak_memory']
+    if memory is None:
+        memory = '-'
+    else:
+        memory = '%.1fMB' % (memory / float(1 << 20))
+
+    rate = result['mb_per_sec']
+    if rate is None:
+        rate = '-'
+    else:
+        rate = '%.1fMB/s' % rate
+
+    print '%-17s %10d %-14s %10.6fs %12s %10s' % (
+            result['kind'], result['bytes'], result['mode'], result['best'],
+            rate, memory)
+    sys.stdout.flush()
+
+def compare(old_results, new_results):
+    '''
+    Print the change from the old results to the new results for each
+    benchmark they have in common.
+    '''
+    def key(result):
+        return (result['kind'], result['size'], result['mode'])
+
+    old = dict((key(result), result) for result in old_results)
+
+    print
+    print '%-17s %10s %-14s %10s %10s' % ('kind', 'size', 'mode', 'time',
+                                          'memory')
+    for result in new_results:
+        old_result = old.get(key(result))
+        if old_result is None:
+            continue
+
+        if old_result['best'] > 0:
+            time_ratio = '%9.2fx' % (result['best'] / old_result['best'])
+        else:
+            time_ratio = '-'
+
+        if result['peak_memory'] and old_result['peak_memory']:
+            memory = '%9.2fx' % (float(result['peak_memory']) /
+                                 old_result['peak_memory'])
+        else:
+            memory = '-'
+
+        print '%-17s %10d %-14s %10s %10s' % (
+                result['kind'], result['size'], result['mode'], time_ratio,
+                memory)
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--kinds', default=','.join(sorted(kinds)),
+                      help='payload kinds to run (default: all of %default)')
+    parser.add_option('--sizes', default='1K,100K,10M',
+                      help='payload sizes, like 1K,10M,500M '
+                           '(default: %default)')
+    parser.add_option('--modes', default=','.join(sorted(modes)),
+                      help='unmarshalling modes (default: all of %default)')
+    parser.add_option('--repeat', type='int',
+                      help='number of runs for each benchmark (default: '
+                           'depends on the size)')
+    parser.add_option('--output', default='bench-results.json',
+                      help='file to write results to (default: %default)')
+    parser.add_option('--compare', metavar='FILE',
+                      help='results file from another revision to compare to')
+    # Used internally to measure memory use in a new process.
+    parser.add_option('--measure-memory', nargs=2,
+                      help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args(args)
+
+    if options.measure_memory:
+        (path, mode_name) = options.measure_memory
+        print measure_memory(path, mode_name)
+        return
+
+    kind_names = options.kinds.split(',')
+    mode_names = options.modes.split(',')
+    for name in kind_names:
+        if name not in kinds:
+            parser.error('unknown payload kind: %s' % name)
+    for name in mode_names:
+        if name not in modes:
+            parser.error('unknown mode: %s' % name)
+
+    try:
+        sizes = [parse_size(size) for size in options.sizes.split(',')]
+    except ValueError, e:
+        parser.error(str(e))
+
+    if resource is None:
+        print 'resource is not available, peak memory will not be recorded'
+
+    results = run(kind_names, sizes, mode_names, options.repeat)
+
+    output = {
+        'revision': revision(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    f = open(options.output, 'w')
+    try:
+        json.dump(output, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            old_output = json.load(f)
+        finally:
+            f.close()
+
+        compare(old_output['results'], results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
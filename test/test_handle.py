@@ -4,8 +4,16 @@
 
 from __future__ import with_statement
 
+import sys
 import time
+import threading
 import unittest
+import StringIO
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
 
 import STAF
 
@@ -26,6 +34,13 @@ class HandleTests(unittest.TestCase):
             result = h.submit('local', 'ping', ['ping'])
             self.assertEqual(result, 'PONG')
 
+            # Empty results are str in every mode.
+            for mode in [STAF.UNMARSHALL_RECURSIVE, STAF.UNMARSHALL_NONE,
+                         STAF.UNMARSHALL_RAW]:
+                result = h.submit('local', 'delay', 'delay 0', unmarshall=mode)
+                self.assertEqual(type(result), str)
+                self.assertEqual(result, '')
+
             result = h.submit('local', 'service', 'list')
             services = dict((s['name'], s) for s in result)
             # There's not much reason to check all these, so just pick a few.
@@ -163,6 +178,348 @@ class HandleTests(unittest.TestCase):
             self.assertEqual(result['rc'], '0')
             self.assertEqual(result['result'], 'PONG')
 
+    def testSubmitMany(self):
+        with STAF.Handle('test handle') as h:
+            requests = [('local', 'echo', ['echo', str(i)])
+                        for i in range(20)]
+            requests.insert(5, ('local', 'doesntexist', 'do magic'))
+
+            results = h.submit_many(requests, max_workers=4)
+            self.assertEqual(len(results), 21)
+            self.assertEqual(results[5].rc, STAF.errors.UnknownService)
+            del results[5]
+            self.assertEqual(results, [str(i) for i in range(20)])
+
+            results = dict(h.iter_submit_many(requests, max_workers=4))
+            self.assertEqual(sorted(results), range(21))
+            self.assertEqual(results[6], '5')
+
+            self.assertRaises(ValueError, h.submit_many, requests,
+                              max_workers=0)
+            self.assertRaises(ValueError, h.iter_submit_many, requests,
+                              max_workers=-1)
+
+    def testHandlePool(self):
+        with STAF.HandlePool('test pool', size=2, preregister=1) as pool:
+            self.assertEqual(pool.submit('local', 'ping', 'ping'), 'PONG')
+
+            with pool.handle() as h1:
+                with pool.handle() as h2:
+                    self.assertNotEqual(h1.handle_num(), h2.handle_num())
+                    self.assertEqual(h2.submit('local', 'ping', 'ping'),
+                                     'PONG')
+
+            # An error about some other handle doesn't drop the pooled one.
+            with pool.handle() as h:
+                num = h.handle_num()
+            self.assertSTAFResultError(STAF.errors.HandleDoesNotExist,
+                                       pool.submit, 'local', 'handle',
+                                       'query handle 999999')
+            with pool.handle() as h:
+                self.assertEqual(h.handle_num(), num)
+
+            # A handle that no longer exists is replaced.
+            with pool.handle() as h:
+                STAF._api.UnRegister(h.handle_num())
+            self.assertEqual(pool.submit('local', 'ping', 'ping'), 'PONG')
+
+            result = pool.submit('local', 'handle',
+                                 ['list handles name', 'test pool'])
+            self.assertEqual(len(result), 2)
+
+        with STAF.Handle('test handle') as h:
+            result = h.submit('local', 'handle',
+                              ['list handles name', 'test pool'])
+            self.assertEqual(result, [])
+
+        self.assertRaises(ValueError, pool.acquire)
+
+    def testRequestManager(self):
+        if concurrent is None:
+            self.skipTest('concurrent.futures is not installed')
+
+        with STAF.RequestManager('test manager', batch_size=10,
+                                 poll_interval=0.5) as manager:
+            futures = [manager.submit('local', 'echo', ['echo', str(i)])
+                       for i in range(100)]
+            delayed = manager.submit('local', 'delay', 'delay 1000')
+            failed = manager.submit('local', 'doesntexist', 'do magic')
+
+            self.assertEqual([f.result() for f in futures],
+                             [str(i) for i in range(100)])
+            self.assertEqual(delayed.result(), '')
+            self.assertSTAFResultError(STAF.errors.UnknownService,
+                                       failed.result)
+
+            result = manager.submit('local', 'service', 'list')
+            self.assertTrue(isinstance(result.result(), list))
+            self.assertEqual(manager.outstanding(), 0)
+
+            # Completions for requests the manager didn't submit expire.
+            manager._early_expiry = 1.0
+            manager.handle.submit('local', 'ping', 'ping', STAF.REQ_QUEUE)
+            self.assertEqual(manager.submit('local', 'ping', 'ping').result(),
+                             'PONG')
+            for i in range(50):
+                if not manager._early:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(manager._early, {})
+
+        self.assertRaises(ValueError, manager.submit, 'local', 'ping', 'ping')
+        self.assertFalse(manager.handle.is_registered())
+
+    def testQueueListener(self):
+        with STAF.Handle('test handle') as h:
+            received = []
+            done = threading.Event()
+            def callback(entry):
+                received.append(entry['message'])
+                if len(received) == 20:
+                    done.set()
+
+            with STAF.QueueListener(h, batch_size=5,
+                                    poll_interval=0.5) as listener:
+                listener.add_callback(callback, 'test/Message')
+                for i in range(20):
+                    h.submit('local', 'queue',
+                             ['queue handle', str(h.handle_num()),
+                              'type', 'test/message', 'message', str(i)])
+                h.submit('local', 'queue',
+                         ['queue handle', str(h.handle_num()),
+                          'type', 'test/other', 'message', 'other'])
+
+                done.wait(10)
+
+            self.assertEqual(listener.error, None)
+            self.assertEqual(received, [str(i) for i in range(20)])
+
+            # Messages without callbacks are left in the queue.
+            result = h.submit('local', 'queue', 'get')
+            self.assertEqual(result['message'], 'other')
+
+    def testAsyncHandle(self):
+        if concurrent is None:
+            self.skipTest('concurrent.futures is not installed')
+
+        with STAF.AsyncHandle('test handle', max_workers=4) as ah:
+            futures = [ah.submit('local', 'ping', 'ping') for i in range(20)]
+            self.assertEqual([f.result() for f in futures], ['PONG'] * 20)
+
+            result = ah.submit('local', 'handle',
+                               ['list handles name', 'test handle', 'long'])
+            self.assertEqual(result.result()[0]['name'], 'test handle')
+
+            future = ah.submit('local', 'doesntexist', 'do magic')
+            self.assertSTAFResultError(STAF.errors.UnknownService,
+                                       future.result)
+
+            handle = ah.handle
+
+        self.assertFalse(handle.is_registered())
+
+    def testAsyncHandleExecutor(self):
+        if concurrent is None:
+            self.skipTest('concurrent.futures is not installed')
+
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        try:
+            ah = STAF.AsyncHandle('test handle', executor=executor)
+            future = ah.submit('local', 'delay', 'delay 1000')
+
+            # close() waits for the request even though it doesn't own the
+            # executor.
+            ah.close()
+            self.assertTrue(future.done())
+            self.assertEqual(future.result(), '')
+            self.assertFalse(ah.handle.is_registered())
+            self.assertRaises(ValueError, ah.submit, 'local', 'ping', 'ping')
+
+            # The executor is still usable.
+            self.assertEqual(executor.submit(len, 'abc').result(), 3)
+        finally:
+            executor.shutdown()
+
+
+class FakeQueueHandle(object):
+    '''
+    Stands in for a Handle, serving QUEUE GET requests from a list of queue
+    entries and recording the requests.
+    '''
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def handle_num(self):
+        return 1
+
+    def submit(self, where, service, request, sync_option=STAF.REQ_SYNC,
+               unmarshall=STAF.UNMARSHALL_RECURSIVE, interner=None):
+        with self.lock:
+            self.requests.append(request)
+            count = int(request.split(' first ')[1].split()[0])
+            batch = self.entries[:count]
+            del self.entries[:count]
+
+        if not batch:
+            time.sleep(0.01)
+            raise STAF.STAFResultError(STAF.errors.Timeout)
+        return STAF.unmarshall(STAF.marshall(batch), unmarshall)
+
+class QueueListenerTests(unittest.TestCase):
+
+    def listen(self, entries, message_type, key=None, **kwargs):
+        handle = FakeQueueHandle(entries)
+        received = []
+        listener = STAF.QueueListener(handle, poll_interval=0.01, **kwargs)
+        try:
+            listener.add_callback(received.append, message_type, key)
+            for i in range(200):
+                if not handle.entries:
+                    break
+                time.sleep(0.01)
+        finally:
+            listener.close()
+
+        return (handle, received)
+
+    def testKeys(self):
+        entries = [{'type': 'STAF/Process/End', 'message': {'key': key}}
+                   for key in ['a', 'b', 'a']]
+        (handle, received) = self.listen(list(entries), 'staf/process/end',
+                                         'a')
+        self.assertEqual(received, [entries[0], entries[2]])
+        self.assertTrue(' type :16:staf/process/end ' in handle.requests[0])
+
+        listener = STAF.QueueListener(FakeQueueHandle([]))
+        try:
+            self.assertRaises(ValueError, listener.add_callback, len,
+                              None, 'a')
+        finally:
+            listener.close()
+
+    def testBatches(self):
+        entries = [{'type': 'x', 'message': str(i)} for i in range(50)]
+        (handle, received) = self.listen(list(entries), 'x', batch_size=20,
+                                         max_pending=0)
+        self.assertEqual(received, entries)
+        self.assertTrue(handle.requests[0].endswith(' first 20 wait 10'))
+
+    def testBadEntries(self):
+        for mode in [STAF.UNMARSHALL_NONE, STAF.UNMARSHALL_RAW,
+                     STAF.UNMARSHALL_NON_RECURSIVE]:
+            self.assertRaises(ValueError, STAF.QueueListener,
+                              FakeQueueHandle([]), unmarshall=mode)
+
+        # An entry that isn't a map goes to the error callback, and doesn't
+        # stop the entries after it.
+        entries = ['bad', {'type': 'x', 'message': 'good'}]
+        errors = []
+        (handle, received) = self.listen(
+                list(entries), None, max_pending=1,
+                error_callback=lambda entry, info: errors.append(entry))
+        self.assertEqual(received, entries[1:])
+        self.assertEqual(errors, ['bad'])
+
+    def testBadErrorCallback(self):
+        # An error callback that raises doesn't stop the dispatch thread, so
+        # the later entries are delivered and close() returns.
+        def error_callback(entry, info):
+            raise RuntimeError('error callback failed')
+
+        entries = ['bad'] * 3 + [{'type': 'x', 'message': 'good'}]
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            (handle, received) = self.listen(list(entries), None,
+                                             max_pending=1,
+                                             error_callback=error_callback)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(received, entries[3:])
+
+class FakeRequestHandle(object):
+    '''
+    Stands in for the Handle of a RequestManager. Requests complete as soon
+    as they're submitted, with the request as the result, and their
+    RequestComplete messages are served to QUEUE GET requests.
+    '''
+
+    def __init__(self, name):
+        self.completions = []
+        self.number = 0
+        self.lock = threading.Lock()
+
+    def handle_num(self):
+        return 1
+
+    def unregister(self):
+        pass
+
+    @staticmethod
+    def completion(number, result):
+        return {'type': 'STAF/RequestComplete',
+                'message': {'requestNumber': number, 'rc': '0',
+                            'result': result}}
+
+    def submit(self, where, service, request, sync_option=STAF.REQ_SYNC,
+               unmarshall=STAF.UNMARSHALL_RECURSIVE, interner=None):
+        with self.lock:
+            if service != 'queue':
+                self.number += 1
+                number = str(self.number)
+                self.completions.append(self.completion(number, request))
+                return number
+
+            batch = self.completions[:]
+            del self.completions[:]
+
+        if not batch:
+            time.sleep(0.01)
+            raise STAF.STAFResultError(STAF.errors.Timeout)
+        return batch
+
+class RequestManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        if concurrent is None:
+            self.skipTest('concurrent.futures is not installed')
+
+        self.handle_class = STAF._requests.Handle
+        STAF._requests.Handle = FakeRequestHandle
+
+    def tearDown(self):
+        STAF._requests.Handle = self.handle_class
+
+    def testResults(self):
+        with STAF.RequestManager('test manager', poll_interval=0.01) as manager:
+            futures = [manager.submit('local', 'echo', str(i))
+                       for i in range(50)]
+            raw = manager.submit('local', 'echo', u'caf\xe9',
+                                 STAF.UNMARSHALL_RAW)
+
+            self.assertEqual([f.result() for f in futures],
+                             [str(i) for i in range(50)])
+            self.assertEqual(type(raw.result()), str)
+            self.assertEqual(raw.result(), 'caf\xc3\xa9')
+
+    def testEarlyExpiry(self):
+        with STAF.RequestManager('test manager', poll_interval=0.01) as manager:
+            manager._early_expiry = 0.05
+            # A completion for a request the manager didn't submit.
+            manager.handle.completions.append(
+                    FakeRequestHandle.completion('999', 'stray'))
+            for i in range(100):
+                if not manager.handle.completions and not manager._early:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(manager._early, {})
+
+            future = manager.submit('local', 'echo', 'foo')
+            self.assertEqual(future.result(), 'foo')
+
 
 if __name__ == '__main__':
     runner = unittest.TextTestRunner(verbosity=2)
@@ -4,16 +4,168 @@
 
 import unittest
 import operator
+import itertools
+import StringIO
+import pickle
+import multiprocessing
+import tempfile
+import struct
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from STAF import (
     unmarshall,
     unmarshall_force,
+    try_unmarshall,
+    looks_marshalled,
+    NOT_MARSHALLED,
+    iter_unmarshall,
+    unmarshall_select,
+    unmarshall_columns,
+    unmarshall_parallel,
     STAFUnmarshallError,
+    Unmarshaller,
+    UNMARSHALL_RECURSIVE,
     UNMARSHALL_NON_RECURSIVE,
     UNMARSHALL_NONE,
+    UNMARSHALL_LAZY,
+    UNMARSHALL_RAW,
     MapClassDefinition,
+    MapClass,
+    marshall,
+    iter_marshall,
+    marshall_to,
+    definition_cache_info,
+    set_definition_cache_size,
+    clear_definition_cache,
+    result_cache_info,
+    set_result_cache_size,
+    clear_result_cache,
+    ReadOnlyList,
+    ReadOnlyDict,
+    ReadOnlyMapClass,
+    dump_snapshot,
+    load_snapshot,
+    register_map_class,
+    LazyList,
+    LazyMapClass,
+    Interner,
 )
 
+# A marshalling context with two map classes.
+map_class_data = (
+    '@SDT/*:1306:'
+    '@SDT/{:743::13:map-class-map'
+    '@SDT/{:715:'
+
+    # ClassFoo:
+    ':8:ClassFoo'
+    '@SDT/{:318:'
+        ':4:keys'
+        '@SDT/[3:274:'
+            '@SDT/{:91:'
+                ':3:key'
+                '@SDT/$S:4:name'
+                ':18:display-short-name'
+                '@SDT/$S:4:Name'
+                ':12:display-name'
+                '@SDT/$S:9:Item Name'
+            '@SDT/{:95:'
+                ':3:key'
+                '@SDT/$S:5:color'
+                ':18:display-short-name'
+                '@SDT/$S:5:Color'
+                ':12:display-name'
+                '@SDT/$S:10:Item Color'
+            '@SDT/{:58:'
+                ':3:key'
+                '@SDT/$S:8:category'
+                ':12:display-name'
+                '@SDT/$S:8:Category'
+        ':4:name'
+        '@SDT/$S:8:ClassFoo'
+
+    # ClassBar:
+    ':8:ClassBar'
+    '@SDT/{:353:'
+        ':4:keys'
+        '@SDT/[3:309:'
+            '@SDT/{:95:'
+                ':3:key'
+                '@SDT/$S:5:fname'
+                ':18:display-short-name'
+                '@SDT/$S:5:First'
+                ':12:display-name'
+                '@SDT/$S:10:First Name'
+            '@SDT/{:92:'
+                ':3:key'
+                '@SDT/$S:5:lname'
+                ':18:display-short-name'
+                '@SDT/$S:4:Last'
+                ':12:display-name'
+                '@SDT/$S:9:Last Name'
+            '@SDT/{:92:'
+                ':3:key'
+                '@SDT/$S:6:number'
+                ':18:display-short-name'
+                '@SDT/$S:6:Number'
+                ':12:display-name'
+                '@SDT/$S:6:Number'
+        ':4:name'
+        '@SDT/$S:8:ClassBar'
+
+    '@SDT/[8:540:'
+        '@SDT/%:54::8:ClassFoo'
+            '@SDT/$S:5:Apple'
+            '@SDT/$S:3:Red'
+            '@SDT/$S:5:Fruit'
+        '@SDT/%:62::8:ClassFoo'
+            '@SDT/$S:6:Carrot'
+            '@SDT/$S:6:Orange'
+            '@SDT/$S:9:Vegetable'
+        '@SDT/%:70::8:ClassFoo'
+            '@SDT/$S:6:Tomato'
+            '@SDT/$S:3:Red'
+            '@SDT/$S:19:Depends who you ask'
+
+        '@SDT/%:59::8:ClassBar'
+            '@SDT/$S:6:George'
+            '@SDT/$S:10:Washington'
+            '@SDT/$S:1:1'
+        '@SDT/%:51::8:ClassBar'
+            '@SDT/$S:4:John'
+            '@SDT/$S:5:Adams'
+            '@SDT/$S:1:2'
+        '@SDT/%:57::8:ClassBar'
+            '@SDT/$S:6:Thomas'
+            '@SDT/$S:9:Jefferson'
+            '@SDT/$S:1:3'
+        '@SDT/%:54::8:ClassBar'
+            '@SDT/$S:5:James'
+            '@SDT/$S:7:Madison'
+            '@SDT/$S:1:4'
+        '@SDT/%:53::8:ClassBar'
+            '@SDT/$S:5:James'
+            '@SDT/$S:6:Monroe'
+            '@SDT/$S:1:5'
+)
+
+map_class_result = [
+    {'name': 'Apple', 'color': 'Red', 'category': 'Fruit'},
+    {'name': 'Carrot', 'color': 'Orange', 'category': 'Vegetable'},
+    {'name': 'Tomato', 'color': 'Red', 'category': 'Depends who you ask'},
+
+    {'fname': 'George', 'lname': 'Washington', 'number': '1'},
+    {'fname': 'John', 'lname': 'Adams', 'number': '2'},
+    {'fname': 'Thomas', 'lname': 'Jefferson', 'number': '3'},
+    {'fname': 'James', 'lname': 'Madison', 'number': '4'},
+    {'fname': 'James', 'lname': 'Monroe', 'number': '5'},
+]
+
 class Unmarshall(unittest.TestCase):
 
     def testUnmarshallScalar(self):
@@ -41,119 +193,9 @@ class Unmarshall(unittest.TestCase):
                          [[], None, 'foo', {}])
 
     def testUnmarshallMapClass(self):
-        data = (
-            '@SDT/*:1306:'
-            '@SDT/{:743::13:map-class-map'
-            '@SDT/{:715:'
-
-            # ClassFoo:
-            ':8:ClassFoo'
-            '@SDT/{:318:'
-                ':4:keys'
-                '@SDT/[3:274:'
-                    '@SDT/{:91:'
-                        ':3:key'
-                        '@SDT/$S:4:name'
-                        ':18:display-short-name'
-                        '@SDT/$S:4:Name'
-                        ':12:display-name'
-                        '@SDT/$S:9:Item Name'
-                    '@SDT/{:95:'
-                        ':3:key'
-                        '@SDT/$S:5:color'
-                        ':18:display-short-name'
-                        '@SDT/$S:5:Color'
-                        ':12:display-name'
-                        '@SDT/$S:10:Item Color'
-                    '@SDT/{:58:'
-                        ':3:key'
-                        '@SDT/$S:8:category'
-                        ':12:display-name'
-                        '@SDT/$S:8:Category'
-                ':4:name'
-                '@SDT/$S:8:ClassFoo'
-
-            # ClassBar:
-            ':8:ClassBar'
-            '@SDT/{:353:'
-                ':4:keys'
-                '@SDT/[3:309:'
-                    '@SDT/{:95:'
-                        ':3:key'
-                        '@SDT/$S:5:fname'
-                        ':18:display-short-name'
-                        '@SDT/$S:5:First'
-                        ':12:display-name'
-                        '@SDT/$S:10:First Name'
-                    '@SDT/{:92:'
-                        ':3:key'
-                        '@SDT/$S:5:lname'
-                        ':18:display-short-name'
-                        '@SDT/$S:4:Last'
-                        ':12:display-name'
-                        '@SDT/$S:9:Last Name'
-                    '@SDT/{:92:'
-                        ':3:key'
-                        '@SDT/$S:6:number'
-                        ':18:display-short-name'
-                        '@SDT/$S:6:Number'
-                        ':12:display-name'
-                        '@SDT/$S:6:Number'
-                ':4:name'
-                '@SDT/$S:8:ClassBar'
-
-            '@SDT/[8:540:'
-                '@SDT/%:54::8:ClassFoo'
-                    '@SDT/$S:5:Apple'
-                    '@SDT/$S:3:Red'
-                    '@SDT/$S:5:Fruit'
-                '@SDT/%:62::8:ClassFoo'
-                    '@SDT/$S:6:Carrot'
-                    '@SDT/$S:6:Orange'
-                    '@SDT/$S:9:Vegetable'
-                '@SDT/%:70::8:ClassFoo'
-                    '@SDT/$S:6:Tomato'
-                    '@SDT/$S:3:Red'
-                    '@SDT/$S:19:Depends who you ask'
-
-                '@SDT/%:59::8:ClassBar'
-                    '@SDT/$S:6:George'
-                    '@SDT/$S:10:Washington'
-                    '@SDT/$S:1:1'
-                '@SDT/%:51::8:ClassBar'
-                    '@SDT/$S:4:John'
-                    '@SDT/$S:5:Adams'
-                    '@SDT/$S:1:2'
-                '@SDT/%:57::8:ClassBar'
-                    '@SDT/$S:6:Thomas'
-                    '@SDT/$S:9:Jefferson'
-                    '@SDT/$S:1:3'
-                '@SDT/%:54::8:ClassBar'
-                    '@SDT/$S:5:James'
-                    '@SDT/$S:7:Madison'
-                    '@SDT/$S:1:4'
-                '@SDT/%:53::8:ClassBar'
-                    '@SDT/$S:5:James'
-                    '@SDT/$S:6:Monroe'
-                    '@SDT/$S:1:5'
-        )
-
-        unmarshalled = unmarshall(data)
+        unmarshalled = unmarshall(map_class_data)
 
-        self.assertEqual(
-            unmarshalled,
-            [
-                {'name': 'Apple', 'color': 'Red', 'category': 'Fruit'},
-                {'name': 'Carrot', 'color': 'Orange', 'category': 'Vegetable'},
-                {'name': 'Tomato', 'color': 'Red', 'category': 'Depends who you ask'},
-
-                {'fname': 'George', 'lname': 'Washington', 'number': '1'},
-                {'fname': 'John', 'lname': 'Adams', 'number': '2'},
-                {'fname': 'Thomas', 'lname': 'Jefferson', 'number': '3'},
-                {'fname': 'James', 'lname': 'Madison', 'number': '4'},
-                {'fname': 'James', 'lname': 'Monroe', 'number': '5'},
-            ]
-        )
+        self.assertEqual(unmarshalled, map_class_result)
 
         for mc in unmarshalled[:3]:
             self.assertEqual(mc.display_name('name'), 'Item Name')
@@ -175,6 +217,27 @@ class Unmarshall(unittest.TestCase):
             self.assertEqual(mc.display_name('number'), 'Number')
             self.assertEqual(mc.display_short_name('number'), 'Number')
 
+    def testMapClassValues(self):
+        # Values other than plain strings, mixed in with plain strings.
+        definition = MapClassDefinition('Mixed')
+        for key in ('a', 'b', 'c', 'd', 'e'):
+            definition.add_item(key, key.upper())
+
+        mc = definition.map_class(a='foo', b=['bar', None], c='@SDT/$S:3:baz',
+                                  d=None, e={'x': 'y'})
+        data = marshall([mc, mc])
+
+        result = unmarshall_force(data)
+        self.assertEqual(result[1].items(),
+                         [('a', 'foo'), ('b', ['bar', None]), ('c', 'baz'),
+                          ('d', None), ('e', {'x': 'y'})])
+
+        result = unmarshall_force(data, UNMARSHALL_NON_RECURSIVE)
+        self.assertEqual(result, [mc, mc])
+
+        self.assertRaises(STAFUnmarshallError, unmarshall_force,
+                          data.replace('$S:3:foo', '$S:4:foo', 1))
+
     def testNoUnmarshall(self):
         no_tag = [
             '',
@@ -197,6 +260,8 @@ class Unmarshall(unittest.TestCase):
         # Nothing should be unmarshalled with UnmarshallNone:
         for test in no_tag + tag:
             self.assertEqual(unmarshall(test, UNMARSHALL_NONE), test)
+            self.assertEqual(unmarshall(test, UNMARSHALL_RAW), test)
+            self.assertEqual(unmarshall_force(test, UNMARSHALL_RAW), test)
 
     def testInvalidData(self):
         bad_strings = [
@@ -246,6 +311,19 @@ class Unmarshall(unittest.TestCase):
             '@SDT/{',
             '@SDT/{:',
             '@SDT/{:0',
+
+            # Objects must not extend past the end of their container
+            '@SDT/[1:8:@SDT/$S:3:foo',
+            '@SDT/{:11::1:k@SDT/$0:0:',
+            '@SDT/[99:0:',
+
+            # Map classes and contexts
+
+            '@SDT/%:0:',
+            '@SDT/%:13::8:NoSuchClass',
+            '@SDT/*:0:',
+            '@SDT/*:10:@SDT/{:0:',
+            '@SDT/*:21:@SDT/{:0:@SDT/$0:0:xx',
         ]
 
         for s in bad_strings:
@@ -256,6 +334,32 @@ class Unmarshall(unittest.TestCase):
                 e.args = ('STAFUnmarshallError not raised for %r' % s,)
                 raise
 
+    def testProbing(self):
+        for s in ['@SDT/$0:0:', '@SDT/$S:3:foo', '@SDT/[0:0:', '@SDT/{:0:',
+                  '@SDT/%:4::1:x', '@SDT/*:1:x', map_class_data]:
+            self.assertTrue(looks_marshalled(s))
+
+        for s in ['', 'foo', '@SDT/', '@SDT/$S:3:fo', '@SDT/$S:3:food',
+                  ' @SDT/$S:3:foo', '@SDT/#:0:', '@SDT/[:0:']:
+            self.assertFalse(looks_marshalled(s))
+            self.assertTrue(try_unmarshall(s) is NOT_MARSHALLED)
+
+        # The header can be right even if the rest isn't.
+        self.assertTrue(looks_marshalled('@SDT/{:3:foo'))
+        self.assertTrue(try_unmarshall('@SDT/{:3:foo') is NOT_MARSHALLED)
+
+        self.assertEqual(try_unmarshall('@SDT/$S:3:foo'), 'foo')
+        self.assertEqual(try_unmarshall('@SDT/$0:0:'), None)
+        self.assertEqual(try_unmarshall('foo', UNMARSHALL_NONE), 'foo')
+
+    def testLargeList(self):
+        items = ['item %d' % i for i in range(10000)]
+        data = ''.join('@SDT/$S:%d:%s' % (len(i), i) for i in items)
+        data = '@SDT/[%d:%d:%s' % (len(items), len(data), data)
+
+        self.assertEqual(unmarshall_force(data), items)
+        self.assertRaises(STAFUnmarshallError, unmarshall_force, data[:-1])
+
     def testRecursion(self):
         s = '@SDT/$S:24:@SDT/$S:13:@SDT/$S:3:foo'
         self.assertEqual(unmarshall(s), 'foo')
@@ -267,6 +371,818 @@ class Unmarshall(unittest.TestCase):
         self.assertEqual(unmarshall(s, UNMARSHALL_NON_RECURSIVE),
                          ['@SDT/[0:0:'])
 
+        # Invalid marshalled strings inside valid data are left alone.
+        s = '@SDT/[2:42:@SDT/$S:10:@SDT/[1:0:@SDT/$S:10:@SDT/[0:0:'
+        self.assertEqual(unmarshall(s), ['@SDT/[1:0:', []])
+
+    def testDeepNesting(self):
+        # Much deeper than the recursion limit.
+        depth = 5000
+
+        s = '@SDT/$S:3:foo'
+        for i in range(depth):
+            s = '@SDT/[1:%d:%s' % (len(s), s)
+
+        obj = unmarshall_force(s)
+        for i in range(depth):
+            self.assertEqual(len(obj), 1)
+            obj = obj[0]
+        self.assertEqual(obj, 'foo')
+
+        s = '@SDT/$S:3:foo'
+        for i in range(depth):
+            s = '@SDT/$S:%d:%s' % (len(s), s)
+
+        self.assertEqual(unmarshall_force(s), 'foo')
+
+
+class LazyUnmarshall(unittest.TestCase):
+
+    def testLazyResults(self):
+        tests = [
+            '@SDT/$0:0:',
+            '@SDT/$S:3:foo',
+            '@SDT/{:0:',
+            '@SDT/{:53:'
+                ':8:some key@SDT/$0:0:'
+                ':7:another@SDT/$S:11:foo bar baz',
+            '@SDT/[0:0:',
+            '@SDT/[4:42:@SDT/[0:0:@SDT/$0:0:@SDT/$S:3:foo@SDT/{:0:',
+            '@SDT/[1:21:@SDT/$S:10:@SDT/[0:0:',
+            map_class_data,
+        ]
+
+        for data in tests:
+            self.assertEqual(unmarshall(data, UNMARSHALL_LAZY),
+                             unmarshall(data))
+
+    def testLazyList(self):
+        lst = unmarshall('@SDT/[4:42:@SDT/[0:0:@SDT/$0:0:@SDT/$S:3:foo'
+                         '@SDT/{:0:', UNMARSHALL_LAZY)
+
+        self.assertEqual(len(lst), 4)
+        self.assertEqual(lst[2], 'foo')
+        self.assertEqual(lst[-2], 'foo')
+        self.assertEqual(lst[1:3], [None, 'foo'])
+        self.assertEqual(list(reversed(lst)), [{}, 'foo', None, []])
+        self.assertTrue('foo' in lst)
+        self.assertEqual(lst.index('foo'), 2)
+        self.assertRaises(IndexError, lst.__getitem__, 4)
+
+        def assign():
+            lst[0] = 'bar'
+        self.assertRaises(TypeError, assign)
+
+    def testLazyMapClass(self):
+        lst = unmarshall(map_class_data, UNMARSHALL_LAZY)
+
+        self.assertEqual(len(lst), 8)
+        mc = lst[4]
+        self.assertEqual(mc.class_name, 'ClassBar')
+        self.assertEqual(mc['lname'], 'Adams')
+        self.assertEqual(mc.keys(), ['fname', 'lname', 'number'])
+        self.assertEqual(mc.values(), ['John', 'Adams', '2'])
+        self.assertTrue('number' in mc)
+        self.assertFalse('name' in mc)
+        self.assertRaises(KeyError, mc.__getitem__, 'name')
+        self.assertEqual(mc.get('name', 'none'), 'none')
+        self.assertEqual(mc.display_name('fname'), 'First Name')
+        self.assertEqual(mc.display_short_name('fname'), 'First')
+        self.assertEqual(mc.definition().keys, ['fname', 'lname', 'number'])
+
+        def assign():
+            mc['fname'] = 'Johnny'
+        self.assertRaises(TypeError, assign)
+
+    def testLazyRecursion(self):
+        s = '@SDT/[2:45:@SDT/$S:10:@SDT/[0:0:@SDT/$S:13:@SDT/$S:3:foo'
+        lst = unmarshall(s, UNMARSHALL_LAZY)
+        self.assertEqual(lst, [[], 'foo'])
+        self.assertEqual(len(lst[0]), 0)
+
+    def testLazyErrors(self):
+        # Only the parts of the data that are used are checked.
+        lst = unmarshall_force('@SDT/[2:23:@SDT/$S:3:foo@SDT/{:1:x',
+                               UNMARSHALL_LAZY)
+        self.assertEqual(lst[0], 'foo')
+        self.assertRaises(STAFUnmarshallError, len, lst[1])
+
+        lst = unmarshall_force('@SDT/[2:13:@SDT/$S:3:foo', UNMARSHALL_LAZY)
+        self.assertEqual(len(lst), 2)
+        self.assertRaises(STAFUnmarshallError, lst.__getitem__, 0)
+
+        for s in ['@SDT/[1:0:', '@SDT/{:1:', '@SDT/$S:3:foo ',
+                  '@SDT/%:13::8:NoSuchClass']:
+            self.assertRaises(STAFUnmarshallError, unmarshall_force, s,
+                              UNMARSHALL_LAZY)
+
+        # Marshalled strings that aren't valid are kept as strings, like they
+        # are by UNMARSHALL_RECURSIVE.
+        s = '@SDT/$S:35:@SDT/{:25::1:c@SDT/[1110:@SDT/$0:0:'
+        self.assertEqual(unmarshall_force(s, UNMARSHALL_LAZY), s[11:])
+        self.assertEqual(unmarshall_force(s, UNMARSHALL_LAZY),
+                         unmarshall_force(s))
+
+class SelectUnmarshall(unittest.TestCase):
+
+    def testSelect(self):
+        data = ('@SDT/{:96:'
+                ':4:list@SDT/[2:34:@SDT/$S:3:foo@SDT/[1:10:@SDT/$0:0:'
+                ':6:nested@SDT/$S:24:@SDT/{:14::1:a@SDT/$0:0:')
+
+        self.assertEqual(unmarshall_select(data, ''), unmarshall(data))
+        self.assertEqual(unmarshall_select(data, 'list'), ['foo', [None]])
+        self.assertEqual(unmarshall_select(data, '.list[1]'), [None])
+        self.assertEqual(unmarshall_select(data, 'list[-2]'), 'foo')
+        self.assertEqual(unmarshall_select(data, '.nested.a'), None)
+        self.assertEqual(unmarshall_select(data, ['list[1][0]', 'nested']),
+                         [None, {'a': None}])
+        self.assertEqual(unmarshall_select(data, 'nested',
+                                           UNMARSHALL_NON_RECURSIVE),
+                         '@SDT/{:14::1:a@SDT/$0:0:')
+
+        self.assertRaises(KeyError, unmarshall_select, data, 'foo')
+        self.assertRaises(KeyError, unmarshall_select, data, 'nested.b')
+        self.assertRaises(IndexError, unmarshall_select, data, 'list[2]')
+        self.assertRaises(TypeError, unmarshall_select, data, 'list.a')
+        self.assertRaises(TypeError, unmarshall_select, data, 'list[1][0].a')
+        self.assertRaises(TypeError, unmarshall_select, data, 'nested[*]')
+        self.assertRaises(KeyError, unmarshall_select, data, '[0]')
+        # Strings can be indexed, like they can be once unmarshalled.
+        self.assertEqual(unmarshall_select(data, 'list[0][1]'), 'o')
+        self.assertRaises(ValueError, unmarshall_select, data, 'list[a]')
+        self.assertRaises(ValueError, unmarshall_select, data, 'list[0]a')
+
+    def testSelectMapClass(self):
+        (everything, first, last, color) = unmarshall_select(
+                map_class_data, ['[*]', '[0].name', '[-1].fname', '[2].color'])
+
+        self.assertEqual(everything, map_class_result)
+        self.assertEqual(everything[0].display_name('name'), 'Item Name')
+        self.assertEqual(first, 'Apple')
+        self.assertEqual(last, 'James')
+        self.assertEqual(color, 'Red')
+
+        # ClassFoo has no 'number' and ClassBar has no 'name'.
+        self.assertRaises(KeyError, unmarshall_select, map_class_data,
+                          '[*].name')
+        self.assertRaises(KeyError, unmarshall_select, map_class_data,
+                          '[*].number')
+
+class ColumnUnmarshall(unittest.TestCase):
+
+    def setUp(self):
+        self.definition = MapClassDefinition('File')
+        self.definition.add_item('name', 'Name')
+        self.definition.add_item('size', 'Size')
+        self.definition.add_item('extra', 'Extra')
+
+        rows = [('foo', '10', None), ('bar', '-2', ['x', 'y']),
+                ('baz', '300', '@SDT/$S:3:qux')]
+        self.data = marshall(self.definition.map_class_rows(rows))
+
+    def testColumns(self):
+        columns = unmarshall_columns(self.data)
+        self.assertEqual(columns.class_name, 'File')
+        self.assertEqual(columns.keys(), ['name', 'size', 'extra'])
+        self.assertEqual(columns.display_name('size'), 'Size')
+        self.assertEqual(columns['name'], ['foo', 'bar', 'baz'])
+        self.assertEqual(columns['size'], ['10', '-2', '300'])
+        self.assertEqual(columns['extra'], [None, ['x', 'y'], 'qux'])
+
+        columns = unmarshall_columns(self.data, UNMARSHALL_NON_RECURSIVE,
+                                     numbers=True)
+        self.assertEqual(columns['size'], [10, -2, 300])
+        self.assertEqual(columns['extra'], [None, ['x', 'y'], '@SDT/$S:3:qux'])
+
+        columns = unmarshall_columns(marshall([self.definition.map_class()]),
+                                     numbers=True)
+        self.assertEqual(columns['size'], [None])
+
+        # Empty lists.
+        self.assertRaises(ValueError, unmarshall_columns, marshall([]))
+
+        data = marshall([self.definition.map_class()])
+        context_map = data[data.index('@SDT/{'):data.index('@SDT/[1:')]
+        data = '@SDT/*:%d:%s@SDT/[0:0:' % (len(context_map) + 10, context_map)
+        columns = unmarshall_columns(data)
+        self.assertEqual(columns.class_name, 'File')
+        self.assertEqual(columns, {'name': [], 'size': [], 'extra': []})
+
+    def testColumnErrors(self):
+        self.assertRaises(ValueError, unmarshall_columns, marshall({}))
+        self.assertRaises(ValueError, unmarshall_columns, marshall([{}]))
+        self.assertRaises(ValueError, unmarshall_columns,
+                          marshall(unmarshall_force(map_class_data)))
+        self.assertRaises(STAFUnmarshallError, unmarshall_columns,
+                          self.data[:-1])
+        self.assertRaises(STAFUnmarshallError, unmarshall_columns,
+                          self.data + ' ')
+
+    def testArrays(self):
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+
+        columns = unmarshall_columns(self.data, numbers=True, arrays=True)
+        self.assertEqual(columns['size'].dtype, numpy.int64)
+        self.assertEqual(columns['size'].sum(), 308)
+        self.assertEqual(columns['name'].dtype, object)
+        self.assertEqual(list(columns['extra']), [None, ['x', 'y'], 'qux'])
+
+class ParallelUnmarshall(unittest.TestCase):
+
+    def testParallel(self):
+        definition = MapClassDefinition('Row')
+        definition.add_item('id', 'ID')
+        definition.add_item('value', 'Value')
+        rows = definition.map_class_rows(
+                [(str(i), ['x' * i, '@SDT/$S:1:%d' % i]) for i in range(50)])
+        lists = [rows, ['a', None, {'b': 'c'}], ['@SDT/$S:3:foo'], []]
+
+        pool = multiprocessing.Pool(2)
+        try:
+            for obj in lists:
+                data = marshall(obj)
+                for mode in [UNMARSHALL_RECURSIVE, UNMARSHALL_NON_RECURSIVE]:
+                    result = unmarshall_parallel(data, mode, threshold=0,
+                                                 pool=pool)
+                    self.assertEqual(result, unmarshall(data, mode))
+
+            result = unmarshall_parallel(marshall(rows), threshold=0,
+                                         pool=pool)
+            self.assertEqual(result[3].class_name, 'Row')
+            self.assertEqual(result[3].display_name('value'), 'Value')
+
+            # Invalid data is returned as-is, like unmarshall().
+            data = marshall(['a', 'b'])
+            data = data.replace('$S:1:b', '$S:2:b')
+            self.assertEqual(unmarshall_parallel(data, threshold=0, pool=pool),
+                             data)
+        finally:
+            pool.close()
+            pool.join()
+
+        # A pool only needs one of imap() and map().
+        class IMapPool(object):
+            def imap(self, function, tasks):
+                return itertools.imap(function, tasks)
+        data = marshall(rows)
+        self.assertEqual(unmarshall_parallel(data, threshold=0,
+                                             pool=IMapPool()),
+                         unmarshall(data))
+
+        # Data that isn't a list or is too small doesn't need a pool.
+        for obj in [{'a': 'b'}, 'foo', None]:
+            self.assertEqual(unmarshall_parallel(marshall(obj), threshold=0),
+                             obj)
+        self.assertEqual(unmarshall_parallel(marshall(['a'])), ['a'])
+        self.assertEqual(unmarshall_parallel('foo', threshold=0), 'foo')
+
+        self.assertTrue(pickle.loads(pickle.dumps(UNMARSHALL_LAZY)) is
+                        UNMARSHALL_LAZY)
+
+class IncrementalUnmarshall(unittest.TestCase):
+
+    def feed_all(self, data, size, mode=UNMARSHALL_RECURSIVE):
+        u = Unmarshaller(mode)
+        items = []
+        for i in range(0, len(data), size):
+            items.extend(u.feed(data[i:i+size]))
+
+        return (items, u.close())
+
+    def testPieces(self):
+        tests = [
+            '@SDT/$0:0:',
+            '@SDT/$S:3:foo',
+            '@SDT/{:53:'
+                ':8:some key@SDT/$0:0:'
+                ':7:another@SDT/$S:11:foo bar baz',
+            '@SDT/[0:0:',
+            '@SDT/[1:21:@SDT/$S:10:@SDT/[0:0:',
+            map_class_data,
+        ]
+
+        for data in tests:
+            for size in (1, 2, 5, 100, len(data)):
+                (items, result) = self.feed_all(data, size)
+                self.assertEqual(result, unmarshall_force(data))
+                if isinstance(result, list):
+                    self.assertEqual(items, result)
+                else:
+                    self.assertEqual(items, [])
+
+        (items, result) = self.feed_all(map_class_data, 7)
+        self.assertEqual(result[0].display_name('name'), 'Item Name')
+
+        self.assertEqual(self.feed_all('@SDT/$S:3:foo', 2, UNMARSHALL_NONE),
+                         ([], '@SDT/$S:3:foo'))
+
+    def testItemsAsCompleted(self):
+        u = Unmarshaller()
+        self.assertEqual(u.feed('@SDT/[3:36:@SDT/$S:3:f'), [])
+        self.assertEqual(u.feed('oo@SDT/$S:3:bar@SDT/'), ['foo', 'bar'])
+        self.assertEqual(u.feed('$0:0:'), [None])
+        self.assertEqual(u.close(), ['foo', 'bar', None])
+
+    def testInvalidData(self):
+        # Bad data is reported as soon as it's seen.
+        u = Unmarshaller()
+        self.assertEqual(u.feed('@SDT/[2:26:@SDT/$S:3:foo'), ['foo'])
+        self.assertRaises(STAFUnmarshallError, u.feed, '@SDT/#')
+
+        u = Unmarshaller()
+        u.feed('@SDT/$S:3:foo')
+        self.assertRaises(STAFUnmarshallError, u.feed, 'bar')
+
+        # Incomplete data is reported by close().
+        for data in ['', '@SDT/', '@SDT/[1:13:@SDT/$S:3:fo']:
+            u = Unmarshaller()
+            u.feed(data)
+            self.assertRaises(STAFUnmarshallError, u.close)
+
+class IterUnmarshall(unittest.TestCase):
+
+    def testIterUnmarshall(self):
+        items = iter_unmarshall(map_class_data)
+        self.assertEqual(items.next(), map_class_result[0])
+        self.assertEqual(list(items), map_class_result[1:])
+
+        data = marshall(['a', None, ['@SDT/$S:1:b'], {'c': 'd'}])
+        self.assertEqual(list(iter_unmarshall(data)),
+                         ['a', None, ['b'], {'c': 'd'}])
+        self.assertEqual(list(iter_unmarshall(data, UNMARSHALL_NON_RECURSIVE)),
+                         ['a', None, ['@SDT/$S:1:b'], {'c': 'd'}])
+        self.assertEqual(list(iter_unmarshall(data, UNMARSHALL_LAZY)),
+                         ['a', None, ['b'], {'c': 'd'}])
+        self.assertEqual(list(iter_unmarshall(marshall([]))), [])
+
+        result = list(iter_unmarshall(map_class_data, interner=True))
+        self.assertTrue(result[3].keys()[0] is result[4].keys()[0])
+
+        # Errors are found as the items are reached.
+        items = iter_unmarshall(data.replace('@SDT/[1:', '@SDT/[x:'))
+        self.assertEqual(items.next(), 'a')
+        self.assertEqual(items.next(), None)
+        self.assertRaises(STAFUnmarshallError, list, items)
+        self.assertRaises(STAFUnmarshallError, list,
+                          iter_unmarshall(data + ' '))
+
+        self.assertRaises(ValueError, list, iter_unmarshall(marshall({})))
+        self.assertRaises(ValueError, list,
+                          iter_unmarshall(data, UNMARSHALL_NONE))
+        self.assertRaises(ValueError, list,
+                          iter_unmarshall(data, UNMARSHALL_RAW))
+
+class Interning(unittest.TestCase):
+
+    def testInterning(self):
+        data = marshall([{'key': 'value %d' % (i % 2), 'n': None}
+                         for i in range(4)])
+
+        result = unmarshall_force(data)
+        self.assertFalse(result[0]['key'] is result[2]['key'])
+
+        for args in [(UNMARSHALL_RECURSIVE, True),
+                     (UNMARSHALL_NON_RECURSIVE, Interner())]:
+            result = unmarshall_force(data, *args)
+            self.assertEqual(result, unmarshall_force(data))
+            self.assertTrue(result[0]['key'] is result[2]['key'])
+            self.assertTrue(result[1]['key'] is result[3]['key'])
+            keys = [[k for k in item if k == 'key'][0] for item in result]
+            self.assertTrue(keys[0] is keys[3])
+
+        # Map class values and incremental unmarshalling.
+        interner = Interner()
+        u = Unmarshaller(interner=interner)
+        for i in range(0, len(map_class_data), 10):
+            u.feed(map_class_data[i:i+10])
+        result = u.close()
+        self.assertEqual(result, map_class_result)
+        self.assertTrue(result[3]['number'] is interner('1'))
+
+    def testInternerLimits(self):
+        # Equal strings that aren't the same object.
+        def copy(string):
+            return ''.join(list(string))
+
+        interner = Interner(maxsize=2, max_length=3)
+        (a, b, c) = ('aaa', 'bbb', 'ccc')
+        self.assertTrue(interner(a) is a)
+        self.assertTrue(interner(copy(a)) is a)
+        self.assertTrue(interner(b) is b)
+        self.assertTrue(interner(c) is c)
+        self.assertFalse(interner(copy(c)) is c)
+        self.assertEqual(len(interner), 2)
+
+        long_str = 'xxxx'
+        self.assertTrue(interner(long_str) is long_str)
+        self.assertFalse(interner(copy(long_str)) is long_str)
+
+        # str and unicode aren't mixed.
+        self.assertTrue(type(interner(u'aaa')) is unicode)
+
+        interner.clear()
+        self.assertEqual(len(interner), 0)
+
+class DefinitionCache(unittest.TestCase):
+
+    def tearDown(self):
+        set_definition_cache_size(100)
+        clear_definition_cache()
+
+    def testCache(self):
+        clear_definition_cache()
+        info = definition_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 0, 0))
+
+        for i in range(3):
+            self.assertEqual(unmarshall_force(map_class_data),
+                             map_class_result)
+        info = definition_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, 1))
+
+        # Cached definitions are used for lazy unmarshalling, selection, and
+        # incremental unmarshalling too.
+        unmarshall_force(map_class_data, UNMARSHALL_LAZY)[0]['name']
+        unmarshall_select(map_class_data, '[0].name')
+        u = Unmarshaller()
+        u.feed(map_class_data)
+        self.assertEqual(u.close()[0].display_name('name'), 'Item Name')
+        self.assertEqual(definition_cache_info().hits, 5)
+
+        # Different definitions are cached separately.
+        mc = MapClassDefinition('ClassBaz')
+        mc.add_item('name', 'Name')
+        data = marshall(mc.map_class(name='foo'))
+        self.assertEqual(unmarshall_force(data)['name'], 'foo')
+        self.assertEqual(definition_cache_info().currsize, 2)
+
+        set_definition_cache_size(1)
+        info = definition_cache_info()
+        self.assertEqual((info.maxsize, info.currsize), (1, 1))
+        self.assertEqual(unmarshall_force(data)['name'], 'foo')
+        self.assertEqual(definition_cache_info().hits, 6)
+
+        set_definition_cache_size(0)
+        self.assertEqual(unmarshall_force(map_class_data), map_class_result)
+        info = definition_cache_info()
+        self.assertEqual((info.hits, info.currsize), (6, 0))
+
+class ResultCache(unittest.TestCase):
+
+    def setUp(self):
+        set_result_cache_size(10)
+
+    def tearDown(self):
+        set_result_cache_size(0)
+        clear_result_cache()
+
+    def testCache(self):
+        result = unmarshall(map_class_data)
+        self.assertEqual(result, map_class_result)
+        self.assertTrue(unmarshall(map_class_data) is result)
+        self.assertTrue(unmarshall_force(map_class_data) is result)
+        info = result_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, 1))
+        self.assertAlmostEqual(info.hit_rate(), 2.0 / 3)
+
+        # Modes, string types, and interners keep results apart.
+        self.assertEqual(unmarshall(map_class_data, UNMARSHALL_NON_RECURSIVE),
+                         map_class_result)
+        self.assertEqual(unmarshall(unicode(map_class_data)), map_class_result)
+        unmarshall(map_class_data, interner=True)
+        info = result_cache_info()
+        self.assertEqual((info.hits, info.currsize), (2, 3))
+
+        # Failures aren't cached.
+        self.assertEqual(unmarshall('@SDT/{:3:foo'), '@SDT/{:3:foo')
+        self.assertEqual(result_cache_info().currsize, 3)
+
+        set_result_cache_size(0)
+        self.assertTrue(unmarshall(map_class_data) is not result)
+        self.assertEqual(type(unmarshall(map_class_data)), list)
+
+    def testRegisteredFactory(self):
+        unmarshall(map_class_data)
+        register_map_class('ClassFoo', dict)
+        try:
+            # Factory results aren't cached, so they aren't shared.
+            result = unmarshall(map_class_data)
+            self.assertEqual(type(result[0]), dict)
+            self.assertEqual(result[0]['name'], 'Apple')
+            result[0]['name'] = 'Pear'
+            self.assertEqual(unmarshall(map_class_data)[0]['name'], 'Apple')
+            self.assertEqual(result_cache_info().currsize, 0)
+        finally:
+            register_map_class('ClassFoo', None)
+        self.assertEqual(type(unmarshall(map_class_data)[0]), ReadOnlyMapClass)
+
+    def testReadOnly(self):
+        data = marshall({'a': ['b', {'c': None}],
+                         'd': unmarshall_force(map_class_data)[0]})
+        result = unmarshall(data)
+        self.assertEqual(result, unmarshall_force(data))
+        self.assertEqual(type(result), ReadOnlyDict)
+        self.assertEqual(type(result['a']), ReadOnlyList)
+        self.assertEqual(type(result['a'][1]), ReadOnlyDict)
+        self.assertEqual(type(result['d']), ReadOnlyMapClass)
+        self.assertEqual(result['d'].display_name('name'), 'Item Name')
+
+        self.assertRaises(NotImplementedError, result.__setitem__, 'a', 1)
+        self.assertRaises(NotImplementedError, result.update, a=1)
+        self.assertRaises(NotImplementedError, result['a'].append, 1)
+        self.assertRaises(NotImplementedError, result['a'].sort)
+        self.assertRaises(NotImplementedError, result['d'].__setitem__,
+                          'name', 1)
+        try:
+            result['a'][:] = []
+        except NotImplementedError:
+            pass
+        else:
+            self.fail('slice assignment succeeded')
+
+        # Copies can be modified.
+        items = list(result['a'])
+        items.append(1)
+        copy = result.copy()
+        copy['a'] = 1
+        mc_copy = result['d'].copy()
+        mc_copy['name'] = 'foo'
+        self.assertEqual(type(mc_copy), MapClass)
+        self.assertEqual(unmarshall(data), unmarshall_force(data))
+
+        self.assertEqual(pickle.loads(pickle.dumps(result, 2)), result)
+        self.assertEqual(type(pickle.loads(pickle.dumps(result['d']))),
+                         ReadOnlyMapClass)
+        self.assertEqual(marshall(result), data)
+
+class RegisteredMapClass(unittest.TestCase):
+
+    def tearDown(self):
+        register_map_class('ClassFoo', None)
+        register_map_class('ClassBar', None)
+
+    def testFactories(self):
+        class Bar(object):
+            __slots__ = ('fname', 'lname', 'number')
+
+            def __init__(self, fname, lname, number):
+                self.fname = fname
+                self.lname = lname
+                self.number = int(number)
+
+        register_map_class('ClassFoo', dict)
+        register_map_class('ClassBar', Bar)
+
+        result = unmarshall_force(map_class_data)
+        self.assertEqual(result[:3], map_class_result[:3])
+        self.assertEqual(type(result[0]), dict)
+        self.assertEqual([(b.fname, b.lname, b.number) for b in result[3:5]],
+                         [('George', 'Washington', 1), ('John', 'Adams', 2)])
+
+        # Unicode keys work as keyword arguments.
+        self.assertEqual(unmarshall(unicode(map_class_data))[0],
+                         map_class_result[0])
+
+        u = Unmarshaller()
+        self.assertEqual(type(u.feed(map_class_data)[4]), Bar)
+        self.assertEqual(unmarshall_select(map_class_data, '[7]').lname,
+                         'Monroe')
+
+        # Lazy results are unaffected.
+        result = unmarshall_force(map_class_data, UNMARSHALL_LAZY)
+        self.assertEqual(result[3].display_name('fname'), 'First Name')
+
+        register_map_class('ClassBar', lambda fname, lname: None)
+        self.assertRaises(TypeError, unmarshall, map_class_data)
+
+        register_map_class('ClassFoo', None)
+        register_map_class('ClassBar', None)
+        self.assertEqual(unmarshall_force(map_class_data)[3].class_name,
+                         'ClassBar')
+
+class Snapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = {
+            'rows': unmarshall_force(map_class_data),
+            'nested': [[], {}, [None, u'caf\xe9', 'x' * 300]],
+            'empty': '',
+        }
+
+    def testRoundTrip(self):
+        f = StringIO.StringIO()
+        dump_snapshot(self.obj, f)
+        dump_snapshot(None, f)
+        dump_snapshot(u'foo', f)
+        data = f.getvalue()
+
+        # Each definition is stored once.
+        self.assertEqual(data.count('Item Name'), 1)
+
+        f = StringIO.StringIO(data)
+        result = load_snapshot(f)
+        self.assertEqual(result, self.obj)
+        self.assertEqual(type(result['nested'][2][1]), unicode)
+        self.assertEqual(type(result['nested'][2][2]), str)
+        row = result['rows'][3]
+        self.assertEqual(row.class_name, 'ClassBar')
+        self.assertEqual(row.keys(), ['fname', 'lname', 'number'])
+        self.assertEqual(row.display_short_name('fname'), 'First')
+        self.assertTrue(row._layout is result['rows'][4]._layout)
+
+        self.assertEqual(load_snapshot(f), None)
+        self.assertEqual(load_snapshot(f), u'foo')
+        self.assertRaises(ValueError, load_snapshot, f)
+
+    def testMappedFile(self):
+        f = tempfile.TemporaryFile()
+        try:
+            f.write('leading data')
+            dump_snapshot(self.obj, f)
+            dump_snapshot(['last'], f)
+            f.seek(len('leading data'))
+
+            self.assertEqual(load_snapshot(f), self.obj)
+
+            position = f.tell()
+            self.assertEqual(load_snapshot(f, lazy=True), ['last'])
+            f.seek(position)
+            result = load_snapshot(f, lazy=True)
+            self.assertTrue(isinstance(result, LazyList))
+            self.assertEqual(result[-1], 'last')
+
+            f.seek(len('leading data'))
+            result = load_snapshot(f, lazy=True)
+            self.assertEqual(result['nested'][2][1], u'caf\xe9')
+            row = result['rows'][2]
+            self.assertTrue(isinstance(row, LazyMapClass))
+            self.assertEqual(row['color'], 'Red')
+            self.assertEqual(row.display_name('color'), 'Item Color')
+            self.assertEqual(result, self.obj)
+
+            # Lazy results can be marshalled or saved again.
+            self.assertEqual(unmarshall(marshall(result)), self.obj)
+            copy = StringIO.StringIO()
+            dump_snapshot(result, copy)
+            copy.seek(0)
+            self.assertEqual(load_snapshot(copy), self.obj)
+        finally:
+            f.close()
+
+    def testInvalidData(self):
+        f = StringIO.StringIO()
+        dump_snapshot(self.obj, f)
+        data = f.getvalue()
+
+        for bad in ['', 'not a snapshot at all', data[:-1],
+                    data.replace('caf\xc3\xa9', 'caf\xff\xa9'),
+                    data[:20] + 'x' + data[21:]]:
+            self.assertRaises(ValueError, load_snapshot, StringIO.StringIO(bad))
+
+    def testInvalidMappedFile(self):
+        f = StringIO.StringIO()
+        dump_snapshot(self.obj, f)
+        data = f.getvalue()
+
+        # Keep track of the mappings to check that they're closed.
+        maps = []
+        original = mmap.mmap
+        class TrackedMap(original):
+            def __new__(cls, *args, **kwargs):
+                result = original.__new__(cls, *args, **kwargs)
+                maps.append(result)
+                return result
+
+        mmap.mmap = TrackedMap
+        try:
+            for bad in ['not a snapshot at all', data[:-1],
+                        data[:8] + '\xff' + data[9:],
+                        data[:20] + 'x' + data[21:],
+                        data.replace('caf\xc3\xa9', 'caf\xff\xa9')]:
+                f = tempfile.TemporaryFile()
+                try:
+                    f.write(bad)
+                    f.seek(0)
+                    self.assertRaises(ValueError, load_snapshot, f)
+                finally:
+                    f.close()
+        finally:
+            mmap.mmap = original
+
+        self.assertEqual(len(maps), 5)
+        for m in maps:
+            self.assertRaises(ValueError, m.read_byte)
+
+    def testInvalidLazyData(self):
+        f = StringIO.StringIO()
+        dump_snapshot({'key': 'value'}, f)
+        data = f.getvalue().replace('s\x05\x00\x00\x00value',
+                                    '?\x05\x00\x00\x00value')
+
+        result = load_snapshot(StringIO.StringIO(data), lazy=True)
+        self.assertRaises(ValueError, result.keys)
+        self.assertRaises(ValueError, operator.getitem, result, 'key')
+
+        f = StringIO.StringIO()
+        dump_snapshot([self.obj['rows'][0], 'x'], f)
+        data = f.getvalue()
+        # Make the map class longer than its values.
+        pos = data.index('m\x00\x00\x00\x00')
+        (length,) = struct.unpack_from('<I', data, pos + 5)
+        data = (data[:pos + 5] + struct.pack('<I', length + 1) +
+                data[pos + 9:])
+
+        result = load_snapshot(StringIO.StringIO(data), lazy=True)
+        self.assertEqual(result[1], 'x')
+        self.assertRaises(ValueError, operator.getitem, result[0], 'fname')
+
+class Marshall(unittest.TestCase):
+
+    def testMarshall(self):
+        self.assertEqual(marshall(None), '@SDT/$0:0:')
+        self.assertEqual(marshall('foo'), '@SDT/$S:3:foo')
+        self.assertEqual(marshall(u'foo'), u'@SDT/$S:3:foo')
+        self.assertEqual(marshall(42), '@SDT/$S:2:42')
+        self.assertEqual(marshall([]), '@SDT/[0:0:')
+        self.assertEqual(marshall({}), '@SDT/{:0:')
+        self.assertEqual(marshall(('foo', None)),
+                         '@SDT/[2:23:@SDT/$S:3:foo@SDT/$0:0:')
+        self.assertEqual(marshall({'key': ['foo']}),
+                         '@SDT/{:30::3:key@SDT/[1:13:@SDT/$S:3:foo')
+
+    def testRoundTrip(self):
+        tests = [
+            None,
+            'foo',
+            u'\u00e9t\u00e9',
+            ['foo', None, [], {}, [['bar']]],
+            {'some key': None, 'another': ['foo', {'x': 'bar baz'}]},
+            '@SDT/$S:3:foo',
+        ]
+
+        for obj in tests:
+            self.assertEqual(unmarshall_force(marshall(obj),
+                                              UNMARSHALL_NON_RECURSIVE), obj)
+
+        # Lazily unmarshalled objects are marshalled like the real thing.
+        data = marshall(tests[3:5])
+        self.assertEqual(marshall(unmarshall(data, UNMARSHALL_LAZY)), data)
+
+    def testMarshallMapClass(self):
+        obj = unmarshall_force(map_class_data)
+        data = marshall(obj)
+        self.assertTrue(data.startswith('@SDT/*:'))
+
+        result = unmarshall_force(data)
+        self.assertEqual(result, map_class_result)
+        for (orig, new) in zip(obj, result):
+            self.assertEqual(new.class_name, orig.class_name)
+            self.assertEqual(new.keys(), orig.keys())
+            for key in orig:
+                self.assertEqual(new.display_name(key),
+                                 orig.display_name(key))
+                self.assertEqual(new.display_short_name(key),
+                                 orig.display_short_name(key))
+
+        # Map classes with the same name must have the same definition.
+        other = MapClassDefinition('ClassFoo')
+        other.add_item('name', 'Item Name', 'Name')
+        self.assertRaises(ValueError, marshall, obj + [other.map_class()])
+
+    def testMarshallDeepNesting(self):
+        depth = 5000
+
+        obj = 'foo'
+        data = '@SDT/$S:3:foo'
+        for i in range(depth):
+            obj = [obj]
+            data = '@SDT/[1:%d:%s' % (len(data), data)
+
+        self.assertEqual(marshall(obj), data)
+
+    def testIterMarshall(self):
+        tests = [
+            None,
+            'foo',
+            [],
+            ['foo', None, [], {}, [['bar']], {'x': ['y']}],
+            ['item %d' % i for i in range(1000)],
+            unmarshall_force(map_class_data),
+        ]
+
+        for obj in tests:
+            data = marshall(obj)
+            for size in (1, 10, 1000):
+                chunks = list(iter_marshall(obj, size))
+                self.assertEqual(''.join(chunks), data)
+                for chunk in chunks[:-1]:
+                    self.assertTrue(len(chunk) >= size)
+
+            f = StringIO.StringIO()
+            marshall_to(obj, f, 100)
+            self.assertEqual(f.getvalue(), data)
 
 class MapClassDefinitionTests(unittest.TestCase):
     def testBasicMapClass(self):
@@ -396,6 +1312,60 @@ class MapClassDefinitionTests(unittest.TestCase):
         self.assertTrue(def2.display_short_name('key2') is None)
         self.assertTrue(def2.display_short_name('key3') is None)
 
+    def testMapClassRows(self):
+        defn = MapClassDefinition('definition')
+        defn.add_item('key1', 'Display Name', 'Short Name')
+        defn.add_item('key2', 'Display Name 2')
+
+        rows = defn.map_class_rows([('a', None), ['b', ['c']]])
+        self.assertEqual(rows, [{'key1': 'a', 'key2': None},
+                                {'key1': 'b', 'key2': ['c']}])
+        self.assertEqual(rows[1].keys(), ['key1', 'key2'])
+        self.assertEqual(rows[1].display_short_name('key1'), 'Short Name')
+        self.assertEqual(rows[0].class_name, 'definition')
+
+        # The usual restrictions still apply.
+        self.assertRaises(KeyError, rows[0].__setitem__, 'key3', 'd')
+        self.assertRaises(NotImplementedError, rows[0].clear)
+
+        self.assertRaises(ValueError, defn.map_class_rows, [('a',)])
+
+    def testPickle(self):
+        mcs = unmarshall_force(map_class_data)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            result = pickle.loads(pickle.dumps(mcs, protocol))
+            self.assertEqual(result, mcs)
+            self.assertEqual(result[0].keys(), ['name', 'color', 'category'])
+            self.assertEqual(result[1].display_name('color'), 'Item Color')
+            self.assertEqual(result[4].class_name, 'ClassBar')
+
+    def testOldPickles(self):
+        # MapClasses pickled with protocols 0 and 2 before they had a shared
+        # layout.
+        old_pickles = [
+            "(lp0\nccopy_reg\n_reconstructor\np1\n(cSTAF\nMapClass\np2\n"
+            "c__builtin__\ndict\np3\n(dp4\nS'a'\np5\nS'x'\np6\nsS'b'\np7\n"
+            "(lp8\nS'y'\np9\nastp10\nRp11\n(dp12\nS'class_name'\np13\n"
+            "S'Foo'\np14\nsS'_keys'\np15\n(lp16\ng5\nag7\nasS'_names'\np17\n"
+            "(dp18\ng5\n(S'A'\np19\nNtp20\nsg7\n(S'B'\np21\ng7\ntp22\nssbag11\n"
+            "a.",
+            '\x80\x02]q\x00(cSTAF\nMapClass\nq\x01)\x81q\x02(U\x01aq\x03U\x01'
+            'xq\x04U\x01bq\x05]q\x06U\x01yq\x07au}q\x08(U\nclass_nameq\tU\x03'
+            'Fooq\nU\x05_keysq\x0b]q\x0c(h\x03h\x05eU\x06_namesq\r}q\x0e(h\x03'
+            'U\x01Aq\x0fN\x86q\x10h\x05U\x01Bq\x11h\x05\x86q\x12uubh\x02e.',
+        ]
+
+        for data in old_pickles:
+            result = pickle.loads(data)
+            self.assertEqual(result, [{'a': 'x', 'b': ['y']}] * 2)
+            mc = result[0]
+            self.assertTrue(isinstance(mc, MapClass))
+            self.assertEqual(mc.class_name, 'Foo')
+            self.assertEqual(mc.keys(), ['a', 'b'])
+            self.assertEqual(mc.display_name('a'), 'A')
+            self.assertEqual(mc.display_short_name('b'), 'b')
+            self.assertRaises(KeyError, mc.__setitem__, 'c', 'z')
+
     def testViews(self):
         if not hasattr(dict, 'viewkeys'):
             print 'Skipping view tests'